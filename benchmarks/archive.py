@@ -0,0 +1,151 @@
+"""
+Runs the archival process end to end on synthetic data, using an in-memory stand-in for Amazon S3, and reports the
+duration of each phase and the peak memory usage.
+
+.. code-block:: shell
+
+   python -m benchmarks.archive
+
+To archive to a local directory instead, for example, to measure throughput to a NAS without network noise:
+
+.. code-block:: shell
+
+   python -m benchmarks.archive --storage /mnt/archive
+
+If the duration of a phase exceeds its baseline by more than the tolerance, the command exits with an error. To
+update the baseline, after an intended change in performance:
+
+.. code-block:: shell
+
+   python -m benchmarks.archive --save-baseline
+"""
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+from unittest import mock
+
+import click
+
+import ocdskingfisherarchive.s3
+from benchmarks.generate import generate
+from ocdskingfisherarchive.archive import Archiver
+from ocdskingfisherarchive.metrics import metrics
+from tests.stand_in import S3StandIn
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+# The phases whose regressions are caught: ScrapyLogFile, Crawl.checksum, LZ4TarFile and Cache.
+PHASES = ('log.logparser', 'log.lines', 'crawl.checksum', 'crawl.write_data_file', 'cache.read', 'cache.write')
+
+
+def peak_rss():
+    """
+    :returns: the peak resident set size of the process, in bytes
+    :rtype: int
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports kilobytes.
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def measure(parameters, repeat=1, storage=None):
+    """
+    Generates synthetic data and runs the archival process on it.
+
+    :param dict parameters: keyword arguments to :func:`benchmarks.generate.generate`
+    :param int repeat: the number of times to run the archival process, using the fastest duration of each phase
+    :param str storage: a directory in which to create a directory to archive to, instead of to an in-memory stand-in
+                        for Amazon S3
+    :returns: the summary of the fastest run of each phase
+    :rtype: dict
+    """
+    result = None
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as directory:
+            data_directory, logs_directory = generate(directory, **parameters)
+            # Each run archives to a new directory, so that no crawl is already archived.
+            bucket_name = f'file://{tempfile.mkdtemp(dir=storage)}' if storage else 'bucket'
+            archiver = Archiver(bucket_name, data_directory, logs_directory, os.path.join(directory, 'cache.sqlite3'))
+
+            with mock.patch.object(ocdskingfisherarchive.s3, 'client', S3StandIn()), \
+                    mock.patch.object(tempfile, 'tempdir', directory):
+                archiver.run()
+            if storage:
+                shutil.rmtree(archiver.s3.directory)
+
+        summary = metrics.summary()
+        if result is None:
+            result = summary
+        else:
+            for phase, totals in summary['phases'].items():
+                if totals['seconds'] < result['phases'][phase]['seconds']:
+                    result['phases'][phase] = totals
+
+    result['peak_rss'] = peak_rss()
+    return result
+
+
+def compare(summary, baseline, tolerance):
+    """
+    :returns: the phases whose durations exceed their baseline by more than the tolerance, as (phase, seconds,
+              baseline seconds) tuples
+    :rtype: list
+    """
+    regressions = []
+    for phase in PHASES:
+        if phase in baseline['phases'] and phase in summary['phases']:
+            seconds = summary['phases'][phase]['seconds']
+            expected = baseline['phases'][phase]['seconds']
+            if seconds > expected * (1 + tolerance):
+                regressions.append((phase, seconds, expected))
+    return regressions
+
+
+@click.command()
+@click.option('--sources', default=3, help='The number of sources')
+@click.option('--months', default=2, help='The number of months of crawls')
+@click.option('--crawls-per-month', default=2, help='The number of crawls per source and month')
+@click.option('--files', default=200, help="The number of files in each source's first crawl")
+@click.option('--file-size', default=20480, help='The approximate size of each file, in bytes')
+@click.option('--errors', default=10, help='The number of FileError items in each log file')
+@click.option('--repeat', default=3, help='The number of runs, using the fastest duration of each phase')
+@click.option('--baseline', default=BASELINE, type=click.Path(dir_okay=False), help='The baseline results file')
+@click.option('--save-baseline', is_flag=True, help='Write the results to the baseline results file')
+@click.option('--tolerance', default=0.5, help='The tolerated slowdown relative to the baseline (0.5 is 50%)')
+@click.option('--storage', type=click.Path(exists=True, file_okay=False),
+              help='Archive to a new directory within this directory (for example, on a NAS), instead of to an '
+                   'in-memory stand-in for Amazon S3')
+def main(repeat, baseline, save_baseline, tolerance, storage, **parameters):
+    summary = measure(parameters, repeat, storage)
+
+    click.echo(f"{'phase':24} {'calls':>7} {'seconds':>9} {'MB/s':>9}")
+    for phase, totals in summary['phases'].items():
+        throughput = totals['bytes_per_second']
+        throughput = f'{throughput / 1024 / 1024:9.1f}' if throughput and totals['bytes'] else f"{'':9}"
+        click.echo(f"{phase:24} {totals['calls']:7d} {totals['seconds']:9.4f} {throughput}")
+    click.echo(f"peak RSS: {summary['peak_rss'] / 1024 / 1024:.1f} MB")
+
+    if save_baseline:
+        with open(baseline, 'w') as f:
+            json.dump({'parameters': parameters, 'phases': summary['phases']}, f, indent=2)
+            f.write('\n')
+        return
+
+    if os.path.exists(baseline):
+        with open(baseline) as f:
+            data = json.load(f)
+        if data['parameters'] != parameters:
+            click.echo(f'Not comparing to the baseline, whose parameters differ: {data["parameters"]}')
+            return
+        regressions = compare(summary, data, tolerance)
+        for phase, seconds, expected in regressions:
+            click.echo(f'Regression in {phase}: {seconds:.4f}s > {expected:.4f}s', err=True)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
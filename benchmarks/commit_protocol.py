@@ -0,0 +1,88 @@
+"""
+Compares the staging and direct commit protocols, with and without bundles, using an in-memory stand-in for Amazon S3
+that simulates the latency of each request and the bandwidth of each transfer.
+
+.. code-block:: shell
+
+   python -m benchmarks.commit_protocol --crawls 10 --size 20
+"""
+import os
+import tempfile
+import time
+from collections import Counter
+from unittest import mock
+
+import click
+import py
+
+import ocdskingfisherarchive.s3
+from ocdskingfisherarchive.archive import Archiver
+from tests import create_crawl
+from tests.stand_in import S3StandIn
+
+
+class SlowStandIn(S3StandIn):
+    def __init__(self, latency, bandwidth):
+        super().__init__()
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def _record(self, operation, key):
+        super()._record(operation, key)
+        time.sleep(self.latency)
+
+    def _transfer(self, size):
+        time.sleep(size / self.bandwidth)
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        response = super().upload_part(Bucket, Key, UploadId, PartNumber, Body, **kwargs)
+        self._transfer(len(Body))
+        return response
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        response = super().put_object(Bucket, Key, Body, **kwargs)
+        self._transfer(len(self.objects[Key]))
+        return response
+
+    def copy(self, CopySource, Bucket, Key, **kwargs):
+        super().copy(CopySource, Bucket, Key, **kwargs)
+        # Server-side copies are faster than uploads, but not free.
+        self._transfer(len(self.objects[Key]) / 10)
+
+
+def measure(direct, bundle, crawls, size, latency, bandwidth):
+    with tempfile.TemporaryDirectory() as directory:
+        tmpdir = py.path.local(directory)
+        for i in range(crawls):
+            # One crawl per source, so that every crawl is archived.
+            create_crawl(tmpdir, '20200801_000000', {'a.json': os.urandom(size // 2).hex()}, source_id=f'source{i}')
+
+        stand_in = SlowStandIn(latency, bandwidth)
+        archiver = Archiver('bucket', tmpdir.join('data'), tmpdir.join('logs', 'kingfisher'),
+                            os.path.join(directory, 'cache.sqlite3'), direct=direct, bundle=bundle)
+
+        with mock.patch.object(ocdskingfisherarchive.s3, 'client', stand_in):
+            start = time.perf_counter()
+            archiver.run()
+            elapsed = time.perf_counter() - start
+
+    return elapsed, Counter(operation for operation, _ in stand_in.requests)
+
+
+@click.command()
+@click.option('--crawls', default=10, help='The number of crawls to archive')
+@click.option('--size', default=1, help='The size of each crawl, in MB')
+@click.option('--latency', default=0.02, help='The latency of each request, in seconds')
+@click.option('--bandwidth', default=100, help='The bandwidth, in MB/s')
+def main(crawls, size, latency, bandwidth):
+    for bundle in (False, True):
+        for direct in (False, True):
+            elapsed, requests = measure(direct, bundle, crawls, size * 1024 * 1024, latency, bandwidth * 1024 * 1024)
+            mode = f"{'direct' if direct else 'staging'}{' bundle' if bundle else ''}"
+            click.echo(f'{mode:15} {elapsed:8.3f}s {sum(requests.values()):5d} requests')
+            for operation, count in sorted(requests.items()):
+                click.echo(f'    {operation:28} {count:5d}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Generates a synthetic FILES_STORE directory and matching Scrapyd logs directory.
+
+.. code-block:: shell
+
+   python -m benchmarks.generate /tmp/synthetic --sources 5 --files 1000
+"""
+import datetime
+import json
+import os
+import random
+
+import click
+
+# The mtime of the crawl directories, so that they are old enough to archive.
+MTIME = 1
+
+
+def generate(directory, sources=3, months=2, crawls_per_month=2, files=100, file_size=10240, errors=0, seed=0):
+    """
+    Generates crawls for each source and month, starting in January 2020.
+
+    Each crawl of a source has the same files as the source's previous crawl, with 10% of files changed, plus one
+    more file, so that later crawls in a month are archived instead of earlier crawls.
+
+    :param str directory: the directory in which to create the ``data`` (FILES_STORE) and ``logs`` directories
+    :param int sources: the number of sources
+    :param int months: the number of months of crawls
+    :param int crawls_per_month: the number of crawls per source and month
+    :param int files: the number of files in each source's first crawl
+    :param int file_size: the approximate size of each file in bytes
+    :param int errors: the number of FileError items in each log file
+    :param int seed: the seed of the random number generator
+    :returns: the paths to the ``data`` and ``logs`` directories
+    :rtype: tuple
+    """
+    generator = random.Random(seed)
+    data_directory = os.path.join(directory, 'data')
+    logs_directory = os.path.join(directory, 'logs', 'kingfisher')
+
+    for i in range(sources):
+        source_id = f'source_{i}'
+        contents = {f'{j}.json': _content(generator, file_size) for j in range(files)}
+
+        for month in range(months):
+            for k in range(crawls_per_month):
+                crawl_time = datetime.datetime(2020 + month // 12, month % 12 + 1, 1 + k)
+
+                for name in generator.sample(sorted(contents), len(contents) // 10):
+                    contents[name] = _content(generator, file_size)
+                contents[f'{len(contents)}.json'] = _content(generator, file_size)
+
+                crawl_directory = os.path.join(data_directory, source_id, crawl_time.strftime('%Y%m%d_%H%M%S'))
+                os.makedirs(crawl_directory)
+                for name, content in contents.items():
+                    with open(os.path.join(crawl_directory, name), 'w') as f:
+                        f.write(content)
+                os.utime(crawl_directory, (MTIME, MTIME))
+
+                log_directory = os.path.join(logs_directory, source_id)
+                os.makedirs(log_directory, exist_ok=True)
+                write_log(os.path.join(log_directory, f'{generator.getrandbits(128):032x}.log'), source_id,
+                          crawl_time, sorted(contents), errors)
+
+    return data_directory, logs_directory
+
+
+def _content(generator, size):
+    # Like OCDS data, the JSON has repetitive keys and varying values, so that it compresses like real data.
+    releases = []
+    length = 0
+    while length < size:
+        release = {
+            'ocid': f'ocds-213czf-{generator.getrandbits(32):08x}',
+            'id': str(generator.getrandbits(48)),
+            'date': f'2020-{generator.randint(1, 12):02d}-{generator.randint(1, 28):02d}T00:00:00Z',
+            'tag': ['tender'],
+            'tender': {'value': {'amount': generator.randint(1, 10 ** 7), 'currency': 'USD'}},
+        }
+        length += len(json.dumps(release)) + 2
+        releases.append(release)
+    return json.dumps({'releases': releases}, indent=None)
+
+
+def write_log(filename, source_id, crawl_time, file_names, errors=0):
+    """
+    Writes a Scrapy log file of a finished crawl, with a File item for each file name and the given number of
+    FileError items.
+
+    :param str filename: the path to the log file
+    :param str source_id: the spider's name
+    :param datetime.datetime crawl_time: the crawl's start time
+    :param list file_names: the file names of the File items
+    :param int errors: the number of FileError items
+    """
+    start = crawl_time.strftime('%Y-%m-%d %H:%M:%S')
+    url = f'https://example.com/{source_id}'
+
+    with open(filename, 'w') as f:
+        f.write(f'{start} [scrapy.utils.log] INFO: Scrapy 2.4.1 started (bot: kingfisher_scrapy)\n')
+        f.write(f"{start} [{source_id}] INFO: Spider arguments: {{'crawl_time': "
+                f"'{crawl_time.strftime('%Y-%m-%dT%H:%M:%S')}', 'note': None}}\n")
+        f.write(f'{start} [scrapy.core.engine] INFO: Spider opened\n')
+
+        for name in file_names:
+            f.write(f'{start} [scrapy.core.engine] DEBUG: Crawled (200) <GET {url}/{name}> (referer: None)\n')
+            f.write(f'{start} [scrapy.core.scraper] DEBUG: Scraped from <200 {url}/{name}>\n')
+            f.write(f"{{'data_type': 'release_package',\n 'encoding': 'utf-8',\n 'file_name': '{name}',\n"
+                    f" 'url': '{url}/{name}'}}\n")
+        for i in range(errors):
+            f.write(f'{start} [scrapy.core.engine] DEBUG: Crawled (503) <GET {url}/error-{i}> (referer: None)\n')
+            f.write(f'{start} [scrapy.core.scraper] DEBUG: Scraped from <503 {url}/error-{i}>\n')
+            f.write(f"{{'errors': {{'http_code': 503}},\n 'file_name': 'error-{i}.json',\n"
+                    f" 'url': '{url}/error-{i}'}}\n")
+
+        count = len(file_names) + errors
+        f.write(f'{start} [scrapy.core.engine] INFO: Closing spider (finished)\n')
+        f.write(f'{start} [scrapy.statscollectors] INFO: Dumping Scrapy stats:\n')
+        f.write(f"{{'finish_reason': 'finished',\n"
+                f" 'finish_time': {crawl_time + datetime.timedelta(hours=1)!r},\n"
+                f" 'item_scraped_count': {count},\n"
+                f" 'start_time': {crawl_time!r}}}\n")
+        f.write(f'{start} [scrapy.core.engine] INFO: Spider closed (finished)\n')
+
+
+@click.command()
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--sources', default=3, help='The number of sources')
+@click.option('--months', default=2, help='The number of months of crawls')
+@click.option('--crawls-per-month', default=2, help='The number of crawls per source and month')
+@click.option('--files', default=100, help="The number of files in each source's first crawl")
+@click.option('--file-size', default=10240, help='The approximate size of each file, in bytes')
+@click.option('--errors', default=0, help='The number of FileError items in each log file')
+@click.option('--seed', default=0, help='The seed of the random number generator')
+def main(directory, **kwargs):
+    data_directory, logs_directory = generate(directory, **kwargs)
+    click.echo(f'KINGFISHER_ARCHIVE_DATA_DIRECTORY={data_directory}')
+    click.echo(f'KINGFISHER_ARCHIVE_LOGS_DIRECTORY={logs_directory}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Measures the time to start the command-line interface, and reports the modules that are slowest to import.
+
+.. code-block:: shell
+
+   python -m benchmarks.startup
+
+If the startup time of a command exceeds the maximum, the command exits with an error.
+"""
+import os
+import subprocess
+import sys
+import time
+
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The commands whose startup time is measured.
+COMMANDS = {
+    'manage.py --help': ['manage.py', '--help'],
+    'import ocdskingfisherarchive.archive': ['-c', 'import ocdskingfisherarchive.archive'],
+}
+
+
+def parse_importtime(stderr):
+    """
+    Parses the output of ``python -X importtime``.
+
+    :param str stderr: the standard error of the process
+    :returns: the modules, as (module, self microseconds, cumulative microseconds) tuples, in the order in which their
+              imports finished. A nested import's module name is indented by two spaces per level.
+    :rtype: list
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        modules.append((module[1:].rstrip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def measure(arguments, repeat=5):
+    """
+    Runs a Python process, with ``-X importtime``.
+
+    :param list arguments: the arguments to the Python interpreter
+    :param int repeat: the number of times to run the process, using the fastest wall time
+    :returns: the fastest wall time in seconds, and the imports of the last run (see :func:`parse_importtime`)
+    :rtype: tuple
+    """
+    fastest = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime', *arguments], cwd=ROOT, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        seconds = time.perf_counter() - start
+        if fastest is None or seconds < fastest:
+            fastest = seconds
+    return fastest, parse_importtime(process.stderr)
+
+
+@click.command()
+@click.option('--repeat', default=5, help='The number of runs, using the fastest wall time')
+@click.option('--top', default=10, help='The number of slowest top-level imports to report')
+@click.option('--max-ms', type=float, help='The maximum startup time of each command, in milliseconds')
+def main(repeat, top, max_ms):
+    slow = False
+    for name, arguments in COMMANDS.items():
+        seconds, modules = measure(arguments, repeat)
+        click.echo(f'{name}: {seconds * 1000:.0f} ms')
+
+        top_level = [module for module in modules if not module[0].startswith(' ')]
+        for module, _, cumulative_us in sorted(top_level, key=lambda module: -module[2])[:top]:
+            click.echo(f'  {cumulative_us / 1000:8.1f} ms  {module}')
+
+        if max_ms is not None and seconds * 1000 > max_ms:
+            click.echo(f'{name} took {seconds * 1000:.0f} ms > {max_ms:.0f} ms', err=True)
+            slow = True
+
+    if slow:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
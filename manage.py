@@ -1,14 +1,23 @@
 #!/usr/bin/env python
+import json
 import logging
 import logging.config
 import os
+import socket
+import sys
 
 import click
-import pidfile
-import sentry_sdk
 from dotenv import load_dotenv
 
-from ocdskingfisherarchive.archive import Archiver
+from ocdskingfisherarchive.buffers import pool
+from ocdskingfisherarchive.metrics import metrics
+from ocdskingfisherarchive.scheduler import POLICIES
+from ocdskingfisherarchive.throttle import lower_priority, throttle
+
+# Modules that are slow to import (like boto3, via ocdskingfisherarchive.archive) are imported by the commands that use
+# them, so that --help and other commands start quickly. To measure startup time, run `python -m benchmarks.startup`.
+
+logger = logging.getLogger('ocdskingfisher.archive')
 
 
 @click.group()
@@ -16,29 +25,129 @@ def cli():
     load_dotenv()
 
 
-@cli.command()
-@click.option('-b', '--bucket-name', envvar='KINGFISHER_ARCHIVE_BUCKET_NAME',
-              help='The Amazon S3 bucket name')
-@click.option('--data-directory', envvar='KINGFISHER_ARCHIVE_DATA_DIRECTORY',
-              type=click.Path(exists=True, file_okay=False),
-              help="Kingfisher Collect's FILES_STORE directory")
-@click.option('--logs-directory', envvar='KINGFISHER_ARCHIVE_LOGS_DIRECTORY',
-              type=click.Path(exists=True, file_okay=False),
-              help="Kingfisher Collect's project directory within Scrapyd's logs_dir directory")
-@click.option('--cache-file', default='cache.sqlite3', envvar='KINGFISHER_ARCHIVE_CACHE_FILE',
-              type=click.Path(exists=False, dir_okay=False),
-              help='The SQLite database for caching the local state (defaults to cache.sqlite3)')
-@click.option('--logging-config-file', envvar='KINGFISHER_ARCHIVE_LOGGING_CONFIG_FILE',
-              type=click.Path(exists=True, dir_okay=False),
-              help="A JSON file following Python's logging configuration dictionary schema")
-@click.option('-n', '--dry-run', is_flag=True,
-              help="Don't archive any files, just show whether they would be")
-@click.option('--invalidate-cache', is_flag=True,
-              help="Ignore and overwrite existing rows in the SQLite database")
-def archive(bucket_name, data_directory, logs_directory, cache_file, logging_config_file, dry_run, invalidate_cache):
+def validate_bucket_name(ctx, param, value):
+    from ocdskingfisherarchive.storage import create_storage
+
+    if value:
+        try:
+            create_storage(value)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+    return value
+
+
+# The options shared by the archive and watch commands, which are passed to create_archiver().
+ARCHIVER_OPTIONS = [
+    click.option('-b', '--bucket-name', envvar='KINGFISHER_ARCHIVE_BUCKET_NAME', callback=validate_bucket_name,
+                 help='The Amazon S3 bucket name, or a file:// URL of a local directory, like file:///mnt/archive'),
+    click.option('--data-directory', envvar='KINGFISHER_ARCHIVE_DATA_DIRECTORY',
+                 type=click.Path(exists=True, file_okay=False),
+                 help="Kingfisher Collect's FILES_STORE directory"),
+    click.option('--logs-directory', envvar='KINGFISHER_ARCHIVE_LOGS_DIRECTORY',
+                 type=click.Path(exists=True, file_okay=False),
+                 help="Kingfisher Collect's project directory within Scrapyd's logs_dir directory"),
+    click.option('--cache-file', default='cache.sqlite3', envvar='KINGFISHER_ARCHIVE_CACHE_FILE',
+                 type=click.Path(exists=False, dir_okay=False),
+                 help='The SQLite database for caching the local state (defaults to cache.sqlite3)'),
+    click.option('--logging-config-file', envvar='KINGFISHER_ARCHIVE_LOGGING_CONFIG_FILE',
+                 type=click.Path(exists=True, dir_okay=False),
+                 help="A JSON file following Python's logging configuration dictionary schema"),
+    click.option('--invalidate-cache', is_flag=True,
+                 help="Ignore and overwrite existing rows in the SQLite database"),
+    click.option('--deduplicate', is_flag=True,
+                 help="Archive only the files that are new relative to the previously archived crawl for the same "
+                      "source"),
+    click.option('--asynchronous', is_flag=True,
+                 help="Make requests to Amazon S3 concurrently, and compress crawls while others are uploaded"),
+    click.option('--queue-size', default=1, type=click.IntRange(min=1),
+                 help="With --asynchronous, the maximum number of compressed crawls waiting to be uploaded "
+                      "(defaults to 1)"),
+    click.option('--reserved-space', default=0, type=click.IntRange(min=0),
+                 help="The MB to keep free in the temporary directory, when compressing a crawl (defaults to 0)"),
+    click.option('--direct', is_flag=True,
+                 help="Upload files to their final keys, and commit the archival by uploading the metadata file "
+                      "last"),
+    click.option('--bundle', is_flag=True,
+                 help="Archive each crawl's metadata, data and log files as one object, to make fewer requests"),
+    click.option('--policy', default='scan', type=click.Choice(POLICIES),
+                 help="The order in which to archive crawls: as found, largest first or oldest first (defaults to "
+                      "scan)"),
+    click.option('--max-size', type=click.IntRange(min=0),
+                 help="The maximum MB of crawls to archive per run, skipping crawls that would exceed it"),
+    click.option('--max-duration', type=click.IntRange(min=0),
+                 help="The maximum minutes after which to start archiving a crawl, per run"),
+    click.option('--read-limit', type=click.FloatRange(min=0),
+                 help="The maximum MB/s to read from disk, when calculating checksums and compressing crawls"),
+    click.option('--upload-limit', type=click.FloatRange(min=0),
+                 help="The maximum MB/s to upload to Amazon S3"),
+    click.option('--cpu-limit', type=click.IntRange(min=1),
+                 help="The maximum CPU usage, as a percentage of one CPU"),
+    click.option('--delete-limit', type=click.FloatRange(min=0),
+                 help="The maximum files/s to delete, when deleting crawl directories"),
+    click.option('--delete-jobs', default=4, type=click.IntRange(min=1),
+                 help="The maximum number of threads deleting crawl directories at once (defaults to 4)"),
+    click.option('--reclaim-directory', envvar='KINGFISHER_ARCHIVE_RECLAIM_DIRECTORY',
+                 type=click.Path(file_okay=False),
+                 help="The directory to which to move crawl directories before deleting them, on the same filesystem "
+                      "as the data directory (defaults to .reclaim beside the data directory)"),
+    click.option('--retention', default=90, type=click.IntRange(min=1),
+                 help="The days after which to delete a crawl that is not archived, because it was rejected or "
+                      "another crawl was archived for the same source and month (defaults to 90)"),
+    click.option('--block-size', default=1, type=click.IntRange(min=1),
+                 help="The size in MB of each block read from a file, when calculating checksums, compressing crawl "
+                      "directories and uploading files (defaults to 1)"),
+    click.option('--keep-page-cache', is_flag=True,
+                 help="Don't drop files from the page cache once read, which otherwise avoids evicting the files "
+                      "that Kingfisher Collect is using"),
+    click.option('--nice', default=0, type=click.IntRange(min=0, max=19),
+                 help="The amount by which to increase the process' niceness (defaults to 0)"),
+    click.option('--idle-io', is_flag=True,
+                 help="Use the idle I/O scheduling class, so that the disk is used only when no other process uses "
+                      "it (Linux only)"),
+    click.option('--shard-index', default=0, envvar='KINGFISHER_ARCHIVE_SHARD_INDEX', type=click.IntRange(min=0),
+                 help="This worker's index, from 0 to --shard-count minus 1 (defaults to 0)"),
+    click.option('--shard-count', default=1, envvar='KINGFISHER_ARCHIVE_SHARD_COUNT', type=click.IntRange(min=1),
+                 help="The number of workers across which to partition sources (defaults to 1)"),
+    click.option('--leases', is_flag=True,
+                 help="Acquire a lease in the bucket on each source and month before archiving it, so that workers "
+                      "on different hosts never archive the same month at once"),
+    click.option('--worker-id', default=socket.gethostname, envvar='KINGFISHER_ARCHIVE_WORKER_ID',
+                 help="With --leases, this worker's unique ID (defaults to the hostname)"),
+    click.option('--lease-duration', default=720, type=click.IntRange(min=1),
+                 help="With --leases, the minutes after which a lease that wasn't released expires, which must exceed "
+                      "the duration of the longest archival (defaults to 720)"),
+]
+
+METRICS_OPTIONS = [
+    click.option('--metrics-file', type=click.Path(dir_okay=False),
+                 help="Write a JSON summary of the duration and throughput of each phase of the run to this file"),
+    click.option('--prometheus-file', type=click.Path(dir_okay=False),
+                 help="Write the summary in Prometheus' text format to this file, for node_exporter's textfile "
+                      "collector"),
+]
+
+
+def options(decorators):
     """
-    Archives data and log files written by Kingfisher Collect to Amazon S3.
+    Returns a decorator that adds the options to a command.
     """
+    def decorator(function):
+        for option in reversed(decorators):
+            function = option(function)
+        return function
+    return decorator
+
+
+def create_archiver(bucket_name, data_directory, logs_directory, cache_file, logging_config_file, invalidate_cache,
+                    deduplicate, asynchronous, queue_size, reserved_space, direct, bundle, policy, max_size,
+                    max_duration, read_limit, upload_limit, cpu_limit, delete_limit, delete_jobs, reclaim_directory,
+                    retention, block_size, keep_page_cache, nice, idle_io, shard_index, shard_count, leases, worker_id,
+                    lease_duration):
+    """
+    Configures logging, throttling and the process' priority, and returns an archiver.
+    """
+    from ocdskingfisherarchive.archive import Archiver
+
     if logging_config_file:
         logging.config.fileConfig(logging_config_file)
     else:
@@ -50,14 +159,280 @@ def archive(bucket_name, data_directory, logs_directory, cache_file, logging_con
         raise click.UsageError('--data-directory or KINGFISHER_ARCHIVE_DATA_DIRECTORY must be set')
     if not logs_directory:
         raise click.UsageError('--logs-directory or KINGFISHER_ARCHIVE_LOGS_DIRECTORY must be set')
+    if shard_index >= shard_count:
+        raise click.UsageError('--shard-index must be less than --shard-count')
+    if bundle and deduplicate:
+        raise click.UsageError('--bundle and --deduplicate are mutually exclusive')
+
+    throttle.configure(read_rate=read_limit and read_limit * 1024 * 1024,
+                       upload_rate=upload_limit and upload_limit * 1024 * 1024,
+                       cpu=cpu_limit and cpu_limit / 100, delete_rate=delete_limit)
+    pool.configure(block_size=block_size * 1024 * 1024, drop_cache=not keep_page_cache)
+    lower_priority(nice, idle_io)
+
+    return Archiver(bucket_name, data_directory, logs_directory, cache_file, invalidate_cache,
+                    deduplicate=deduplicate, asynchronous=asynchronous, queue_size=queue_size,
+                    reserved_space=reserved_space * 1024 * 1024, direct=direct, policy=policy,
+                    max_bytes=None if max_size is None else max_size * 1024 * 1024,
+                    max_seconds=None if max_duration is None else max_duration * 60, shard_index=shard_index,
+                    shard_count=shard_count, lease_owner=worker_id if leases else None,
+                    lease_seconds=lease_duration * 60, delete_jobs=delete_jobs, reclaim_directory=reclaim_directory,
+                    retention_seconds=retention * 24 * 60 * 60, bundle=bundle)
+
+
+def write_metrics(metrics_file, prometheus_file):
+    """
+    Logs the summary of the run, and writes it to the metrics files, if any.
+    """
+    logger.info('Run summary: %s', json.dumps(metrics.summary()))
+    if metrics_file:
+        metrics.write_json(metrics_file)
+    if prometheus_file:
+        metrics.write_prometheus(prometheus_file)
+
+
+@cli.command()
+@options(ARCHIVER_OPTIONS)
+@click.option('-n', '--dry-run', is_flag=True,
+              help="Don't archive any files, just show whether they would be")
+@options(METRICS_OPTIONS)
+@click.option('--profile', is_flag=True,
+              help="Profile the run with cProfile, and print the functions with the highest cumulative time")
+@click.option('--profile-output', default='archive.prof', type=click.Path(dir_okay=False),
+              help="With --profile, the pstats file to which to write the results (defaults to archive.prof)")
+@click.option('--profile-phase', multiple=True,
+              help="With --profile, profile only this phase, like log.lines, crawl.checksum or crawl.write_data_file "
+                   "(can be repeated)")
+def archive(dry_run, metrics_file, prometheus_file, profile, profile_output, profile_phase, **kwargs):
+    """
+    Archives data and log files written by Kingfisher Collect to Amazon S3.
+    """
+    import pidfile
+
+    from ocdskingfisherarchive.profiler import Profiler
+
+    archiver = create_archiver(**kwargs)
+    profiler = Profiler(phases=profile_phase) if profile else None
 
     # We don't catch pidfile.AlreadyRunningError so that it can be raised to Sentry. If this error is raised by a cron
     # job, it points to either a very slow archival process, or to an unanticipated problem.
     with pidfile.PIDFile():
-        Archiver(bucket_name, data_directory, logs_directory, cache_file, invalidate_cache).run(dry_run)
+        if profiler:
+            with profiler.profiling():
+                archiver.run(dry_run)
+        else:
+            archiver.run(dry_run)
+
+    write_metrics(metrics_file, prometheus_file)
+    if profiler:
+        profiler.write(profile_output)
+        profiler.print_stats(sys.stderr)
+
+
+@cli.command()
+@options(ARCHIVER_OPTIONS)
+@click.option('--interval', default=60, type=click.IntRange(min=1),
+              help="The minutes between scans of the data directory, if inotify is unavailable, and between retries "
+                   "of crawls that weren't archived (defaults to 60)")
+@options(METRICS_OPTIONS)
+def watch(interval, metrics_file, prometheus_file, **kwargs):
+    """
+    Archives each crawl once its directory is quiet, in a long-running process.
+    """
+    import pidfile
+
+    from ocdskingfisherarchive.watch import Watcher
+
+    archiver = create_archiver(**kwargs)
+
+    # Unlike the archive command, this command is expected to run continuously, under a process manager. The process
+    # lock prevents it from running at the same time as the archive command.
+    with pidfile.PIDFile():
+        Watcher(archiver, interval=interval * 60).run(callback=lambda: write_metrics(metrics_file, prometheus_file))
+
+
+@cli.command()
+@click.option('--cache-file', default='cache.sqlite3', envvar='KINGFISHER_ARCHIVE_CACHE_FILE',
+              type=click.Path(exists=True, dir_okay=False),
+              help='The SQLite database for caching the local state (defaults to cache.sqlite3)')
+@click.option('--source', help='Report only this source')
+@click.option('--format', 'output_format', default='table', type=click.Choice(['table', 'json']),
+              help='The output format (defaults to table)')
+def report(cache_file, source, output_format):
+    """
+    Reports the crawls pending archival, archived, rejected and ignored, per source, from the SQLite database.
+
+    This command reads neither the data directory nor Amazon S3. Crawls that were not yet evaluated are not reported.
+    """
+    from ocdskingfisherarchive.cache import Cache
+
+    cache = Cache(cache_file)
+    sources = cache.get_sources(source)
+    rejected = cache.get_rejected(source)
+
+    if output_format == 'json':
+        click.echo(json.dumps({'sources': sources, 'rejected': rejected}, indent=2))
+        return
+
+    statuses = ('pending', 'archived', 'rejected', 'ignored')
+    header = ''.join(f"{status:>10} {'MB':>10}" for status in statuses)
+    click.echo(f"{'source':40}{header} {'compressed MB':>14}")
+    for source_id, totals in sources.items():
+        row = ''.join(f"{totals[status]['crawls']:10d} {totals[status]['bytes'] / 1024 / 1024:10.1f}"
+                      for status in statuses)
+        click.echo(f"{source_id:40}{row} {totals['archived']['compressed_bytes'] / 1024 / 1024:14.1f}")
+
+    if rejected:
+        click.echo()
+        click.echo(f"{'rejected crawl':60} reason")
+        for crawl in rejected:
+            click.echo(f"{crawl['source_id'] + '/' + crawl['data_version']:60} {crawl['reject_reason']}")
+
+
+def parse_period(ctx, param, value):
+    periods = []
+    for period in value:
+        try:
+            year, month = map(int, period.split('/'))
+        except ValueError:
+            raise click.BadParameter(f'{period!r} is not in YYYY/MM format')
+        if not 1 <= month <= 12:
+            raise click.BadParameter(f'{period!r} has an invalid month')
+        periods.append((year, month))
+    return periods
+
+
+@cli.command()
+@click.argument('source')
+@click.argument('periods', nargs=-1, required=True, callback=parse_period, metavar='YYYY/MM...')
+@click.option('-b', '--bucket-name', envvar='KINGFISHER_ARCHIVE_BUCKET_NAME', callback=validate_bucket_name,
+              help='The Amazon S3 bucket name, or a file:// URL of a local directory')
+@click.option('--dest', default='.', type=click.Path(file_okay=False),
+              help="The directory into which to restore the crawls, with the same layout as Kingfisher Collect's "
+                   "FILES_STORE directory (defaults to the current directory)")
+@click.option('--jobs', default=4, type=click.IntRange(min=1),
+              help='The maximum number of crawls to restore at once (defaults to 4)')
+@click.option('--connections', default=4, type=click.IntRange(min=1),
+              help='The maximum number of concurrent ranged requests per crawl (defaults to 4)')
+def restore(source, periods, bucket_name, dest, jobs, connections):
+    """
+    Restores the crawls archived for the SOURCE in each month, verifying their checksums.
+
+    Archives are downloaded using concurrent ranged requests, and decompressed and extracted as a stream.
+    """
+    from ocdskingfisherarchive.restore import restore_all
+    from ocdskingfisherarchive.storage import create_storage
+
+    logging.basicConfig(level=logging.INFO)
+
+    if not bucket_name:
+        raise click.UsageError('--bucket-name or KINGFISHER_ARCHIVE_BUCKET_NAME must be set')
+
+    storage = create_storage(bucket_name)
+    for local_directory in restore_all(storage, source, periods, dest, jobs=jobs, concurrency=connections):
+        click.echo(local_directory)
+
+
+@cli.command()
+@click.option('-b', '--bucket-name', envvar='KINGFISHER_ARCHIVE_BUCKET_NAME', callback=validate_bucket_name,
+              help='The Amazon S3 bucket name, or a file:// URL of a local directory')
+@click.option('--cache-file', default='cache.sqlite3', envvar='KINGFISHER_ARCHIVE_CACHE_FILE',
+              type=click.Path(exists=False, dir_okay=False),
+              help='The SQLite database for recording the results (defaults to cache.sqlite3)')
+@click.option('--source', help='Audit only this source')
+@click.option('--sample', type=click.IntRange(min=1),
+              help='The number of archived crawls to audit, selected at random among those not yet audited')
+@click.option('--seed', type=int, help='The seed of the random selection')
+@click.option('--force', is_flag=True, help='Audit archived crawls again, if already audited')
+@click.option('--jobs', default=4, type=click.IntRange(min=1),
+              help='The maximum number of archived crawls to audit at once (defaults to 4)')
+@click.option('--connections', default=4, type=click.IntRange(min=1),
+              help='The maximum number of concurrent ranged requests per archive (defaults to 4)')
+def audit(bucket_name, cache_file, source, sample, seed, force, jobs, connections):
+    """
+    Verifies that archived crawls match the checksums in their metadata files.
+
+    Archives are downloaded using concurrent ranged requests, and decompressed and read as a stream, without writing
+    to disk. Results are recorded in the SQLite database, and archived crawls that were already audited are skipped,
+    unless archived again since. Exits with an error if any archived crawl fails the audit.
+    """
+    from ocdskingfisherarchive.audit import OK, Auditor
+    from ocdskingfisherarchive.cache import Cache
+    from ocdskingfisherarchive.storage import create_storage
+
+    logging.basicConfig(level=logging.INFO)
+
+    if not bucket_name:
+        raise click.UsageError('--bucket-name or KINGFISHER_ARCHIVE_BUCKET_NAME must be set')
+
+    auditor = Auditor(create_storage(bucket_name), Cache(cache_file), jobs=jobs, concurrency=connections)
+    results = auditor.run(source, sample=sample, seed=seed, force=force)
+
+    failed = sorted(remote_directory for remote_directory, status in results.items() if status != OK)
+    click.echo(f'{len(results) - len(failed)} of {len(results)} archived crawls passed the audit')
+    for remote_directory in failed:
+        click.echo(f'{remote_directory:60} {results[remote_directory]}')
+    if failed:
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('-b', '--bucket-name', envvar='KINGFISHER_ARCHIVE_BUCKET_NAME', callback=validate_bucket_name,
+              help='The Amazon S3 bucket name, or a file:// URL of a local directory, to export the archived crawls')
+@click.option('--cache-file', default='cache.sqlite3', envvar='KINGFISHER_ARCHIVE_CACHE_FILE',
+              type=click.Path(exists=True, dir_okay=False),
+              help='The SQLite database, to export the evaluated crawls (defaults to cache.sqlite3)')
+@click.option('--source', help='Export only this source')
+@click.option('--output', default='history.npz', type=click.Path(dir_okay=False),
+              help='The file to write (defaults to history.npz)')
+def export_history(bucket_name, cache_file, source, output):
+    """
+    Exports the history of crawls to a columnar file, for the simulate command.
+
+    Crawls that were evaluated are read from the SQLite database, and crawls that were archived are read from the
+    metadata files in the bucket, if --bucket-name is set.
+    """
+    from ocdskingfisherarchive.cache import Cache
+    from ocdskingfisherarchive.history import History
+    from ocdskingfisherarchive.storage import create_storage
+
+    history = History.export(Cache(cache_file), bucket_name and create_storage(bucket_name), source)
+    history.save(output)
+    click.echo(f'Exported {len(history)} crawls of {len(history.sources)} sources to {output}')
+
+
+@cli.command()
+@click.argument('history_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--bytes-ratio', multiple=True, type=click.FloatRange(min=1),
+              help='The factor by which a crawl\'s bytes must exceed those of an earlier crawl in the same month, for '
+                   'it to be archived instead (repeatable)')
+@click.option('--files-ratio', multiple=True, type=click.FloatRange(min=1),
+              help='The factor by which a crawl\'s files must exceed those of an earlier crawl in the same month, for '
+                   'it to be archived instead (repeatable)')
+def simulate(history_file, bytes_ratio, files_ratio):
+    """
+    Reports how many crawls and bytes would be archived under each variant of the data retention policy.
+
+    Replays the policy over the HISTORY_FILE written by the export-history command, for every combination of the
+    --bytes-ratio and --files-ratio options, and for the current policy.
+    """
+    from ocdskingfisherarchive.crawl import BYTES_RATIO, FILES_RATIO
+    from ocdskingfisherarchive.history import History, report, variants
+
+    history = History.load(history_file)
+    combinations = variants(bytes_ratio or (BYTES_RATIO,), files_ratio or (FILES_RATIO,))
+    if (BYTES_RATIO, FILES_RATIO) not in combinations:
+        combinations.insert(0, (BYTES_RATIO, FILES_RATIO))
+
+    click.echo(f"{'bytes ratio':>12} {'files ratio':>12} {'archives':>10} {'MB':>12}")
+    for row in report(history, combinations):
+        click.echo(f"{row['bytes_ratio']:12.2f} {row['files_ratio']:12.2f} {row['archives']:10d} "
+                   f"{row['bytes'] / 1024 / 1024:12.1f}")
 
 
 if __name__ == '__main__':
     if 'SENTRY_DSN' in os.environ:
+        import sentry_sdk
+
         sentry_sdk.init(dsn=os.getenv('SENTRY_DSN'))
     cli()
@@ -1,94 +1,389 @@
+import asyncio
+import json
 import logging
 import os
 import shutil
-from collections import defaultdict
+import tempfile
+from collections import deque
+from functools import partial
 
+from ocdskingfisherarchive.bundle import BUNDLE_NAME, Bundle
 from ocdskingfisherarchive.cache import Cache
 from ocdskingfisherarchive.crawl import Crawl
-from ocdskingfisherarchive.s3 import S3
+from ocdskingfisherarchive.exceptions import ConcurrentArchivalError
+from ocdskingfisherarchive.lease import LEASE_SECONDS, Leases
+from ocdskingfisherarchive.manifest import Manifest
+from ocdskingfisherarchive.metrics import metrics
+from ocdskingfisherarchive.reclaim import RETENTION_PERIOD, Reclaimer
+from ocdskingfisherarchive.scheduler import Scheduler
+from ocdskingfisherarchive.scrapy_log_file import ScrapyLogFile
+from ocdskingfisherarchive.shard import Shard
+from ocdskingfisherarchive.storage import AsyncStorage, create_storage
 
 logger = logging.getLogger('ocdskingfisher.archive')
 
+# The maximum number of groups of crawls whose crawl information is looked up in remote storage at once, ahead of their
+# evaluation, when archiving asynchronously.
+LOOKAHEAD = 8
+
 
 class Archiver:
-    def __init__(self, bucket_name, data_directory, logs_directory, cache_file, cached_expired=False):
+    def __init__(self, bucket_name, data_directory, logs_directory, cache_file, cached_expired=False,
+                 deduplicate=False, asynchronous=False, queue_size=1, reserved_space=0, direct=False, policy='scan',
+                 max_bytes=None, max_seconds=None, shard_index=0, shard_count=1, lease_owner=None,
+                 lease_seconds=LEASE_SECONDS, delete_jobs=4, reclaim_directory=None,
+                 retention_seconds=RETENTION_PERIOD, bundle=False):
         """
-        :param str bucket_name: an Amazon S3 bucket name
+        :param str bucket_name: an Amazon S3 bucket name, or a ``file://`` URL of a local directory (see
+                                :func:`~ocdskingfisherarchive.storage.create_storage`)
         :param str data_directory: Kingfisher Collect's FILES_STORE directory
         :param str logs_directory: Kingfisher Collect's project directory within Scrapyd's logs_dir directory
         :param str cache_file: the path to a SQLite database for caching the local state
         :param bool cached_expired: whether to ignore and overwrite existing rows in the SQLite database
+        :param bool deduplicate: whether to archive in content-addressed mode (see
+                                 :class:`~ocdskingfisherarchive.manifest.Manifest`)
+        :param bool asynchronous: whether to use the asyncio interface to the storage (see
+                                  :class:`~ocdskingfisherarchive.storage.AsyncStorage`), to look up remote crawls for
+                                  all groups at once, to upload a crawl's files at once, and to evaluate and compress
+                                  the next groups' crawls while the previous group's best crawl is uploaded
+        :param int queue_size: if asynchronous, the maximum number of compressed crawls waiting to be uploaded
+        :param int reserved_space: the number of bytes to keep free in the temporary directory, when compressing a
+                                   crawl (if asynchronous, compression waits for uploads to finish; if there is still
+                                   insufficient space, the crawl is skipped)
+        :param bool direct: whether to upload files to their final keys, and commit the archival by uploading the
+                            metadata file last, instead of uploading files to the staging directory
+        :param str policy: the order in which to archive groups of crawls (see
+                           :data:`~ocdskingfisherarchive.scheduler.POLICIES`)
+        :param int max_bytes: the maximum number of bytes of crawls to archive in a run
+        :param float max_seconds: the maximum number of seconds after which to start archiving a group of crawls
+        :param int shard_index: this worker's index, if sources are partitioned across workers (see
+                                :class:`~ocdskingfisherarchive.shard.Shard`)
+        :param int shard_count: the number of workers across which sources are partitioned
+        :param str lease_owner: if set, this worker's ID, to acquire a lease on each remote directory before archiving
+                                to it (see :class:`~ocdskingfisherarchive.lease.Leases`)
+        :param float lease_seconds: the number of seconds after which a lease that wasn't released expires, and after
+                                    which a staged file or upload that no archival in progress references is swept
+        :param int delete_jobs: the maximum number of threads deleting crawl directories at once (see
+                                :class:`~ocdskingfisherarchive.reclaim.Reclaimer`)
+        :param str reclaim_directory: the directory to which to move crawl directories before deleting them, which
+                                      should be on the same filesystem as the data directory (defaults to
+                                      ``.reclaim`` beside the data directory)
+        :param float retention_seconds: the number of seconds after which to delete a crawl that is not archived, or
+                                        ``None`` to keep it
+        :param bool bundle: whether to archive a crawl's metadata, data and log files as one bundle (see
+                            :class:`~ocdskingfisherarchive.bundle.Bundle`), instead of as multiple files
         """
-        self.s3 = S3(bucket_name)
+        self.s3 = create_storage(bucket_name)
         self.data_directory = data_directory
         self.logs_directory = logs_directory
         self.cache = Cache(cache_file, expired=cached_expired)
+        self.deduplicate = deduplicate
+        self.asynchronous = asynchronous
+        self.async_s3 = AsyncStorage(self.s3) if asynchronous else None
+        self.queue_size = queue_size
+        self.reserved_space = reserved_space
+        self.direct = direct
+        self.bundle = bundle
+        self.scheduler = Scheduler(policy, max_bytes=max_bytes, max_seconds=max_seconds)
+        self.shard = Shard(shard_index, shard_count)
+        self.leases = Leases(self.s3, lease_owner, lease_seconds) if lease_owner else None
+        self.lease_seconds = lease_seconds
+        if reclaim_directory is None:
+            reclaim_directory = os.path.join(os.path.dirname(os.path.abspath(data_directory)), '.reclaim')
+        self.reclaimer = Reclaimer(reclaim_directory, delete_jobs)
+        self.retention_seconds = retention_seconds
 
-    def run(self, dry_run=False):
+    def run(self, dry_run=False, crawls=None):
         """
         Runs the archival process.
 
+        Timers and counters are reset, and can be read from :data:`ocdskingfisherarchive.metrics.metrics` once the
+        process ends.
+
+        If sources are partitioned across workers, only this worker's sources are archived. If leases are used, a
+        group of crawls is skipped if another worker holds the lease on its remote directory.
+
+        Crawl directories are deleted in the background, and the run ends once they are deleted.
+
         :param bool dry_run: whether to modify the filesystem and the bucket
+        :param list crawls: the crawls to consider, instead of all crawls in the data directory (see
+                            :meth:`~ocdskingfisherarchive.crawl.Crawl.all`)
+        """
+        if crawls is None:
+            crawls = Crawl.all(self.data_directory, self.logs_directory)
+        else:
+            crawls = sorted(crawls, key=lambda crawl: (crawl.source_id, crawl.data_version))
+
+        metrics.reset()
+        self.scheduler.start()
+
+        try:
+            self._run(crawls, dry_run)
+        finally:
+            if self.async_s3:
+                self.async_s3.close()
+            if self.leases:
+                self.leases.release_all()
+            self.reclaimer.wait()
+
+    def _run(self, crawls, dry_run):
+        if not dry_run:
+            self.resume()
+            self.reclaimer.resume()
+            self.expire()
+
+        ordered = self.scheduler.order(self._groups(crawls))
+
+        if self.asynchronous:
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(self._run_async(ordered, dry_run))
+            finally:
+                loop.close()
+            return
+
+        for crawls in ordered:
+            if self.scheduler.expired():
+                break
+
+            remote_directory = crawls[0].remote_directory
+            if not dry_run and not self._acquire(remote_directory):
+                continue
+
+            try:
+                # Add the crawl information from remote storage.
+                exact = self.s3.load_exact(crawls[0].source_id, crawls[0].data_version)
+                latest = None if exact else self.s3.load_latest(crawls[0].source_id, crawls[0].data_version)
+
+                best = self._select(crawls, exact, latest)
+                if dry_run:
+                    continue
+
+                # If the best crawl isn't archived, archive it. (The crawl from an earlier month is already archived.)
+                if self._commit(crawls, best) and self._allows(best) and not self.archive(best):
+                    # Evaluate the abandoned crawl again on the next run.
+                    self.cache.delete(best)
+            finally:
+                self._release(remote_directory)
+
+    def _groups(self, crawls):
         """
-        # Group the crawls by remote directory.
-        groups = defaultdict(list)
-        for crawl in Crawl.all(self.data_directory, self.logs_directory):
+        Yields the crawls to consider, grouped by remote directory, as soon as each group is complete, so that archival
+        starts before all crawl directories are read, and only one group is held in memory at a time.
+
+        :param crawls: crawls, ordered by source and data version (see :meth:`ocdskingfisherarchive.crawl.Crawl.all`)
+        """
+        group = []
+        for crawl in metrics.iterate('crawl.all', crawls):
+            if not self.shard.owns(crawl.source_id):
+                continue
+
+            metrics.increment('crawls')
             crawl = self.cache.get(crawl)
 
             if crawl.reject_reason:
                 # Save the decision to reject the crawl.
                 logger.info('Ignoring %s (%s)', crawl, crawl.reject_reason)
+                metrics.increment('crawls_rejected')
                 crawl.archived = False
                 self.cache.set(crawl)
             elif crawl.archived is False:
                 logger.info('Ignoring %s', crawl)
             else:
-                groups[crawl.remote_directory].append(crawl)
-
-        for remote_directory, crawls in groups.items():
-            # Add the crawl information from remote storage.
-            remote = self.s3.load_exact(crawl.source_id, crawl.data_version)
-            if remote:
-                crawls.append(remote)
-
-            crawls.sort(key=lambda crawl: crawl.data_version)
-
-            # Consider each crawl in chronological order.
-            best = crawls[0]
-            pool = crawls[1:]
-
-            # If no crawl is yet archived for this month, get the most recent earlier crawl.
-            if not remote:
-                remote = self.s3.load_latest(crawl.source_id, crawl.data_version)
-                if remote:
-                    best = remote
-                    pool = crawls
-
-            logger.info('%s initial (%r)', crawl, crawl.asdict())
-
-            # Find the best crawl to archive.
-            for crawl in pool:
-                decision, reason = crawl.compare(best)
-                if decision:
-                    best = crawl
-                logger.info('%s %s %s (%r)', crawl, '+' if decision else '-', reason, crawl.asdict())
-
-            logger.info('%s final', best)
-            if dry_run:
-                continue
+                if group and group[0].remote_directory != crawl.remote_directory:
+                    yield group
+                    group = []
+                group.append(crawl)
+
+        if group:
+            yield group
+
+    async def _run_async(self, ordered, dry_run):
+        loop = asyncio.get_event_loop()
+
+        async def lookup(crawls):
+            # Acquire the lease before looking up the remote crawls, so that they don't change until it's released.
+            if not dry_run and not await self.async_s3.run(self._acquire, crawls[0].remote_directory):
+                return None
+            exact = await self.async_s3.load_exact(crawls[0].source_id, crawls[0].data_version)
+            latest = None if exact else await self.async_s3.load_latest(crawls[0].source_id, crawls[0].data_version)
+            return exact, latest
+
+        # Look up the crawl information from remote storage for up to LOOKAHEAD groups at once, ahead of their
+        # evaluation. The groups are read in a thread, because reading a group can read log files and the cache.
+        async def lookups():
+            iterator = iter(ordered)
+            pending = deque()
+            while True:
+                while len(pending) < LOOKAHEAD:
+                    crawls = await loop.run_in_executor(None, next, iterator, None)
+                    if crawls is None:
+                        break
+                    pending.append((crawls, asyncio.ensure_future(lookup(crawls))))
+                if not pending:
+                    return
+                crawls, task = pending.popleft()
+                try:
+                    yield crawls, await task
+                except GeneratorExit:
+                    # The run stopped early. Wait for the remaining lookups, whose leases are released by run().
+                    await asyncio.gather(*(task for _, task in pending))
+                    raise
+
+        # Compressed crawls waiting to be uploaded. The producer evaluates and compresses crawls, while the consumer
+        # uploads them, so that the CPU and the network are both busy.
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        # The number of crawls that are compressed but not yet uploaded, and a condition to notify when it decreases.
+        state = {'pending': 0}
+        condition = asyncio.Condition()
+
+        async def prepare(crawls, exact, latest):
+            best = await loop.run_in_executor(None, self._select, crawls, exact, latest)
+            if dry_run or not self._commit(crawls, best):
+                return None
+
+            # Wait for uploads to finish, if the temporary directory hasn't enough space to compress the crawl.
+            async with condition:
+                while state['pending'] and not self._has_space(best):
+                    logger.info('Waiting for space to compress %s', best)
+                    await condition.wait()
+
+            if not self._allows(best):
+                return None
+
+            try:
+                archival = await loop.run_in_executor(None, self._start, best)
+            except Exception:
+                logger.exception('Failed to compress %s', best)
+                return None
+
+            return best, archival
+
+        async def produce():
+            groups = lookups()
+            try:
+                async for crawls, remote in groups:
+                    if self.scheduler.expired():
+                        break
+                    # Another worker holds the lease.
+                    if remote is None:
+                        continue
+
+                    item = await prepare(crawls, *remote)
+                    if item is None:
+                        await self.async_s3.run(self._release, crawls[0].remote_directory)
+                        continue
+
+                    state['pending'] += 1
+                    await queue.put(item)
+            finally:
+                await groups.aclose()
+
+            await queue.put(None)
+
+        async def consume():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+
+                crawl, archival = item
+                try:
+                    if not await self._continue_async(crawl, archival):
+                        self.cache.delete(crawl)
+                except Exception:
+                    # The archival's state is recorded, so it is resumed on the next run.
+                    logger.exception('Failed to archive %s', crawl)
+                    metrics.increment('crawls_failed')
+                await self.async_s3.run(self._release, crawl.remote_directory)
+
+                async with condition:
+                    state['pending'] -= 1
+                    condition.notify_all()
+
+        await asyncio.gather(produce(), consume())
 
-            # Mark other crawls from this month as not archived. (The crawl from an earlier month is not included.)
-            if best in crawls:
-                crawls.remove(best)
-            for crawl in crawls:
-                # Keep the crawl for 90 days.
+    def _acquire(self, remote_directory):
+        """
+        Returns whether the lease on the remote directory is acquired, or whether leases are not used.
+        """
+        return self.leases is None or self.leases.acquire(remote_directory)
+
+    def _release(self, remote_directory):
+        """
+        Releases the lease on the remote directory, if held.
+        """
+        if self.leases:
+            self.leases.release(remote_directory)
+
+    def _allows(self, crawl):
+        """
+        Returns whether the temporary directory has enough space to compress the crawl, and whether the crawl is within
+        the run's budget.
+        """
+        if not self._has_space(crawl):
+            logger.warning('Skipping %s, because the temporary directory has insufficient space', crawl)
+            return False
+        return self.scheduler.schedule(crawl)
+
+    def _has_space(self, crawl):
+        """
+        Returns whether the temporary directory has enough space to compress the crawl, assuming no compression.
+        """
+        return shutil.disk_usage(tempfile.gettempdir()).free - self.reserved_space >= crawl.bytes
+
+    def _select(self, crawls, exact, latest):
+        """
+        Returns the best crawl to archive from a group of crawls with the same remote directory.
+
+        :param list crawls: the local crawls
+        :param exact: the crawl archived for the same month, if any
+        :param latest: the most recent crawl archived for an earlier month, if any (only used if ``exact`` is not set)
+        :returns: the best crawl
+        :rtype: ocdskingfisherarchive.crawl.Crawl
+        """
+        candidates = list(crawls)
+        if exact:
+            candidates.append(exact)
+
+        candidates.sort(key=lambda crawl: crawl.data_version)
+
+        # Consider each crawl in chronological order.
+        best = candidates[0]
+        pool = candidates[1:]
+
+        # If no crawl is yet archived for this month, use the most recent earlier crawl.
+        if not exact and latest:
+            best = latest
+            pool = candidates
+
+        logger.info('%s initial (%r)', best, best.asdict())
+
+        # Find the best crawl to archive.
+        for crawl in pool:
+            decision, reason = crawl.compare(best)
+            if decision:
+                best = crawl
+            logger.info('%s %s %s (%r)', crawl, '+' if decision else '-', reason, crawl.asdict())
+
+        logger.info('%s final', best)
+        return best
+
+    def _commit(self, crawls, best):
+        """
+        Saves the decision not to archive the local crawls other than the best crawl, and the evaluation of the best
+        crawl, if local.
+
+        :returns: whether the best crawl needs to be archived
+        :rtype: bool
+        """
+        for crawl in crawls:
+            if crawl is not best:
+                # Keep the crawl for the retention period (see expire()).
                 crawl.archived = False
-                self.cache.set(best)
+            self.cache.set(crawl)
 
-            # If the best crawl isn't archived, archive it. (The crawl from an earlier month is already archived.)
-            if not best.archived:
-                self.archive(best)
-                self.cache.delete(best)
+        return not best.archived
 
     def archive(self, crawl):
         """
@@ -102,29 +397,397 @@ class Archiver:
         -  The presence of a final directory indicates the crawl has already been archived. Therefore, we limit the
            risk of an incomplete upload using a staged process. (Leftover files indicate an incomplete upload.)
 
+        In direct mode, it instead uploads the files other than the metadata file to the final directory, then uploads
+        the metadata file, listing the ETag and size of the other files, to commit the archival. The metadata file is
+        uploaded only if no other process has written it since the archival started; otherwise, the archival is
+        abandoned. If the files in the final directory differ from those listed in the metadata file, a later archival
+        was interrupted, and the archive is treated as incomplete.
+
+        In content-addressed mode, the data file contains only the files whose contents are new relative to the
+        previously archived crawl for the same source, and a manifest file is also uploaded.
+
+        In bundle mode, the metadata, data and log files are written to one bundle, which is uploaded like a single
+        file (in direct mode, the bundle is itself the commit, unless it is too large to upload in one request). Once
+        the bundle is at its final key, any files archived as multiple files in the final directory are deleted.
+
         Finally, it deletes the created files, the crawl's data directory, and the crawl's log file.
+
+        The state of the archival is recorded in the cache after each step, so that an interrupted archival is resumed
+        by :meth:`resume`. The states are, in order: ``compressed``, ``uploaded``, ``copied`` and ``cleaned`` (or
+        ``compressed``, ``uploaded`` and ``committed``, in direct mode, or ``compressed``, ``committed`` and
+        ``cleaned``, in direct bundle mode). Once the local files are deleted, the state is deleted.
+
+        :returns: whether the crawl was archived
+        :rtype: bool
         """
-        meta_file_name = crawl.write_meta_data_file()
-        data_file_name = crawl.write_data_file()
+        return self._continue(crawl, self._start(crawl))
 
-        remote_directory = f'{crawl.source_id}/{crawl.data_version.year}/{crawl.data_version.month:02d}'
+    def resume(self):
+        """
+        Resumes interrupted archivals, then calls :meth:`sweep`.
+
+        If the temporary files of an interrupted archival were deleted before they were uploaded, the archival is
+        abandoned, and the crawl is evaluated again.
+        """
+        for archival in self.cache.get_archivals():
+            crawl = Crawl(archival['source_id'], archival['data_version'], self.data_directory, self.logs_directory)
+
+            uploading = archival['state'] in ('compressed', 'staged') or (
+                archival['protocol'] == 'direct' and archival['state'] == 'uploaded'
+            )
+            if uploading and not all(os.path.exists(local) for local in archival['files']):
+                logger.warning('Abandoning %s (missing temporary files)', crawl)
+                self._abandon(crawl, archival)
+                continue
+
+            if not self._acquire(crawl.remote_directory):
+                continue
+
+            try:
+                logger.info('Resuming %s (%s)', crawl, archival['state'])
+                if not self._continue(crawl, archival):
+                    self.cache.delete(crawl)
+            finally:
+                self._release(crawl.remote_directory)
 
-        files = {
-            meta_file_name: f'{remote_directory}/metadata.json',
-            data_file_name: f'{remote_directory}/data.tar.lz4',
-            crawl.scrapy_log_file.name: f'{remote_directory}/scrapy.log',
+        self.sweep()
+
+    def expire(self):
+        """
+        Deletes the crawl directories and log files of crawls that were not archived (because they were rejected, or
+        because another crawl was archived for the same source and month), once the retention period has passed since
+        they were first evaluated.
+        """
+        if self.retention_seconds is None:
+            return
+
+        for source_id, data_version in self.cache.get_expired(self.retention_seconds):
+            if not self.shard.owns(source_id):
+                continue
+
+            crawl = Crawl(source_id, data_version, self.data_directory, self.logs_directory)
+            if os.path.isdir(crawl.local_directory):
+                logger.info('Deleting %s, which was not archived, after the retention period', crawl)
+                if crawl.scrapy_log_file:
+                    crawl.scrapy_log_file.delete()
+                self.reclaimer.delete(crawl.local_directory)
+                metrics.increment('crawls_expired')
+            self.cache.set_deleted(crawl)
+
+    def sweep(self):
+        """
+        Aborts the multipart uploads, and deletes the files in the staging directory, that no archival in progress
+        references, and that are older than the lease duration, so that another host's archival in progress into the
+        same bucket is left alone.
+
+        If sources are partitioned across workers, only this worker's sources are swept. If leases are used, a remote
+        directory is swept only if its lease is acquired.
+        """
+        # Whether each remote directory can be swept.
+        sweepable = {}
+
+        def can_sweep(key):
+            remote_file_name = key[len('staging/'):] if key.startswith('staging/') else key
+            remote_directory = '/'.join(remote_file_name.split('/')[:3])
+            if remote_directory not in sweepable:
+                sweepable[remote_directory] = (
+                    self.shard.owns(remote_directory.split('/')[0]) and self._acquire(remote_directory)
+                )
+            return sweepable[remote_directory]
+
+        try:
+            self._sweep(can_sweep)
+        finally:
+            for remote_directory, acquired in sweepable.items():
+                if acquired:
+                    self._release(remote_directory)
+
+    def _sweep(self, can_sweep):
+        referenced = set()
+        for archival in self.cache.get_archivals():
+            for remote in archival['files'].values():
+                referenced.update((remote, f'staging/{remote}'))
+
+        uploads = self.cache.get_uploads()
+        for key in uploads:
+            if key not in referenced:
+                self.cache.delete_upload(key)
+
+        uploads = self.cache.get_uploads()
+        for key, upload_id in self.s3.list_uploads(self.lease_seconds):
+            if uploads.get(key) != upload_id and can_sweep(key):
+                logger.info('Aborting upload of %s', key)
+                self.s3.abort_upload(key, upload_id)
+
+        for key in self.s3.list_staging_files(self.lease_seconds):
+            if key not in referenced and can_sweep(key):
+                logger.info('Deleting %s', key)
+                self.s3.delete_file(key)
+
+    def _start(self, crawl):
+        """
+        Creates the crawl's files, and records the state of its archival.
+
+        :returns: the state of the archival
+        :rtype: dict
+        """
+        archival = {'state': 'compressed', 'protocol': 'direct' if self.direct else 'staging', 'etag': None}
+        if self.direct:
+            # Commit the archival only if the current metadata file (or bundle) is unchanged when the archival
+            # finishes.
+            name = BUNDLE_NAME if self.bundle else 'metadata.json'
+            current = self.s3.head(f'{crawl.remote_directory}/{name}')
+            archival['etag'] = current and current['etag']
+
+        archival['files'] = self._prepare(crawl)
+        self.cache.set_archival(crawl, archival)
+        return archival
+
+    def _steps(self, archival):
+        """
+        Returns the remaining steps of the archival, as tuples of a list of functions that can be called concurrently,
+        and the state once all the functions are called.
+        """
+        files = archival['files']
+
+        if any(remote.endswith(f'/{BUNDLE_NAME}') for remote in files.values()):
+            return self._bundle_steps(archival)
+
+        metadata = next(local for local, remote in files.items() if remote.endswith('/metadata.json'))
+        remote_directory = files[metadata].rsplit('/', 1)[0]
+
+        # If the month was archived in content-addressed mode, its manifest file is deleted once this archival is
+        # committed, as restores and audits read the manifest file, if any, instead of the data file.
+        stale = []
+        if not any(remote.endswith('/manifest.json') for remote in files.values()):
+            stale.append(partial(self.s3.delete_file, f'{remote_directory}/manifest.json'))
+
+        # The metadata file is uploaded last, with the checksums of the other files (see S3.upload_file_to_staging()).
+        if archival['protocol'] == 'direct':
+            steps = [
+                ([partial(self._upload, archival, self.s3.upload_file, local, remote)
+                  for local, remote in files.items() if local != metadata], 'uploaded'),
+                ([partial(self._commit_metadata, archival, metadata)], 'committed'),
+                (stale, 'cleaned'),
+            ]
+        else:
+            steps = [
+                ([partial(self._upload, archival, self.s3.upload_file_to_staging, local, remote)
+                  for local, remote in files.items() if local != metadata], 'staged'),
+                ([partial(self._upload_metadata, archival, metadata)], 'uploaded'),
+                ([partial(self.s3.move_file_from_staging_to_real, remote) for remote in files.values()], 'copied'),
+                ([partial(self.s3.remove_staging_file, remote) for remote in files.values()] + stale, 'cleaned'),
+            ]
+
+        states = ['compressed'] + [state for _, state in steps]
+        return steps[states.index(archival['state']):]
+
+    def _bundle_steps(self, archival):
+        """
+        Returns the remaining steps of the archival of a bundle, like :meth:`_steps`.
+        """
+        (local, remote), = archival['files'].items()
+        remote_directory = remote.rsplit('/', 1)[0]
+
+        if archival['protocol'] == 'direct':
+            steps = [
+                ([partial(self._commit_file, archival, local)], 'committed'),
+                ([partial(self.s3.delete_legacy_files, remote_directory)], 'cleaned'),
+            ]
+        else:
+            steps = [
+                ([partial(self._upload, archival, self.s3.upload_file_to_staging, local, remote)], 'uploaded'),
+                ([partial(self.s3.move_file_from_staging_to_real, remote)], 'copied'),
+                ([partial(self.s3.remove_staging_file, remote),
+                  partial(self.s3.delete_legacy_files, remote_directory)], 'cleaned'),
+            ]
+
+        states = ['compressed'] + [state for _, state in steps]
+        return steps[states.index(archival['state']):]
+
+    def _upload(self, archival, function, local, remote):
+        """
+        Uploads a file, and records its checksum, which is saved with the archival's state once the step is completed.
+        """
+        checksum = function(local, remote, journal=self.cache)
+        archival.setdefault('checksums', {})[remote] = checksum
+
+    def _upload_metadata(self, archival, metadata):
+        """
+        Adds the checksums of the other files to the metadata file, and uploads it to the staging directory.
+        """
+        self._update_metadata(archival, metadata)
+        self._upload(archival, self.s3.upload_file_to_staging, metadata, archival['files'][metadata])
+
+    def _commit_metadata(self, archival, metadata):
+        """
+        Adds the checksums, ETag and size of the other files to the metadata file, and uploads it if its ETag is
+        unchanged.
+        """
+        objects = {}
+        for local, remote in archival['files'].items():
+            if local != metadata:
+                objects[remote.rsplit('/', 1)[1]] = self.s3.head(remote)
+
+        self._update_metadata(archival, metadata, objects=objects)
+        self._commit_file(archival, metadata)
+
+    def _commit_file(self, archival, local):
+        """
+        Uploads a file to its final key, if the ETag of the current file is unchanged since the archival started, and
+        records its checksum, like :meth:`_upload`.
+        """
+        remote = archival['files'][local]
+        archival.setdefault('checksums', {})[remote] = self.s3.commit_file(local, remote, archival['etag'])
+
+    def _update_metadata(self, archival, metadata, **values):
+        with open(metadata) as f:
+            data = json.load(f)
+        data['checksums'] = {
+            remote.rsplit('/', 1)[1]: checksum
+            for remote, checksum in archival.get('checksums', {}).items()
+            if checksum and remote != archival['files'][metadata]
         }
+        data.update(values)
+        with open(metadata, 'w') as f:
+            json.dump(data, f, indent=2)
 
-        for local, remote in files.items():
-            self.s3.upload_file_to_staging(local, remote)
-        for remote in files.values():
-            self.s3.move_file_from_staging_to_real(remote)
-        for remote in files.values():
-            self.s3.remove_staging_file(remote)
+    def _continue(self, crawl, archival):
+        """
+        Performs the remaining steps of the archival of the crawl, recording each completed step.
+
+        :returns: whether the crawl was archived
+        :rtype: bool
+        """
+        try:
+            for functions, state in self._steps(archival):
+                for function in functions:
+                    function()
+                self._advance(crawl, archival, state)
+        except ConcurrentArchivalError as e:
+            logger.warning('Abandoning %s (%s)', crawl, e)
+            self._abandon(crawl, archival)
+            return False
+
+        self._finalize(crawl, archival['files'])
+        return True
+
+    async def _continue_async(self, crawl, archival):
+        """
+        Performs the steps like :meth:`_continue`, but calls the functions of each step concurrently.
+        """
+        try:
+            for functions, state in self._steps(archival):
+                await asyncio.gather(*(self.async_s3.run(function) for function in functions))
+                self._advance(crawl, archival, state)
+        except ConcurrentArchivalError as e:
+            logger.warning('Abandoning %s (%s)', crawl, e)
+            self._abandon(crawl, archival)
+            return False
+
+        await asyncio.get_event_loop().run_in_executor(None, self._finalize, crawl, archival['files'])
+        return True
+
+    def _advance(self, crawl, archival, state):
+        archival['state'] = state
+        self.cache.set_archival(crawl, archival)
+
+    def _abandon(self, crawl, archival):
+        self._delete_files(archival['files'])
+        self.cache.delete_archival(crawl)
+        metrics.increment('crawls_abandoned')
+
+    def _prepare(self, crawl):
+        """
+        Creates the crawl's data and metadata files (and manifest file, in content-addressed mode).
+
+        :returns: the remote path of each file to upload, keyed by its local path
+        :rtype: dict
+        """
+        remote_directory = f'{crawl.source_id}/{crawl.data_version.year}/{crawl.data_version.month:02d}'
+
+        meta_file_name = crawl.write_meta_data_file()
+        try:
+            return self._prepare_data(crawl, remote_directory, meta_file_name)
+        except Exception:
+            os.unlink(meta_file_name)
+            raise
+
+    def _prepare_data(self, crawl, remote_directory, meta_file_name):
+        if self.deduplicate:
+            previous = self.s3.load_manifest(crawl.source_id, crawl.data_version)
+            manifest, names = Manifest.build(crawl, previous)
+            logger.info('%s has %d new files of %d (base: %s)', crawl, len(names), len(manifest.files), manifest.base)
+
+            manifest_file_name = manifest.write_file()
+            try:
+                data_file_name = crawl.write_data_file(names)
+            except Exception:
+                os.unlink(manifest_file_name)
+                raise
+
+            files = {
+                meta_file_name: f'{remote_directory}/metadata.json',
+                manifest_file_name: f'{remote_directory}/manifest.json',
+                data_file_name: f'{remote_directory}/{Manifest.archive_name(crawl)}',
+                crawl.scrapy_log_file.name: f'{remote_directory}/scrapy.log',
+            }
+        elif self.bundle:
+            data_file_name = crawl.write_data_file()
+            try:
+                with open(meta_file_name) as f:
+                    metadata = json.load(f)
+                bundle_file_name = Bundle.write_file(metadata, {
+                    'scrapy.log': crawl.scrapy_log_file.name,
+                    'data.tar.lz4': data_file_name,
+                })
+            finally:
+                os.unlink(data_file_name)
+            os.unlink(meta_file_name)
+
+            files = {
+                bundle_file_name: f'{remote_directory}/{BUNDLE_NAME}',
+            }
+        else:
+            data_file_name = crawl.write_data_file()
 
-        os.unlink(meta_file_name)
-        os.unlink(data_file_name)
-        shutil.rmtree(crawl.local_directory)
-        crawl.scrapy_log_file.delete()
+            files = {
+                meta_file_name: f'{remote_directory}/metadata.json',
+                data_file_name: f'{remote_directory}/data.tar.lz4',
+                crawl.scrapy_log_file.name: f'{remote_directory}/scrapy.log',
+            }
+
+        return files
+
+    def _finalize(self, crawl, files):
+        """
+        Records the archival, then deletes the created files, the crawl's data directory, the crawl's log file and the
+        archival's state.
+        """
+        compressed_bytes = sum(
+            os.path.getsize(local) for local, remote in files.items()
+            if not remote.endswith(('/metadata.json', '/manifest.json', '/scrapy.log')) and os.path.exists(local)
+        )
+        self.cache.set_archived(crawl, compressed_bytes)
+
+        self._delete_files(files)
+        if os.path.isdir(crawl.local_directory):
+            self.reclaimer.delete(crawl.local_directory)
+        for local, remote in files.items():
+            if remote.endswith('/scrapy.log'):
+                ScrapyLogFile(local).delete()
+            elif remote.endswith(f'/{BUNDLE_NAME}') and crawl.scrapy_log_file:
+                # The bundle contains a copy of the log file.
+                crawl.scrapy_log_file.delete()
+        self.cache.delete_archival(crawl)
 
         logger.info('Archived %s', crawl)
+        metrics.increment('crawls_archived')
+
+    def _delete_files(self, files):
+        """
+        Deletes the files created by :meth:`_prepare`.
+        """
+        for local, remote in files.items():
+            if not remote.endswith('/scrapy.log') and os.path.exists(local):
+                os.unlink(local)
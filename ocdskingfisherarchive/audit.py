@@ -0,0 +1,274 @@
+import hashlib
+import logging
+import random
+import tarfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+
+from lz4.frame import LZ4FrameFile
+from xxhash import xxh3_128
+
+from ocdskingfisherarchive.bundle import BUNDLE_NAME
+from ocdskingfisherarchive.exceptions import ArchiveNotFoundError
+from ocdskingfisherarchive.restore import _strip, _walk_key
+from ocdskingfisherarchive.storage import RANGE_SIZE
+from ocdskingfisherarchive.tarfile import LZ4TarFile
+
+logger = logging.getLogger('ocdskingfisher.archive')
+
+# The maximum number of bytes of members to hold in memory, while reading an archive's members in order.
+BUFFER_SIZE = 64 * 1024 * 1024  # 64MB
+
+# The results of an audit.
+OK = 'ok'
+# The checksum of the archive differs from the checksum in the metadata file.
+MISMATCH = 'mismatch'
+# The metadata file lists an object that differs from the object in the bucket.
+INCOMPLETE = 'incomplete'
+# An archive referenced by the metadata file or manifest doesn't exist.
+MISSING = 'missing'
+# An archive can't be decompressed or read.
+CORRUPT = 'corrupt'
+# The metadata file has no checksum.
+UNVERIFIABLE = 'unverifiable'
+
+
+class Auditor:
+    """
+    Verifies that archived crawls match the checksums in their metadata files.
+
+    Each archive is downloaded using concurrent ranged requests, and decompressed and read as a stream, without writing
+    to disk. The checksum is calculated over the archive's members in the order in which
+    :attr:`ocdskingfisherarchive.crawl.Crawl.checksum` is calculated, which is the order in which
+    :meth:`ocdskingfisherarchive.crawl.Crawl.write_data_file` writes them. If the members are in a different order
+    (for example, in archives written by earlier versions), the archive is read again, buffering members in memory up
+    to a limit (see :func:`checksum`).
+
+    If a crawl was archived in content-addressed mode, its checksum can't be calculated without buffering members
+    across archives. Instead, the checksum of each member is verified against the checksums in its manifest.
+
+    If a crawl was archived in a bundle, the MD5 digest of each of the bundle's members is also verified against the
+    digests in its index (see :func:`verify_bundle`).
+
+    The result of each audit is recorded in the SQLite database, with the ETag of the metadata file (or bundle), so
+    that an interrupted audit can be resumed, and an archived crawl is audited again only if it is archived again.
+    """
+
+    def __init__(self, s3, cache, jobs=4, concurrency=4, range_size=RANGE_SIZE):
+        """
+        :param s3: an instance of a subclass of the :class:`~ocdskingfisherarchive.storage.Storage` class
+        :param cache: an instance of the :class:`~ocdskingfisherarchive.cache.Cache` class
+        :param int jobs: the maximum number of archived crawls to audit at once
+        :param int concurrency: the maximum number of concurrent ranged requests per archive
+        :param int range_size: the size of each ranged request
+        """
+        self.s3 = s3
+        self.cache = cache
+        self.jobs = jobs
+        self.concurrency = concurrency
+        self.range_size = range_size
+
+    def run(self, source_id=None, sample=None, seed=None, force=False):
+        """
+        Audits the archived crawls that were not yet audited.
+
+        :param str source_id: audit only this source's archived crawls
+        :param int sample: the number of archived crawls to audit, selected at random
+        :param seed: the seed of the random selection
+        :param bool force: whether to audit archived crawls again, if already audited
+        :returns: the status of each audited crawl, keyed by remote directory
+        :rtype: dict
+        """
+        archives = self.s3.list_archives(source_id)
+        audits = self.cache.get_audits()
+
+        remote_directories = [remote_directory for remote_directory, etag in archives.items()
+                              if force or audits.get(remote_directory, {}).get('etag') != etag]
+        if sample is not None and sample < len(remote_directories):
+            remote_directories = sorted(random.Random(seed).sample(remote_directories, sample))
+
+        logger.info('Auditing %d of %d archived crawls', len(remote_directories), len(archives))
+
+        results = {}
+        with ThreadPoolExecutor(self.jobs) as executor:
+            futures = {executor.submit(self.audit, remote_directory): remote_directory
+                       for remote_directory in remote_directories}
+            for future in as_completed(futures):
+                remote_directory = futures[future]
+                status, checksum = future.result()
+                # Record each result as soon as it is available, so that an interrupted audit can be resumed.
+                self.cache.set_audit(remote_directory, archives[remote_directory], status, checksum)
+                if status != OK:
+                    logger.warning('Audit of %s: %s', remote_directory, status)
+                results[remote_directory] = status
+        return results
+
+    def audit(self, remote_directory):
+        """
+        Audits an archived crawl.
+
+        :param str remote_directory: a remote directory, like "source_id/2020/01"
+        :returns: the status, and the checksum calculated from the archive, if any
+        :rtype: tuple
+        """
+        source_id, year, month = remote_directory.split('/')
+        crawl = self.s3.load(source_id, int(year), int(month))
+        if not crawl:
+            return INCOMPLETE, None
+
+        kwargs = {'concurrency': self.concurrency, 'range_size': self.range_size}
+        try:
+            manifest = self.s3.get_manifest(remote_directory)
+            if manifest:
+                return (OK if verify_manifest(self.s3, manifest, **kwargs) else MISMATCH), None
+
+            expected = crawl.asdict()['checksum']
+            if expected is None:
+                return UNVERIFIABLE, None
+
+            key, offset, size = self.s3.locate(remote_directory, 'data.tar.lz4')
+            if key.endswith(f'/{BUNDLE_NAME}') and not verify_bundle(self.s3, remote_directory, **kwargs):
+                return MISMATCH, None
+
+            prefix = f'{source_id}/{crawl.format_data_version()}'
+            actual = checksum(self.s3, key, lambda name: _strip(name, prefix), offset=offset, size=size, **kwargs)
+        except ArchiveNotFoundError:
+            return MISSING, None
+        except (tarfile.TarError, RuntimeError, EOFError):
+            logger.exception('Failed to read the archive of %s', remote_directory)
+            return CORRUPT, None
+
+        return (OK if actual == expected else MISMATCH), actual
+
+
+def _members(s3, remote_file_name, concurrency=4, range_size=RANGE_SIZE, offset=0, size=None):
+    """
+    Yields the name and file object of each file in an archive, in the order in which they are stored.
+    """
+    stream = s3.open(remote_file_name, range_size=range_size, concurrency=concurrency, offset=offset, size=size)
+    if not stream:
+        raise ArchiveNotFoundError(f'No archive found: {remote_file_name}')
+
+    with stream, LZ4TarFile.open(fileobj=LZ4FrameFile(stream), mode='r|') as tar:
+        for tarinfo in tar:
+            if tarinfo.isfile():
+                with tar.extractfile(tarinfo) as f:
+                    yield tarinfo.name, f
+
+
+def _update(hasher, f):
+    for chunk in iter(partial(f.read, 65536), b''):  # 64KB
+        hasher.update(chunk)
+
+
+def checksum(s3, remote_file_name, names, buffer_size=BUFFER_SIZE, **kwargs):
+    """
+    Calculates the checksum of an archive's members, in the order in which
+    :attr:`ocdskingfisherarchive.crawl.Crawl.checksum` is calculated.
+
+    The archive is read once, if its members are in that order. Otherwise, it is read once to list its members, then
+    again to read its members in that order. Members that are read before their turn are held in memory, up to the
+    buffer size; if the buffer is full, the archive is read again, as many times as needed.
+
+    :param s3: an instance of a subclass of the :class:`~ocdskingfisherarchive.storage.Storage` class
+    :param str remote_file_name: the key of the archive
+    :param function names: a function that returns the paths (relative to the crawl directory) of a member, given its
+                           name
+    :param int buffer_size: the maximum number of bytes of members to hold in memory
+    :param kwargs: keyword arguments to :meth:`ocdskingfisherarchive.storage.Storage.open`
+    :returns: the checksum
+    :rtype: str
+    :raises ArchiveNotFoundError: if the archive doesn't exist
+    """
+    hasher = xxh3_128()
+    keys = []
+    for name, f in _members(s3, remote_file_name, **kwargs):
+        for path in names(name):
+            keys.append(_walk_key(path))
+            if hasher and len(keys) > 1 and keys[-1] <= keys[-2]:
+                hasher = None
+            if hasher:
+                _update(hasher, f)
+    if hasher:
+        return hasher.hexdigest()
+
+    hasher = xxh3_128()
+    positions = {key: position for position, key in enumerate(sorted(keys))}
+    # The content of members read before their turn, keyed by position.
+    buffered = {}
+    size = 0
+    index = 0
+    passes = 1
+    while index < len(positions):
+        passes += 1
+        for name, f in _members(s3, remote_file_name, **kwargs):
+            for path in names(name):
+                position = positions[_walk_key(path)]
+                if position == index:
+                    _update(hasher, f)
+                    index += 1
+                    while index in buffered:
+                        content = buffered.pop(index)
+                        hasher.update(content)
+                        size -= len(content)
+                        index += 1
+                elif position > index and position not in buffered:
+                    content = f.read(buffer_size - size + 1)
+                    if len(content) <= buffer_size - size:
+                        buffered[position] = content
+                        size += len(content)
+
+    logger.debug('Read %s %d times, to read its members in order', remote_file_name, passes)
+    return hasher.hexdigest()
+
+
+def verify_manifest(s3, manifest, **kwargs):
+    """
+    Verifies the checksum of each member of each archive referenced by a manifest.
+
+    :param s3: an instance of a subclass of the :class:`~ocdskingfisherarchive.storage.Storage` class
+    :param manifest: an instance of the :class:`~ocdskingfisherarchive.manifest.Manifest` class
+    :param kwargs: keyword arguments to :meth:`ocdskingfisherarchive.storage.Storage.open`
+    :returns: whether every member exists and matches the checksums in the manifest
+    :rtype: bool
+    :raises ArchiveNotFoundError: if an archive doesn't exist
+    """
+    for archive, members in manifest.archives().items():
+        remaining = set(members)
+        for name, f in _members(s3, archive, **kwargs):
+            if name not in members:
+                continue
+            hasher = xxh3_128()
+            _update(hasher, f)
+            digest = hasher.hexdigest()
+            if any(manifest.files[path]['digest'] != digest for path in members[name]):
+                return False
+            remaining.discard(name)
+        if remaining:
+            return False
+    return True
+
+
+def verify_bundle(s3, remote_directory, **kwargs):
+    """
+    Verifies the MD5 digest of each member of a bundle.
+
+    :param s3: an instance of a subclass of the :class:`~ocdskingfisherarchive.storage.Storage` class
+    :param str remote_directory: a remote directory, like "source_id/2020/01"
+    :param kwargs: keyword arguments to :meth:`ocdskingfisherarchive.storage.Storage.open`
+    :returns: whether every member matches the digests in the bundle's index
+    :rtype: bool
+    :raises ArchiveNotFoundError: if the bundle doesn't exist
+    """
+    bundle = s3.get_bundle(remote_directory)
+    if not bundle:
+        raise ArchiveNotFoundError(f'No archive found: {remote_directory}/{BUNDLE_NAME}')
+
+    for name, member in bundle.members.items():
+        offset, size = bundle.range(name)
+        hasher = hashlib.md5()
+        with s3.open(f'{remote_directory}/{BUNDLE_NAME}', offset=offset, size=size, **kwargs) as f:
+            _update(hasher, f)
+        if hasher.hexdigest() != member['md5']:
+            return False
+    return True
@@ -0,0 +1,137 @@
+import os
+import threading
+from contextlib import contextmanager
+
+# The default size of each block read from a file.
+BLOCK_SIZE = 1024 * 1024  # 1MB
+# The maximum number of free buffers of each size to keep for reuse.
+MAX_FREE = 8
+
+
+def _advise(f, advice):
+    # posix_fadvise() is not available on macOS or Windows. Advice is only a hint, so errors are ignored, for example,
+    # if the file object has no file descriptor.
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, getattr(os, advice))
+        except (OSError, ValueError):
+            pass
+
+
+class BufferPool:
+    """
+    Reads files in large blocks into reusable buffers, to calculate checksums, write archives and upload files.
+
+    Blocks are read with ``readinto()`` into a ``bytearray`` from the pool, and yielded as ``memoryview`` slices, so
+    that no ``bytes`` object is allocated per block. Files are opened with ``posix_fadvise()`` advice for sequential
+    reads, and, once read, their pages are dropped from the page cache, so that archiving a crawl doesn't evict the
+    files that Kingfisher Collect is reading and writing.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Free buffers, keyed by size.
+        self.free = {}
+        self.configure()
+
+    def configure(self, block_size=BLOCK_SIZE, drop_cache=True):
+        """
+        :param int block_size: the size of each block read from a file
+        :param bool drop_cache: whether to drop a file's pages from the page cache, once it is read
+        """
+        with self.lock:
+            self.free.clear()
+        self.block_size = block_size
+        self.drop_cache = drop_cache
+
+    @contextmanager
+    def buffer(self, size=None):
+        """
+        Yields a buffer from the pool, and returns it to the pool on exit.
+
+        :param int size: the size of the buffer (defaults to the block size)
+        :rtype: bytearray
+        """
+        size = size or self.block_size
+        with self.lock:
+            free = self.free.get(size)
+            buffer = free.pop() if free else None
+        if buffer is None:
+            buffer = bytearray(size)
+        try:
+            yield buffer
+        finally:
+            with self.lock:
+                free = self.free.setdefault(size, [])
+                if len(free) < MAX_FREE:
+                    free.append(buffer)
+
+    @contextmanager
+    def open(self, path):
+        """
+        Opens a file for sequential reading, without buffering, and drops its pages from the page cache on exit (see
+        :meth:`configure`).
+
+        :param str path: the path to the file
+        """
+        with open(path, 'rb', buffering=0) as f:
+            self.advise(f)
+            try:
+                yield f
+            finally:
+                self.release(f)
+
+    def read_blocks(self, f, size=None):
+        """
+        Yields the blocks of a file object, as ``memoryview`` slices of a buffer from the pool.
+
+        A block is valid only until the next block is yielded, because the buffer is reused. Copy it with ``bytes()``
+        to keep it.
+
+        :param f: a file object with a ``readinto()`` method
+        :param int size: the maximum number of bytes to read (defaults to the rest of the file)
+        """
+        with self.buffer() as buffer:
+            view = memoryview(buffer)
+            while size is None or size > 0:
+                count = f.readinto(view if size is None or size >= len(view) else view[:size])
+                if not count:
+                    break
+                if size is not None:
+                    size -= count
+                yield view[:count]
+
+    def readinto(self, f, buffer):
+        """
+        Reads from a file object until the buffer is full or the file ends. Unlike ``readinto()``, it doesn't return
+        a short count before the end of the file.
+
+        :param f: a file object with a ``readinto()`` method
+        :param buffer: a writable buffer
+        :returns: the number of bytes read
+        :rtype: int
+        """
+        total = 0
+        view = memoryview(buffer)
+        while total < len(view):
+            count = f.readinto(view[total:])
+            if not count:
+                break
+            total += count
+        return total
+
+    def advise(self, f):
+        """
+        Advises the kernel that an open file object will be read sequentially.
+        """
+        _advise(f, 'POSIX_FADV_SEQUENTIAL')
+
+    def release(self, f):
+        """
+        Drops the pages of an open file object from the page cache, if configured (see :meth:`configure`).
+        """
+        if self.drop_cache:
+            _advise(f, 'POSIX_FADV_DONTNEED')
+
+
+pool = BufferPool()
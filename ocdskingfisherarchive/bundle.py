@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+
+from ocdskingfisherarchive.buffers import pool
+
+# The name of a bundle, within a remote directory.
+BUNDLE_NAME = 'archive.bundle'
+# The names of the files of an archived crawl in the multi-file layout, which a bundle replaces.
+LEGACY_NAMES = ('metadata.json', 'manifest.json', 'data.tar.lz4', 'scrapy.log')
+# The first bytes of a bundle.
+MAGIC = b'KFBUNDLE'
+# The magic number, followed by the length of the index.
+PREFIX = struct.Struct('>8sQ')
+# The number of bytes to read to read a bundle's header, which is enough for the index of a typical bundle.
+HEADER_SIZE = 64 * 1024  # 64KB
+
+
+def _header(index):
+    data = json.dumps(index, sort_keys=True).encode()
+    return PREFIX.pack(MAGIC, len(data)) + data
+
+
+class Bundle:
+    """
+    A single file that holds an archived crawl's metadata, log file and data file, so that archiving a crawl uploads,
+    copies and deletes one object instead of three.
+
+    A bundle starts with a header: the magic number ``KFBUNDLE``, the length of the index as an 8-byte big-endian
+    integer, and the index as JSON. The index has the crawl's metadata (``metadata``), and the offset (relative to the
+    end of the header), size and MD5 digest of each member (``members``), keyed by name, like ``scrapy.log`` and
+    ``data.tar.lz4``. The members follow the header.
+
+    The metadata is read with one ranged request for the first :data:`HEADER_SIZE` bytes of the bundle.
+    """
+
+    def __init__(self, metadata, members, header_size):
+        """
+        :param dict metadata: the crawl's metadata
+        :param dict members: the offset, size and MD5 digest of each member, keyed by name
+        :param int header_size: the size of the header
+        """
+        self.metadata = metadata
+        self.members = members
+        self.header_size = header_size
+
+    @staticmethod
+    def get_header_size(data):
+        """
+        :param bytes data: the first bytes of a bundle, at least as many as the magic number and the index's length
+        :returns: the size of the header
+        :rtype: int
+        :raises ValueError: if the data is not the start of a bundle
+        """
+        if len(data) < PREFIX.size:
+            raise ValueError('Truncated bundle')
+        magic, length = PREFIX.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('Not a bundle')
+        return PREFIX.size + length
+
+    @classmethod
+    def from_header(cls, data):
+        """
+        :param bytes data: the first bytes of a bundle, at least as many as the header
+        :returns: the bundle's index
+        :rtype: ocdskingfisherarchive.bundle.Bundle
+        :raises ValueError: if the data is not the header of a bundle
+        """
+        header_size = cls.get_header_size(data)
+        if len(data) < header_size:
+            raise ValueError('Truncated bundle')
+        index = json.loads(data[PREFIX.size:header_size].decode())
+        return cls(index['metadata'], index['members'], header_size)
+
+    @classmethod
+    def write_file(cls, metadata, members):
+        """
+        Writes a bundle to a temporary file.
+
+        The MD5 digest of each member is calculated while it is written, and written to the header once all members
+        are written. A digest has the same length as its placeholder, so the header's length doesn't change.
+
+        :param dict metadata: the crawl's metadata
+        :param dict members: the path to each member, keyed by name, in order
+        :returns: the path to the file
+        :rtype: str
+        """
+        index = {'metadata': metadata, 'members': {}}
+        offset = 0
+        for name, path in members.items():
+            size = os.path.getsize(path)
+            index['members'][name] = {'offset': offset, 'size': size, 'md5': '0' * 32}
+            offset += size
+
+        file_descriptor, filename = tempfile.mkstemp(prefix='archive', suffix='.bundle')
+        try:
+            with open(file_descriptor, 'wb') as f:
+                header = _header(index)
+                f.write(header)
+                for name, path in members.items():
+                    member = index['members'][name]
+                    hasher = hashlib.md5()
+                    written = 0
+                    with pool.open(path) as source:
+                        for block in pool.read_blocks(source, member['size']):
+                            hasher.update(block)
+                            f.write(block)
+                            written += len(block)
+                    if written != member['size']:
+                        raise OSError(f'unexpected end of data: {path}')
+                    member['md5'] = hasher.hexdigest()
+
+                f.seek(0)
+                f.write(_header(index))
+        except Exception:
+            os.unlink(filename)
+            raise
+
+        return filename
+
+    def range(self, name):
+        """
+        :param str name: a member's name
+        :returns: the offset and size of the member within the bundle
+        :rtype: tuple
+        """
+        member = self.members[name]
+        return self.header_size + member['offset'], member['size']
@@ -1,11 +1,38 @@
+import datetime
+import json
 import sqlite3
+import threading
 
 from ocdskingfisherarchive.crawl import Crawl
+from ocdskingfisherarchive.metrics import metrics
+
+# Columns added after a table's creation, which are added to existing tables.
+MIGRATIONS = (
+    ('crawl', 'fingerprint', 'TEXT'),
+    ('archival', 'protocol', "TEXT NOT NULL DEFAULT 'staging'"),
+    ('archival', 'etag', 'TEXT'),
+    ('crawl', 'evaluated_at', 'TEXT'),
+    ('crawl', 'archived_at', 'TEXT'),
+    ('crawl', 'compressed_bytes', 'INTEGER'),
+    ('crawl', 'deleted_at', 'TEXT'),
+    ('upload_part', 'md5', 'TEXT'),
+    ('archival', 'checksums', 'TEXT'),
+)
+
+# Indexes for the queries of the report command.
+INDEXES = (
+    ('crawl', 'source_id'),
+    ('crawl', 'archived'),
+    ('crawl', 'reject_reason'),
+)
 
 
 class Cache:
     """
-    A cache of which crawl directories have been archived or skipped.
+    A cache of which crawl directories have been evaluated, archived or skipped.
+
+    It also records the state of each archival in progress, and the upload ID and completed parts of each multipart
+    upload in progress, so that interrupted archivals can be resumed. It can be used from multiple threads.
     """
 
     def __init__(self, filename, expired=False):
@@ -13,10 +40,11 @@ class Cache:
         :param str filename: the path to the SQLite database for caching the local state
         :param bool expired: whether to ignore and overwrite existing rows in the SQLite database
         """
-        self.conn = sqlite3.connect(filename)
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
         self.cursor = self.conn.cursor()
         self.expired = expired
+        self.lock = threading.RLock()
 
         self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'crawl'")
         if not self.cursor.fetchone():
@@ -36,6 +64,50 @@ class Cache:
             """)
             self.conn.commit()
 
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS archival (
+                id TEXT PRIMARY KEY NOT NULL,
+                source_id TEXT NOT NULL,
+                data_version TEXT NOT NULL,
+                state TEXT NOT NULL,
+                files TEXT NOT NULL,
+                protocol TEXT NOT NULL DEFAULT 'staging',
+                etag TEXT
+            )
+        """)
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS audit (
+                remote_directory TEXT PRIMARY KEY NOT NULL,
+                etag TEXT NOT NULL,
+                status TEXT NOT NULL,
+                checksum TEXT,
+                audited_at TEXT NOT NULL
+            )
+        """)
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS upload (
+                key TEXT PRIMARY KEY NOT NULL,
+                upload_id TEXT NOT NULL
+            )
+        """)
+        self.cursor.execute("""
+            CREATE TABLE IF NOT EXISTS upload_part (
+                upload_id TEXT NOT NULL,
+                part_number INTEGER NOT NULL,
+                etag TEXT NOT NULL,
+                PRIMARY KEY (upload_id, part_number)
+            )
+        """)
+
+        for table, column, declaration in MIGRATIONS:
+            self.cursor.execute(f'PRAGMA table_info({table})')
+            if column not in {row['name'] for row in self.cursor.fetchall()}:
+                self.cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+        for table, column in INDEXES:
+            self.cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_{column}_idx ON {table} ({column})')
+        self.conn.commit()
+
+    @metrics.timed('cache.read')
     def get(self, crawl):
         """
         :param crawl: an instance of the :class:`~ocdskingfisherarchive.crawl.Crawl` class
@@ -43,31 +115,34 @@ class Cache:
         :rtype: ocdskingfisherarchive.crawl.Crawl
         """
         if self.expired:
-            return
+            return crawl
 
-        self.cursor.execute("""
-            SELECT
-                source_id,
-                data_version,
-                bytes,
-                checksum,
-                files_count,
-                errors_count,
-                reject_reason,
-                archived
-            FROM crawl
-            WHERE id = :id
-        """, {'id': crawl.pk})
-        result = self.cursor.fetchone()
+        with self.lock:
+            result = self.conn.execute("""
+                SELECT
+                    source_id,
+                    data_version,
+                    bytes,
+                    checksum,
+                    files_count,
+                    errors_count,
+                    reject_reason,
+                    archived,
+                    fingerprint
+                FROM crawl
+                WHERE id = :id AND archived_at IS NULL
+            """, {'id': crawl.pk}).fetchone()
         if result:
-            return Crawl(**result)
+            return Crawl(data_directory=crawl.data_directory, logs_directory=crawl.logs_directory, **result)
         return crawl
 
     def set(self, crawl):
         """
+        Records the evaluation of the crawl. The time of the first evaluation is kept.
+
         :param crawl: an instance of the :class:`~ocdskingfisherarchive.crawl.Crawl` class
         """
-        self.cursor.execute("""
+        self._execute("""
             REPLACE INTO crawl (
                 id,
                 source_id,
@@ -77,7 +152,9 @@ class Cache:
                 files_count,
                 errors_count,
                 reject_reason,
-                archived
+                archived,
+                fingerprint,
+                evaluated_at
             ) VALUES (
                 :id,
                 :source_id,
@@ -87,14 +164,288 @@ class Cache:
                 :files_count,
                 :errors_count,
                 :reject_reason,
-                :archived
+                :archived,
+                :fingerprint,
+                COALESCE((SELECT evaluated_at FROM crawl WHERE id = :id), :now)
             )
-        """, crawl.asdict())
-        self.conn.commit()
+        """, dict(self._parameters(crawl), now=_now()))
+
+    def set_archived(self, crawl, compressed_bytes):
+        """
+        Records the archival of the crawl. The crawl is then ignored by :meth:`get`, like a crawl that was never
+        evaluated, but is included in reports.
+
+        :param crawl: an instance of the :class:`~ocdskingfisherarchive.crawl.Crawl` class
+        :param int compressed_bytes: the number of bytes of the crawl's compressed data files
+        """
+        parameters = {'id': crawl.pk, 'source_id': crawl.source_id, 'data_version': crawl.format_data_version(),
+                      'compressed_bytes': compressed_bytes, 'now': _now()}
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO crawl (id, source_id, data_version, evaluated_at) "
+                "VALUES (:id, :source_id, :data_version, :now)", parameters
+            )
+            self._execute(
+                "UPDATE crawl SET archived = 1, archived_at = :now, compressed_bytes = :compressed_bytes "
+                "WHERE id = :id", parameters
+            )
+
+    def get_expired(self, seconds):
+        """
+        Returns the crawls that were not archived (because they were rejected, or because another crawl was archived
+        for the same source and month), that were first evaluated more than the given number of seconds ago, and whose
+        crawl directories were not yet deleted.
+
+        Crawls that were evaluated before the time of evaluation was recorded are recorded as evaluated now.
+
+        :param float seconds: the retention period
+        :returns: the crawls, as (source_id, data_version) tuples
+        :rtype: list
+        """
+        with self.lock:
+            self.conn.execute(
+                "UPDATE crawl SET evaluated_at = :now WHERE evaluated_at IS NULL AND archived = 0", {'now': _now()}
+            )
+            self.conn.commit()
+            rows = self.conn.execute(
+                "SELECT source_id, data_version FROM crawl "
+                "WHERE archived = 0 AND deleted_at IS NULL AND evaluated_at < :cutoff "
+                "ORDER BY source_id, data_version", {'cutoff': _now(-seconds)}
+            ).fetchall()
+        return [tuple(row) for row in rows]
+
+    def set_deleted(self, crawl):
+        """
+        Records the deletion of the crawl directory of a crawl that was not archived.
+
+        :param crawl: an instance of the :class:`~ocdskingfisherarchive.crawl.Crawl` class
+        """
+        self._execute("UPDATE crawl SET deleted_at = :now WHERE id = :id", {'id': crawl.pk, 'now': _now()})
+
+    def _parameters(self, crawl):
+        parameters = crawl.asdict()
+        if parameters['fingerprint'] is not None:
+            parameters['fingerprint'] = json.dumps(parameters['fingerprint'])
+        return parameters
 
     def delete(self, crawl):
         """
         :param crawl: an instance of the :class:`~ocdskingfisherarchive.crawl.Crawl` class
         """
-        self.cursor.execute("DELETE FROM crawl WHERE id = :id", {'id': crawl.pk})
-        self.conn.commit()
+        self._execute("DELETE FROM crawl WHERE id = :id", {'id': crawl.pk})
+
+    # Reports
+
+    @metrics.timed('cache.read')
+    def get_sources(self, source_id=None):
+        """
+        Returns, for each source, the number and bytes of crawls that are pending archival, archived, rejected or
+        ignored (because another crawl was archived for the same source and month), and the compressed bytes of
+        archived crawls.
+
+        :param str source_id: if set, report only this source
+        :returns: the totals, keyed by source ID
+        :rtype: dict
+        """
+        with self.lock:
+            rows = self.conn.execute(f"""
+                SELECT
+                    source_id,
+                    CASE
+                        WHEN archived_at IS NOT NULL OR archived = 1 THEN 'archived'
+                        WHEN reject_reason IS NOT NULL THEN 'rejected'
+                        WHEN archived = 0 THEN 'ignored'
+                        ELSE 'pending'
+                    END AS status,
+                    COUNT(*) AS crawls,
+                    COALESCE(SUM(bytes), 0) AS bytes,
+                    COALESCE(SUM(compressed_bytes), 0) AS compressed_bytes,
+                    MIN(evaluated_at) AS first_evaluated_at,
+                    MAX(archived_at) AS last_archived_at
+                FROM crawl
+                {'WHERE source_id = :source_id' if source_id else ''}
+                GROUP BY source_id, status
+                ORDER BY source_id
+            """, {'source_id': source_id}).fetchall()
+
+        sources = {}
+        for row in rows:
+            source = sources.setdefault(row['source_id'], {
+                'pending': {'crawls': 0, 'bytes': 0},
+                'archived': {'crawls': 0, 'bytes': 0, 'compressed_bytes': 0, 'last_archived_at': None},
+                'rejected': {'crawls': 0, 'bytes': 0},
+                'ignored': {'crawls': 0, 'bytes': 0},
+            })
+            totals = source[row['status']]
+            totals['crawls'] = row['crawls']
+            totals['bytes'] = row['bytes']
+            if row['status'] == 'archived':
+                totals['compressed_bytes'] = row['compressed_bytes']
+                totals['last_archived_at'] = row['last_archived_at']
+        return sources
+
+    @metrics.timed('cache.read')
+    def get_rejected(self, source_id=None):
+        """
+        :param str source_id: if set, report only this source
+        :returns: the rejected crawls, as dicts with ``source_id``, ``data_version``, ``reject_reason``, ``bytes`` and
+                  ``evaluated_at`` keys
+        :rtype: list
+        """
+        with self.lock:
+            rows = self.conn.execute(f"""
+                SELECT source_id, data_version, reject_reason, bytes, evaluated_at
+                FROM crawl
+                WHERE reject_reason IS NOT NULL AND archived_at IS NULL
+                {'AND source_id = :source_id' if source_id else ''}
+                ORDER BY source_id, data_version
+            """, {'source_id': source_id}).fetchall()
+        return [dict(row) for row in rows]
+
+    @metrics.timed('cache.read')
+    def get_crawls(self, source_id=None):
+        """
+        :param str source_id: if set, report only this source
+        :returns: the crawls that were not rejected, as dicts with ``source_id``, ``data_version``, ``bytes``,
+                  ``checksum``, ``files_count``, ``errors_count``, ``archived`` and ``fingerprint`` (a string of JSON)
+                  keys
+        :rtype: list
+        """
+        with self.lock:
+            rows = self.conn.execute(f"""
+                SELECT source_id, data_version, bytes, checksum, files_count, errors_count, archived, fingerprint
+                FROM crawl
+                WHERE reject_reason IS NULL
+                {'AND source_id = :source_id' if source_id else ''}
+                ORDER BY source_id, data_version
+            """, {'source_id': source_id}).fetchall()
+        return [dict(row) for row in rows]
+
+    # Archivals in progress
+
+    @metrics.timed('cache.read')
+    def get_archivals(self):
+        """
+        :returns: the archivals in progress, as dicts with ``source_id``, ``data_version``, ``state``, ``files``,
+                  ``protocol``, ``etag`` and ``checksums`` keys
+        :rtype: list
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT source_id, data_version, state, files, protocol, etag, checksums FROM archival"
+            ).fetchall()
+        return [dict(row, files=json.loads(row['files']), checksums=json.loads(row['checksums'] or '{}'))
+                for row in rows]
+
+    def set_archival(self, crawl, archival):
+        """
+        :param crawl: an instance of the :class:`~ocdskingfisherarchive.crawl.Crawl` class
+        :param dict archival: the ``state`` (the last completed step of the archival), the ``files`` (the remote path
+                              of each file to upload, keyed by its local path), the ``protocol``, the ``etag`` (the
+                              ETag of the metadata file, when the archival started) and the ``checksums`` of the
+                              uploaded files, keyed by remote path
+        """
+        self._execute(
+            "REPLACE INTO archival (id, source_id, data_version, state, files, protocol, etag, checksums) "
+            "VALUES (:id, :source_id, :data_version, :state, :files, :protocol, :etag, :checksums)",
+            {'id': crawl.pk, 'source_id': crawl.source_id, 'data_version': crawl.format_data_version(),
+             'state': archival['state'], 'files': json.dumps(archival['files']), 'protocol': archival['protocol'],
+             'etag': archival['etag'], 'checksums': json.dumps(archival.get('checksums', {}))},
+        )
+
+    def delete_archival(self, crawl):
+        """
+        :param crawl: an instance of the :class:`~ocdskingfisherarchive.crawl.Crawl` class
+        """
+        self._execute("DELETE FROM archival WHERE id = :id", {'id': crawl.pk})
+
+    # Audits of archived crawls
+
+    @metrics.timed('cache.read')
+    def get_audits(self):
+        """
+        :returns: the audits of archived crawls, as dicts with ``etag`` (the ETag of the metadata file, when audited),
+                  ``status``, ``checksum`` and ``audited_at`` keys, keyed by remote directory
+        :rtype: dict
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT remote_directory, etag, status, checksum, audited_at FROM audit ORDER BY remote_directory"
+            ).fetchall()
+        return {row['remote_directory']: dict(row) for row in rows}
+
+    def set_audit(self, remote_directory, etag, status, checksum=None):
+        """
+        :param str remote_directory: a remote directory, like "source_id/2020/01"
+        :param str etag: the ETag of the metadata file
+        :param str status: the result of the audit
+        :param str checksum: the checksum calculated from the archive, if any
+        """
+        self._execute(
+            "REPLACE INTO audit (remote_directory, etag, status, checksum, audited_at) "
+            "VALUES (:remote_directory, :etag, :status, :checksum, :now)",
+            {'remote_directory': remote_directory, 'etag': etag, 'status': status, 'checksum': checksum,
+             'now': _now()},
+        )
+
+    # Multipart uploads in progress
+
+    @metrics.timed('cache.read')
+    def get_uploads(self):
+        """
+        :returns: the upload ID of each multipart upload in progress, keyed by its key
+        :rtype: dict
+        """
+        with self.lock:
+            return dict(self.conn.execute("SELECT key, upload_id FROM upload").fetchall())
+
+    @metrics.timed('cache.read')
+    def get_upload(self, key):
+        """
+        :param str key: the key of the object being uploaded
+        :returns: the upload ID of the multipart upload in progress, if any
+        :rtype: str
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT upload_id FROM upload WHERE key = ?", (key,)).fetchone()
+        return row and row['upload_id']
+
+    def set_upload(self, key, upload_id):
+        self._execute("REPLACE INTO upload (key, upload_id) VALUES (?, ?)", (key, upload_id))
+
+    def delete_upload(self, key):
+        """
+        Deletes the multipart upload and its completed parts.
+        """
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM upload_part WHERE upload_id IN (SELECT upload_id FROM upload WHERE key = ?)", (key,)
+            )
+            self._execute("DELETE FROM upload WHERE key = ?", (key,))
+
+    @metrics.timed('cache.read')
+    def get_parts(self, upload_id):
+        """
+        :param str upload_id: the upload ID of a multipart upload
+        :returns: the ETag and MD5 digest of each completed part, as a tuple, keyed by its part number
+        :rtype: dict
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT part_number, etag, md5 FROM upload_part WHERE upload_id = ?",
+                                     (upload_id,)).fetchall()
+        return {row['part_number']: (row['etag'], row['md5']) for row in rows}
+
+    def set_part(self, upload_id, part_number, etag, md5=None):
+        self._execute("REPLACE INTO upload_part (upload_id, part_number, etag, md5) VALUES (?, ?, ?, ?)",
+                      (upload_id, part_number, etag, md5))
+
+    @metrics.timed('cache.write')
+    def _execute(self, sql, parameters):
+        with self.lock:
+            self.conn.execute(sql, parameters)
+            self.conn.commit()
+
+
+def _now(seconds=0):
+    now = datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+    return now.replace(microsecond=0).isoformat() + 'Z'
@@ -3,43 +3,61 @@ import json
 import os
 import tempfile
 import time
-from functools import partial
 
 from xxhash import xxh3_128
 
+from ocdskingfisherarchive.buffers import pool
 from ocdskingfisherarchive.exceptions import FutureDataVersionError, SourceMismatchError
+from ocdskingfisherarchive.metrics import metrics
 from ocdskingfisherarchive.scrapy_log_file import ScrapyLogFile
 from ocdskingfisherarchive.tarfile import LZ4TarFile
+from ocdskingfisherarchive.throttle import throttle
 
 DATA_VERSION_FORMAT = '%Y%m%d_%H%M%S'
 
+# The number of seconds after which a crawl directory to which no files have been written is archived.
+QUIET_PERIOD = 604800  # 7 * 24 * 60 * 60
+
+# The factors by which a crawl's bytes or files must exceed those of an earlier crawl in the same month, for it to be
+# preferred (see Crawl.compare()).
+BYTES_RATIO = 1.5
+FILES_RATIO = 1.5
+
+# The layers of a crawl's fingerprint, from least to most expensive to calculate.
+FINGERPRINT_LAYERS = ('files', 'bytes', 'manifest', 'sample')
+# The size of the blocks read from the start and end of each file, to calculate the "sample" layer of the fingerprint.
+FINGERPRINT_BLOCK_SIZE = 4096
+
 
 class Crawl:
     """
     A representation of a Kingfisher Collect crawl.
 
     Crawl information might be loaded from a :class:`local cache<ocdskingfisherarchive.cache.Cache>` or from
-    :class:`remote storage<ocdskingfisherarchive.s3.S3>`, or constructed from scratch.
+    :class:`remote storage<ocdskingfisherarchive.storage.Storage>`, or constructed from scratch.
     """
 
     @classmethod
     def all(cls, data_directory, logs_directory):
         """
         Yields a :class:`~ocdskingfisherarchive.crawl.Crawl` instance for each non-sample crawl directory to which no
-        files have been written in 7 days.
+        files have been written in 7 days, ordered by source and data version, so that crawls for the same source and
+        month are consecutive.
 
         :param str data_directory: Kingfisher Collect's FILES_STORE directory
         :param str logs_directory: Kingfisher Collect's project directory within Scrapyd's logs_dir directory
         """
-        seven_weeks_ago = time.time() - 604800  # 7 * 24 * 60 * 60
+        seven_weeks_ago = time.time() - QUIET_PERIOD
 
-        for source_id in os.scandir(data_directory):
+        for source_id in _sorted_scandir(data_directory):
             if not source_id.is_dir():
                 continue
-            if source_id.name.endswith('_sample'):
+            # Ignore sample crawls and hidden directories, like an old ``.reclaim`` directory.
+            if source_id.name.endswith('_sample') or source_id.name.startswith('.'):
                 continue
 
-            for data_version in os.scandir(source_id.path):
+            # Data versions sort chronologically.
+            for data_version in _sorted_scandir(source_id.path):
                 if not data_version.is_dir():
                     continue
                 parsed = cls.parse_data_version(data_version.name)
@@ -91,8 +109,13 @@ class Crawl:
         if isinstance(kwargs['archived'], int):
             kwargs['archived'] = bool(kwargs['archived'])
 
+        if isinstance(kwargs.get('fingerprint'), str):
+            kwargs['fingerprint'] = json.loads(kwargs['fingerprint'])
+
         self._values = kwargs
         self._scrapy_log_file = None
+        self._fingerprint = {}
+        self._digests = None
 
     def __str__(self):
         """
@@ -199,19 +222,50 @@ class Crawl:
         if 'checksum' in self._values:
             return self._values['checksum']
 
-        hasher = xxh3_128()
-        for root, dirs, files in os.walk(self.local_directory):
-            dirs.sort()
-            for file in sorted(files):
-                with open(os.path.join(root, file), 'rb') as f:
-                    # xxsum reads 64KB at a time (https://github.com/Cyan4973/xxHash/blob/dev/xxhsum.c). If the end of
-                    # a file could appear at the start of another file, we could add bytes for file boundaries.
-                    for chunk in iter(partial(f.read, 65536), b''):  # 64KB
-                        hasher.update(chunk)
-        self._values['checksum'] = hasher.hexdigest()
+        self._hash()
 
         return self._values['checksum']
 
+    @property
+    def digests(self):
+        """
+        Returns the checksum of each file in the crawl directory, using the same hash function as :attr:`checksum`.
+
+        If the checksum of the crawl directory isn't yet calculated, it is calculated in the same pass.
+
+        :returns: the checksum of each file, keyed by its path relative to the crawl directory, in alphabetical order
+        :rtype: dict
+        """
+        if self._digests is None:
+            self._hash(digests=True)
+
+        return self._digests
+
+    def _hash(self, digests=False):
+        hasher = None if 'checksum' in self._values else xxh3_128()
+        results = {}
+
+        with metrics.timer('crawl.checksum') as measurement:
+            for name, path in self._walk():
+                file_hasher = xxh3_128() if digests else None
+                with pool.open(path) as f:
+                    # The checksum doesn't depend on the block size. If the end of a file could appear at the start of
+                    # another file, we could add bytes for file boundaries.
+                    for block in pool.read_blocks(f):
+                        throttle.read(len(block))
+                        measurement['bytes'] += len(block)
+                        if hasher:
+                            hasher.update(block)
+                        if file_hasher:
+                            file_hasher.update(block)
+                if file_hasher:
+                    results[name] = file_hasher.hexdigest()
+
+        if hasher:
+            self._values['checksum'] = hasher.hexdigest()
+        if digests:
+            self._digests = results
+
     @property
     def bytes(self):
         """
@@ -221,11 +275,137 @@ class Crawl:
         if 'bytes' in self._values:
             return self._values['bytes']
 
-        self._values['bytes'] = sum(os.path.getsize(os.path.join(root, file))
-                                    for root, _, files in os.walk(self.local_directory) for file in files)
+        if 'bytes' in self._fingerprint:
+            self._values['bytes'] = self._fingerprint['bytes']
+        else:
+            with metrics.timer('crawl.bytes'):
+                self._values['bytes'] = sum(os.path.getsize(path) for _, path in self._walk())
 
         return self._values['bytes']
 
+    @property
+    def fingerprint(self):
+        """
+        Returns a fingerprint of all data in the crawl directory, which is cheaper to calculate than the checksum.
+
+        The fingerprint has layers, from least to most expensive to calculate:
+
+        -  ``files``: the number of files
+        -  ``bytes``: the total size in bytes of all files
+        -  ``manifest``: the checksum of the relative paths and sizes of all files, in alphabetical order
+        -  ``sample``: the checksum of the first and last blocks of all files, in alphabetical order
+
+        If any layer differs between two crawl directories, the crawl directories are distinct.
+
+        :returns: the fingerprint of all data in the crawl directory
+        :rtype: dict
+        """
+        if 'fingerprint' in self._values:
+            return self._values['fingerprint']
+
+        self._values['fingerprint'] = {layer: self._fingerprint_layer(layer) for layer in FINGERPRINT_LAYERS}
+
+        return self._values['fingerprint']
+
+    def _fingerprint_layer(self, layer):
+        if layer in self._fingerprint:
+            return self._fingerprint[layer]
+
+        with metrics.timer('crawl.fingerprint'):
+            self._calculate_fingerprint_layer(layer)
+
+        return self._fingerprint[layer]
+
+    def _calculate_fingerprint_layer(self, layer):
+        if layer == 'sample':
+            hasher = xxh3_128()
+            for _, path in self._walk():
+                with open(path, 'rb') as f:
+                    head = f.read(FINGERPRINT_BLOCK_SIZE)
+                    throttle.read(len(head))
+                    hasher.update(head)
+                    if len(head) == FINGERPRINT_BLOCK_SIZE:
+                        # Read the last block, or the remainder of the file if it is shorter than two blocks.
+                        f.seek(max(FINGERPRINT_BLOCK_SIZE, os.fstat(f.fileno()).st_size - FINGERPRINT_BLOCK_SIZE))
+                        tail = f.read(FINGERPRINT_BLOCK_SIZE)
+                        throttle.read(len(tail))
+                        hasher.update(tail)
+            self._fingerprint['sample'] = hasher.hexdigest()
+        else:
+            # The other layers are calculated from a single pass of `stat()` system calls.
+            files = 0
+            total = 0
+            hasher = xxh3_128()
+            for name, path in self._walk():
+                size = os.path.getsize(path)
+                files += 1
+                total += size
+                hasher.update(f'{name}\0{size}\n'.encode())
+            self._fingerprint.update({'files': files, 'bytes': total, 'manifest': hasher.hexdigest()})
+
+    def _distinct_fingerprint(self, other):
+        """
+        Returns whether any layer of this crawl's fingerprint differs from another crawl's fingerprint, calculating
+        only as many layers as necessary.
+
+        :returns: whether the crawl directories are distinct, or ``False`` if the other crawl has no fingerprint
+        :rtype: bool
+        """
+        # The other crawl is typically loaded from remote storage, in which case its fingerprint can't be calculated.
+        theirs = other._values.get('fingerprint')
+        if not theirs:
+            return False
+
+        ours = self._values.get('fingerprint')
+        for layer in FINGERPRINT_LAYERS:
+            if layer in theirs:
+                value = ours[layer] if ours else self._fingerprint_layer(layer)
+                if value != theirs[layer]:
+                    return True
+
+        return False
+
+    def _walk(self):
+        """
+        Yields the relative path and full path of each file in the crawl directory, in alphabetical order.
+        """
+        for name, entry in self._scan():
+            yield name, entry.path
+
+    def _scan(self, directories=False):
+        """
+        Yields the relative path and :class:`os.DirEntry` of each file in the crawl directory, in alphabetical order,
+        with a directory's files before its sub-directories' files, like :func:`os.walk`.
+
+        :param bool directories: whether to also yield each sub-directory, before its files
+        """
+        def scan(path, prefix):
+            try:
+                entries = _sorted_scandir(path)
+            except OSError:  # like os.walk(), ignore directories that can't be read
+                return
+
+            subdirectories = []
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    subdirectories.append(entry)
+                else:
+                    yield prefix + entry.name, entry
+
+            for entry in subdirectories:
+                # Like os.walk(), don't follow symbolic links to directories.
+                if entry.is_symlink():
+                    continue
+                if directories:
+                    yield prefix + entry.name, entry
+                yield from scan(entry.path, f'{prefix}{entry.name}{os.sep}')
+
+        return scan(self.local_directory, '')
+
     @property
     def archived(self):
         return self._values['archived']
@@ -252,6 +432,7 @@ class Crawl:
             'errors_count': getter('errors_count'),
             'reject_reason': getter('reject_reason'),
             'archived': getter('archived'),
+            'fingerprint': getter('fingerprint'),
         }
 
     def compare(self, other):
@@ -274,6 +455,11 @@ class Crawl:
         -  is less clean and less complete (in which case it might have been identical, if not for the errors)
         -  is not distinct (the checksums are identical)
 
+        If the earlier crawl has a fingerprint, and any layer of the fingerprints differs, the crawls are distinct, and
+        the checksum isn't calculated. The ``files`` and ``manifest`` layers depend on the number and names of files,
+        so crawls with identical content (and thus identical checksums) are distinct if their files were renamed or
+        split differently, and this crawl is then preferred.
+
         Otherwise, it is preferred.
 
         :returns: whether this crawl is preferred for archival, and the reason
@@ -284,20 +470,21 @@ class Crawl:
         if self.source_id != other.source_id:
             raise SourceMismatchError(f'Crawl source mismatch: {self.source_id} != {other.source_id}')
         # Crawls should only be compared in chronological order.
-        if other.data_version.year > self.data_version.year or other.data_version.month > self.data_version.month:
+        if (other.data_version.year, other.data_version.month) > (self.data_version.year, self.data_version.month):
             raise FutureDataVersionError(f'Future data version: {other.data_version} > {self.data_version}')
 
         # We run tests from least to most expensive, except where the logic requires otherwise:
         #
         # - Tests against Scrapy log files
         # - Counting bytes requires a ``stat()`` system call for each file
+        # - Calculating fingerprints requires reading at most two blocks of each file
         # - Calculating checksums requires reading each file
 
         if other.data_version.year == self.data_version.year and other.data_version.month == self.data_version.month:
             if self.bytes > other.bytes:
-                if self.bytes >= other.bytes * 1.5:
+                if self.bytes >= other.bytes * BYTES_RATIO:
                     return True, 'same_period_more_bytes'
-                if self.files_count >= other.files_count * 1.5:
+                if self.files_count >= other.files_count * FILES_RATIO:
                     return True, 'same_period_more_files'
                 if self.errors_count < other.errors_count:
                     return True, 'same_period_more_clean'
@@ -311,6 +498,8 @@ class Crawl:
                 and self.bytes <= other.bytes
             ):
                 return False, f'{other.data_version.year}_{other.data_version.month}_not_distinct_maybe'
+            if self._distinct_fingerprint(other):
+                return True, 'new_period'
             if other.checksum == self.checksum:
                 return False, f'{other.data_version.year}_{other.data_version.month}_not_distinct'
 
@@ -319,15 +508,43 @@ class Crawl:
     def write_meta_data_file(self):
         file_descriptor, filename = tempfile.mkstemp(prefix='archive', suffix='.json')
         with open(filename, 'w') as f:
-            json.dump(self.asdict(), f, indent=2)
+            # Later crawls are compared to this crawl using its metadata, so all values are calculated.
+            json.dump(self.asdict(cached=False), f, indent=2)
 
         os.close(file_descriptor)
         return filename
 
-    def write_data_file(self):
+    def write_data_file(self, names=None):
+        """
+        Writes the crawl directory to a temporary LZ4-compressed TAR file.
+
+        :param list names: if set, the paths (relative to the crawl directory) of the only files to write, whose member
+                           names are relative to the data directory
+        :returns: the path to the file
+        :rtype: str
+        """
         file_descriptor, filename = tempfile.mkstemp(prefix='archive', suffix='.tar.lz4')
-        with LZ4TarFile.open(filename, 'w:lz4') as tar:
-            tar.add(self.local_directory)
+        # The bytes are the compressed bytes written.
+        with metrics.timer('crawl.write_data_file') as measurement:
+            with LZ4TarFile.open(filename, 'w:lz4') as tar:
+                tar.on_read = throttle.read
+                # Members are written in the order in which the checksum is calculated, using the results of the
+                # directory walk (see LZ4TarFile.add_stat()).
+                if names is None:
+                    tar.add_stat(self.local_directory, os.stat(self.local_directory))
+                    for _, entry in self._scan(directories=True):
+                        tar.add_stat(entry.path, entry.stat())
+                else:
+                    prefix = f'{self.source_id}/{self.format_data_version()}'
+                    for name in names:
+                        path = os.path.join(self.local_directory, name)
+                        tar.add_stat(path, os.stat(path), f"{prefix}/{name.replace(os.sep, '/')}")
+            measurement['bytes'] = os.path.getsize(filename)
 
         os.close(file_descriptor)
         return filename
+
+
+def _sorted_scandir(path):
+    with os.scandir(path) as it:
+        return sorted(it, key=lambda entry: entry.name)
@@ -8,3 +8,15 @@ class SourceMismatchError(KingfisherArchiveError):
 
 class FutureDataVersionError(KingfisherArchiveError):
     """Raised if a future crawl is compared with a given crawl"""
+
+
+class ArchiveNotFoundError(KingfisherArchiveError):
+    """Raised if no archive exists for a given source and period"""
+
+
+class ConcurrentArchivalError(KingfisherArchiveError):
+    """Raised if another process archived a crawl for the same source and period during an archival"""
+
+
+class ChecksumMismatchError(KingfisherArchiveError):
+    """Raised if the checksum of a restored crawl differs from the checksum of the archived crawl"""
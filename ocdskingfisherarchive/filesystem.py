@@ -0,0 +1,268 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from urllib.parse import quote, unquote
+
+from ocdskingfisherarchive.buffers import pool
+from ocdskingfisherarchive.exceptions import ConcurrentArchivalError
+from ocdskingfisherarchive.metrics import metrics
+from ocdskingfisherarchive.storage import RANGE_SIZE, Storage
+from ocdskingfisherarchive.throttle import throttle
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# The directory, within the storage directory, of files being written.
+TEMPORARY_DIRECTORY = '.tmp'
+# The prefix of temporary files that are not listed by FileSystem.list_uploads().
+UNLISTED_PREFIX = '.'
+# The file, within the storage directory, that is locked during conditional writes and deletes.
+LOCK_FILE = '.lock'
+
+
+def _etag(stat):
+    # A file is only ever replaced by renaming a new file over it, so its inode, modification time and size change.
+    return f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+class FileSystem(Storage):
+    """
+    Stores archived crawls in a local directory, like a NAS mount, with the same layout as the Amazon S3 bucket.
+
+    A file is written to a temporary file in the ``.tmp`` directory, then renamed to its key, so that a file is never
+    partially written. A file is moved from the ``staging/`` directory to its final key by renaming it, which is
+    atomic.
+
+    ETags are derived from a file's inode, modification time and size. Conditional writes and deletes (see
+    :meth:`commit_file`, :meth:`put` and :meth:`delete_file`) hold an exclusive lock on the ``.lock`` file, so that
+    processes that share the directory, on POSIX systems, don't write concurrently.
+    """
+
+    def __init__(self, directory):
+        """
+        :param str directory: the directory in which to store archived crawls
+        """
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, *key.split('/'))
+
+    @contextmanager
+    def _locked(self):
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, LOCK_FILE), 'a') as f:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _write(self, key, listed=True):
+        """
+        Yields a temporary file, and renames it to the key on exit, unless an error occurred.
+
+        :param bool listed: whether :meth:`list_uploads` lists the temporary file
+        """
+        directory = os.path.join(self.directory, TEMPORARY_DIRECTORY)
+        os.makedirs(directory, exist_ok=True)
+        # The key is encoded in the temporary file's name, so that list_uploads() can return it.
+        prefix = f'{quote(key, safe="")}.' if listed else UNLISTED_PREFIX
+        fd, name = tempfile.mkstemp(prefix=prefix, dir=directory)
+        try:
+            with open(fd, 'wb') as f:
+                yield f
+                f.flush()
+                os.fsync(f.fileno())
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(name, path)
+        except BaseException:
+            os.unlink(name)
+            raise
+
+    def _check(self, key, etag):
+        current = self.head(key)
+        if (current and current['etag']) != etag:
+            condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+            raise ConcurrentArchivalError(f'{key} was written concurrently ({condition})')
+
+    def _copy(self, local_file_name, key):
+        # The checksum is the MD5 digest of the file, like the ETag of an object uploaded in a single request to Amazon
+        # S3, calculated from the blocks that are written, so the file is read once.
+        hasher = hashlib.md5()
+        with pool.open(local_file_name) as source, self._write(key) as f:
+            for block in pool.read_blocks(source):
+                throttle.upload(len(block))
+                hasher.update(block)
+                f.write(block)
+        return hasher.hexdigest()
+
+    def upload_file_to_staging(self, local_file_name, remote_file_name, journal=None):
+        """
+        Copies a file to the staging directory. An interrupted copy is restarted, so the journal is unused.
+
+        :returns: the MD5 digest of the file
+        :rtype: str
+        """
+        with metrics.timer('filesystem.upload', os.path.getsize(local_file_name)):
+            return self._copy(local_file_name, f'staging/{remote_file_name}')
+
+    def upload_file(self, local_file_name, remote_file_name, journal=None):
+        """
+        Copies a file to its final key, like :meth:`upload_file_to_staging`.
+        """
+        with metrics.timer('filesystem.upload', os.path.getsize(local_file_name)):
+            return self._copy(local_file_name, remote_file_name)
+
+    def commit_file(self, local_file_name, remote_file_name, etag=None):
+        with metrics.timer('filesystem.upload', os.path.getsize(local_file_name)), self._locked():
+            self._check(remote_file_name, etag)
+            return self._copy(local_file_name, remote_file_name)
+
+    @metrics.timed('filesystem.put')
+    def put(self, key, body, etag=None):
+        with self._locked():
+            self._check(key, etag)
+            # Small files, like leases, are not listed as uploads, like on Amazon S3.
+            with self._write(key, listed=False) as f:
+                f.write(body)
+            return self.head(key)['etag']
+
+    @metrics.timed('filesystem.get')
+    def get(self, key, size=None):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read(-1 if size is None else size), _etag(os.fstat(f.fileno()))
+        except FileNotFoundError:
+            return None
+
+    @metrics.timed('filesystem.head')
+    def head(self, remote_file_name):
+        try:
+            stat = os.stat(self._path(remote_file_name))
+        except FileNotFoundError:
+            return None
+        return {'etag': _etag(stat), 'size': stat.st_size}
+
+    def get_file(self, remote_file_name, suffix='.json'):
+        try:
+            with metrics.timer('filesystem.download') as measurement, open(self._path(remote_file_name), 'rb') as f:
+                with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as file:
+                    shutil.copyfileobj(f, file)
+                    measurement['bytes'] = file.tell()
+                    return file.name
+        except FileNotFoundError:
+            return None
+
+    def get_range(self, remote_file_name, start, end):
+        with metrics.timer('filesystem.download', end - start + 1), open(self._path(remote_file_name), 'rb') as f:
+            f.seek(start)
+            return f.read(end - start + 1)
+
+    def open(self, remote_file_name, range_size=RANGE_SIZE, concurrency=4, offset=0, size=None):
+        """
+        Opens a file for reading. Local files are read sequentially, so ``concurrency`` is unused, unless reading part
+        of a file, like a member of a bundle.
+        """
+        if offset or size is not None:
+            return super().open(remote_file_name, range_size, concurrency, offset, size)
+        try:
+            return open(self._path(remote_file_name), 'rb', buffering=range_size)
+        except FileNotFoundError:
+            return None
+
+    @metrics.timed('filesystem.move')
+    def move_file_from_staging_to_real(self, remote_file_name):
+        """
+        Renames a file from the staging directory to its final key. If the file is no longer in the staging directory,
+        and the file exists at its final key, the file was already moved.
+        """
+        path = self._path(remote_file_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.replace(self._path(f'staging/{remote_file_name}'), path)
+        except FileNotFoundError:
+            if not os.path.exists(path):
+                raise
+
+    @metrics.timed('filesystem.delete')
+    def remove_staging_file(self, remote_file_name):
+        self._remove(f'staging/{remote_file_name}')
+
+    @metrics.timed('filesystem.delete')
+    def delete_file(self, key, etag=None):
+        if etag:
+            with self._locked():
+                self._check(key, etag)
+                self._remove(key)
+        else:
+            self._remove(key)
+
+    def _remove(self, key):
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def list_uploads(self, seconds=0):
+        """
+        :param float seconds: list only the files last modified at least this many seconds ago
+        :returns: the files being written, or left over by interrupted writes, as (key, temporary file name) tuples
+        :rtype: list
+        """
+        directory = os.path.join(self.directory, TEMPORARY_DIRECTORY)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        before = time.time() - seconds
+        uploads = []
+        for name in sorted(names):
+            if name.startswith(UNLISTED_PREFIX):
+                continue
+            try:
+                if os.stat(os.path.join(directory, name)).st_mtime > before:
+                    continue
+            except FileNotFoundError:  # the write finished
+                continue
+            uploads.append((unquote(name.rsplit('.', 1)[0]), name))
+        return uploads
+
+    def abort_upload(self, key, upload_id):
+        """
+        Deletes a temporary file returned by :meth:`list_uploads`.
+        """
+        try:
+            os.unlink(os.path.join(self.directory, TEMPORARY_DIRECTORY, upload_id))
+        except FileNotFoundError:
+            pass
+
+    @metrics.timed('filesystem.list')
+    def _list(self, prefix):
+        # Walk only the deepest directory that contains the prefix.
+        top = self._path(prefix.rsplit('/', 1)[0]) if '/' in prefix else self.directory
+        contents = []
+        for root, dirs, files in os.walk(top):
+            if root == self.directory:
+                dirs[:] = [name for name in dirs if name != TEMPORARY_DIRECTORY]
+                files = [name for name in files if name != LOCK_FILE]
+            relative = os.path.relpath(root, self.directory)
+            for name in files:
+                key = name if relative == '.' else f'{relative.replace(os.sep, "/")}/{name}'
+                if key.startswith(prefix):
+                    stat = os.stat(os.path.join(root, name))
+                    contents.append({'Key': key, 'ETag': _etag(stat), 'Size': stat.st_size,
+                                     'LastModified': datetime.fromtimestamp(stat.st_mtime, timezone.utc)})
+        return sorted(contents, key=lambda c: c['Key'])
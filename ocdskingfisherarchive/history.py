@@ -0,0 +1,232 @@
+import itertools
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ocdskingfisherarchive.crawl import BYTES_RATIO, FILES_RATIO, Crawl
+
+# The columns of the history, other than the source. Unknown integers are -1.
+COLUMNS = ('data_version', 'month', 'bytes', 'files_count', 'errors_count', 'checksum', 'fingerprint', 'archived')
+
+
+class History:
+    """
+    The history of crawls, as one NumPy array per column, with one row per crawl, ordered by source and data version.
+
+    The ``source`` column is the index of the crawl's source in :attr:`sources`. The ``checksum`` column is an integer
+    that is equal for equal checksums, or -1 if the checksum is unknown, and likewise the ``fingerprint`` column for
+    fingerprints.
+    """
+
+    def __init__(self, sources, columns):
+        """
+        :param list sources: the source IDs
+        :param dict columns: the ``source`` column and :data:`COLUMNS`, as NumPy arrays of equal length
+        """
+        self.sources = sources
+        self.columns = columns
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        :param records: dicts with the keys of :meth:`ocdskingfisherarchive.crawl.Crawl.asdict`. If a crawl occurs
+                        more than once, its last record is used. A fingerprint can be a dict, or a string of JSON.
+        :returns: the history
+        :rtype: ocdskingfisherarchive.history.History
+        """
+        unique = {}
+        for record in records:
+            unique[(record['source_id'], record['data_version'])] = record
+        rows = [unique[key] for key in sorted(unique)]
+
+        sources = sorted({source_id for source_id, _ in unique})
+        source_index = {source_id: index for index, source_id in enumerate(sources)}
+        checksums = {}
+        fingerprints = {}
+
+        def integer(value):
+            return -1 if value is None else value
+
+        def code(checksum):
+            return -1 if checksum is None else checksums.setdefault(checksum, len(checksums))
+
+        def fingerprint_code(fingerprint):
+            if isinstance(fingerprint, str):
+                fingerprint = json.loads(fingerprint)
+            if not fingerprint:
+                return -1
+            return fingerprints.setdefault(json.dumps(fingerprint, sort_keys=True), len(fingerprints))
+
+        data_version = np.array([Crawl.parse_data_version(row['data_version']) for row in rows], dtype='datetime64[s]')
+        columns = {
+            'source': np.array([source_index[row['source_id']] for row in rows], dtype=np.int64),
+            'data_version': data_version,
+            'month': data_version.astype('datetime64[M]').astype(np.int64),
+            'bytes': np.array([integer(row['bytes']) for row in rows], dtype=np.int64),
+            'files_count': np.array([integer(row['files_count']) for row in rows], dtype=np.int64),
+            'errors_count': np.array([integer(row['errors_count']) for row in rows], dtype=np.int64),
+            'checksum': np.array([code(row['checksum']) for row in rows], dtype=np.int64),
+            'fingerprint': np.array([fingerprint_code(row.get('fingerprint')) for row in rows], dtype=np.int64),
+            'archived': np.array([bool(row['archived']) for row in rows], dtype=bool),
+        }
+        return cls(sources, columns)
+
+    @classmethod
+    def export(cls, cache=None, s3=None, source_id=None, jobs=8):
+        """
+        Exports the history of crawls that were not rejected from the SQLite database, and of archived crawls from the
+        metadata files in the bucket. If a crawl is in both, the values in its metadata file are used.
+
+        :param cache: an instance of the :class:`~ocdskingfisherarchive.cache.Cache` class
+        :param s3: an instance of a subclass of the :class:`~ocdskingfisherarchive.storage.Storage` class
+        :param str source_id: export only this source's crawls
+        :param int jobs: the maximum number of metadata files to download at once
+        :returns: the history
+        :rtype: ocdskingfisherarchive.history.History
+        """
+        records = []
+
+        if cache:
+            records.extend(cache.get_crawls(source_id))
+
+        if s3:
+            def load(remote_directory):
+                source_id, year, month = remote_directory.split('/')
+                return s3.load(source_id, int(year), int(month))
+
+            with ThreadPoolExecutor(jobs) as executor:
+                crawls = executor.map(load, s3.list_archives(source_id))
+                records.extend(crawl.asdict() for crawl in crawls if crawl)
+
+        return cls.from_records(records)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        :param str filename: a file written by :meth:`save`
+        :returns: the history
+        :rtype: ocdskingfisherarchive.history.History
+        """
+        with np.load(filename) as data:
+            sources = list(data['sources'])
+            columns = {key: data[key] for key in ('source',) + COLUMNS if key in data}
+        # Files written before fingerprints were exported have no fingerprint column.
+        columns.setdefault('fingerprint', np.full(len(columns['source']), -1, dtype=np.int64))
+        return cls(sources, columns)
+
+    def save(self, filename):
+        """
+        Writes the history to a compressed NumPy ``.npz`` file, with one array per column.
+
+        :param str filename: the file to write
+        """
+        np.savez_compressed(filename, sources=np.array(self.sources, dtype=str), **self.columns)
+
+    def __len__(self):
+        return len(self.columns['source'])
+
+
+def simulate(history, variants):
+    """
+    Replays the data retention policy of :meth:`ocdskingfisherarchive.crawl.Crawl.compare` over the history, once per
+    variant of its thresholds, as if every crawl had been archived in chronological order.
+
+    Each source's crawls are considered in chronological order, as in
+    :meth:`ocdskingfisherarchive.archive.Archiver._select`. The n-th crawls of all sources are compared at once, for
+    all variants at once, so the number of vectorized steps is the maximum number of crawls of a source.
+
+    As in :meth:`~ocdskingfisherarchive.crawl.Crawl.compare`, crawls in different months are distinct if both
+    fingerprints are known and differ, even if their checksums are equal (for example, if files were renamed);
+    otherwise, they are distinct if their checksums differ. If a crawl's checksum is unknown, it is treated as
+    distinct.
+
+    :param history: an instance of the :class:`~ocdskingfisherarchive.history.History` class
+    :param list variants: (bytes ratio, files ratio) tuples (see :data:`ocdskingfisherarchive.crawl.BYTES_RATIO` and
+                          :data:`ocdskingfisherarchive.crawl.FILES_RATIO`)
+    :returns: for each variant, a boolean array of the crawls that would be archived, with one row per variant
+    :rtype: numpy.ndarray
+    """
+    columns = history.columns
+    source = columns['source']
+    month = columns['month']
+    size = columns['bytes'].astype(np.float64)
+    files_count = columns['files_count'].astype(np.float64)
+    errors_count = columns['errors_count']
+    checksum = columns['checksum']
+    fingerprint = columns['fingerprint']
+
+    count = len(history)
+    kept = np.zeros((len(variants), count), dtype=bool)
+    if not count:
+        return kept
+
+    bytes_ratio = np.array([variant[0] for variant in variants], dtype=np.float64)[:, None]
+    files_ratio = np.array([variant[1] for variant in variants], dtype=np.float64)[:, None]
+
+    # The row of each source's n-th crawl, or -1, with one row per source and one column per n.
+    starts = np.flatnonzero(np.r_[True, source[1:] != source[:-1]])
+    lengths = np.diff(np.r_[starts, count])
+    matrix = np.full((len(starts), lengths.max()), -1, dtype=np.int64)
+    position = np.arange(count) - np.repeat(starts, lengths)
+    matrix[np.repeat(np.arange(len(starts)), lengths), position] = np.arange(count)
+
+    # Whether each crawl is the last crawl of its source and month.
+    last = np.r_[(source[1:] != source[:-1]) | (month[1:] != month[:-1]), True]
+
+    # The row of the best crawl so far of each source, for each variant.
+    best = np.full((len(variants), len(starts)), -1, dtype=np.int64)
+    for rows in matrix.T:
+        valid = rows >= 0
+        row = np.where(valid, rows, 0)
+        other = np.where(best >= 0, best, 0)
+
+        same_period = (size[row] > size[other]) & (
+            (size[row] >= size[other] * bytes_ratio)
+            | (files_count[row] >= files_count[other] * files_ratio)
+            | (errors_count[row] < errors_count[other])
+        )
+        distinct = (fingerprint[row] >= 0) & (fingerprint[other] >= 0) & (fingerprint[row] != fingerprint[other])
+        new_period = ~(
+            (errors_count[row] > errors_count[other])
+            & (files_count[row] <= files_count[other])
+            & (size[row] <= size[other])
+        ) & (distinct | ~((checksum[row] == checksum[other]) & (checksum[row] >= 0)))
+        decision = (best < 0) | np.where(month[row] == month[other], same_period, new_period)
+        best = np.where(valid & decision, row, best)
+
+        # At the end of a month, its best crawl is archived, unless it is from an earlier month.
+        end = valid & last[row] & (month[best] == month[row])
+        variant, column = np.nonzero(end)
+        kept[variant, best[variant, column]] = True
+
+    return kept
+
+
+def report(history, variants):
+    """
+    :param history: an instance of the :class:`~ocdskingfisherarchive.history.History` class
+    :param list variants: (bytes ratio, files ratio) tuples
+    :returns: for each variant, a dict with ``bytes_ratio``, ``files_ratio``, ``archives`` (the number of crawls that
+              would be archived) and ``bytes`` (their total bytes) keys
+    :rtype: list
+    """
+    kept = simulate(history, variants)
+    size = np.maximum(history.columns['bytes'], 0)
+    return [
+        {
+            'bytes_ratio': bytes_ratio,
+            'files_ratio': files_ratio,
+            'archives': int(kept[index].sum()),
+            'bytes': int(size[kept[index]].sum()),
+        }
+        for index, (bytes_ratio, files_ratio) in enumerate(variants)
+    ]
+
+
+def variants(bytes_ratios=(BYTES_RATIO,), files_ratios=(FILES_RATIO,)):
+    """
+    :returns: every combination of the bytes ratios and files ratios
+    :rtype: list
+    """
+    return list(itertools.product(bytes_ratios, files_ratios))
@@ -0,0 +1,95 @@
+import json
+import logging
+import threading
+import time
+
+from ocdskingfisherarchive.exceptions import ConcurrentArchivalError
+
+logger = logging.getLogger('ocdskingfisher.archive')
+
+# The number of seconds after which a lease that wasn't released can be taken over by another worker. This must exceed
+# the duration of the longest archival.
+LEASE_SECONDS = 43200  # 12 * 60 * 60
+
+
+class Leases:
+    """
+    Leases on remote directories, so that two workers never archive crawls to the same remote directory at once.
+
+    A lease is an object in the bucket's ``leases/`` directory, with the worker's ID and the lease's expiry time. It
+    is created with a conditional write that fails if the object exists. An expired lease, or a lease held by a worker
+    with the same ID (for example, if the worker was interrupted), is taken over with a conditional write that fails if
+    the object changed since it was read. A lease is released with a conditional delete.
+    """
+
+    def __init__(self, s3, owner, seconds=LEASE_SECONDS):
+        """
+        :param s3: an instance of a subclass of the :class:`~ocdskingfisherarchive.storage.Storage` class
+        :param str owner: this worker's ID, like its hostname
+        :param float seconds: the number of seconds after which a lease that wasn't released expires
+        """
+        self.s3 = s3
+        self.owner = owner
+        self.seconds = seconds
+        # The ETag of each lease held by this worker, keyed by remote directory.
+        self.held = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, remote_directory):
+        """
+        Acquires the lease on the remote directory, unless another worker holds it.
+
+        :param str remote_directory: a remote directory, like "source_id/2020/01"
+        :returns: whether the lease is acquired
+        :rtype: bool
+        """
+        key = _key(remote_directory)
+        body = json.dumps({'owner': self.owner, 'expires': time.time() + self.seconds}).encode()
+
+        current = self.s3.get(key)
+        etag = None
+        if current:
+            content, etag = current
+            lease = json.loads(content)
+            if lease['owner'] != self.owner and lease['expires'] > time.time():
+                logger.info('Skipping %s, because %s holds its lease', remote_directory, lease['owner'])
+                return False
+            if lease['owner'] != self.owner:
+                logger.warning('Taking over the expired lease of %s on %s', lease['owner'], remote_directory)
+
+        try:
+            etag = self.s3.put(key, body, etag=etag)
+        except ConcurrentArchivalError:
+            logger.info('Skipping %s, because another worker acquired its lease', remote_directory)
+            return False
+
+        with self.lock:
+            self.held[remote_directory] = etag
+        return True
+
+    def release(self, remote_directory):
+        """
+        Releases the lease on the remote directory, if this worker holds it.
+
+        :param str remote_directory: a remote directory, like "source_id/2020/01"
+        """
+        with self.lock:
+            etag = self.held.pop(remote_directory, None)
+        if etag is None:
+            return
+
+        try:
+            self.s3.delete_file(_key(remote_directory), etag=etag)
+        except ConcurrentArchivalError:
+            logger.warning('Not releasing the lease on %s, because another worker took it over', remote_directory)
+
+    def release_all(self):
+        """
+        Releases all leases held by this worker.
+        """
+        for remote_directory in list(self.held):
+            self.release(remote_directory)
+
+
+def _key(remote_directory):
+    return f'leases/{remote_directory}.json'
@@ -0,0 +1,122 @@
+import json
+import os
+import tempfile
+from collections import defaultdict
+
+
+class Manifest:
+    """
+    A manifest of the files in an archived crawl, in content-addressed mode.
+
+    In content-addressed mode, an archive contains only the files whose contents are new relative to the previously
+    archived crawl for the same source. The manifest lists every file in the crawl, with its checksum and the archive
+    and member in which its contents are stored, so that the full crawl can be restored.
+
+    .. code:: json
+
+       {
+         "source_id": "scotland",
+         "data_version": "20200902_052458",
+         "base": "scotland/2020/08",
+         "files": {
+           "1.json": {
+             "digest": "eba6c0bd00d10c54c3793ee13bcc114b",
+             "archive": "scotland/2020/08/data-20200802_052458.tar.lz4",
+             "member": "scotland/20200802_052458/1.json"
+           }
+         }
+       }
+    """
+
+    @classmethod
+    def build(cls, crawl, previous=None):
+        """
+        Builds the manifest of a crawl, referencing the files in the previous manifest with identical contents.
+
+        :param crawl: an instance of the :class:`~ocdskingfisherarchive.crawl.Crawl` class
+        :param previous: the manifest of the previously archived crawl for the same source, if any
+        :type previous: ocdskingfisherarchive.manifest.Manifest
+        :returns: the manifest, and the paths (relative to the crawl directory) of the files to archive
+        :rtype: tuple
+        """
+        known = {}
+        if previous:
+            for entry in previous.files.values():
+                known.setdefault(entry['digest'], entry)
+
+        archive = f'{crawl.remote_directory}/{cls.archive_name(crawl)}'
+        prefix = f'{crawl.source_id}/{crawl.format_data_version()}'
+
+        files = {}
+        names = []
+        for name, digest in crawl.digests.items():
+            if digest in known:
+                files[name] = dict(known[digest])
+            else:
+                # Use forward slashes, to be independent of the platform.
+                files[name] = {'digest': digest, 'archive': archive, 'member': f"{prefix}/{name.replace(os.sep, '/')}"}
+                known[digest] = files[name]
+                names.append(name)
+
+        base = previous and previous.remote_directory
+        return cls(crawl.source_id, crawl.format_data_version(), files, base=base), names
+
+    @staticmethod
+    def archive_name(crawl):
+        """
+        Returns the filename of the crawl's archive, in content-addressed mode.
+
+        The filename is unique to the crawl, so that an archive that is referenced by later manifests is never
+        overwritten, even if a better crawl is later archived for the same month.
+
+        :param crawl: an instance of the :class:`~ocdskingfisherarchive.crawl.Crawl` class
+        :rtype: str
+        """
+        return f'data-{crawl.format_data_version()}.tar.lz4'
+
+    def __init__(self, source_id, data_version, files, base=None):
+        """
+        :param str source_id: the spider's name
+        :param str data_version: the crawl directory's name
+        :param dict files: the entry of each file, keyed by its path relative to the crawl directory
+        :param str base: the remote directory of the previous manifest, if any
+        """
+        self.source_id = source_id
+        self.data_version = data_version
+        self.files = files
+        self.base = base
+
+    @property
+    def remote_directory(self):
+        """
+        :returns: the path of the remote directory
+        :rtype: str
+        """
+        return f'{self.source_id}/{self.data_version[:4]}/{self.data_version[4:6]}'
+
+    def archives(self):
+        """
+        :returns: the members to extract from each archive, as a dict of archive to a dict of member to the paths
+                  (relative to the crawl directory) of the files with the member's contents
+        :rtype: dict
+        """
+        archives = defaultdict(lambda: defaultdict(list))
+        for name, entry in sorted(self.files.items()):
+            archives[entry['archive']][entry['member']].append(name)
+        return archives
+
+    def asdict(self):
+        return {
+            'source_id': self.source_id,
+            'data_version': self.data_version,
+            'base': self.base,
+            'files': self.files,
+        }
+
+    def write_file(self):
+        file_descriptor, filename = tempfile.mkstemp(prefix='archive', suffix='.json')
+        with open(filename, 'w') as f:
+            json.dump(self.asdict(), f, indent=2)
+
+        os.close(file_descriptor)
+        return filename
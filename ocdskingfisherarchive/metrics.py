@@ -0,0 +1,177 @@
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+# The prefix of the metric names in Prometheus' text format.
+PROMETHEUS_PREFIX = 'kingfisher_archive'
+
+
+class Metrics:
+    """
+    Timers and counters for the phases of an archival process.
+
+    Each time a phase runs, its number of calls, its duration and the number of bytes it processed are added to its
+    totals. Phases can run concurrently in different threads, in which case their durations overlap.
+
+    .. code:: python
+
+       from ocdskingfisherarchive.metrics import metrics
+
+       with metrics.timer('s3.upload', size):
+           ...
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # An instance of the :class:`~ocdskingfisherarchive.profiler.Profiler` class, to profile selected phases.
+        self.profiler = None
+        self.reset()
+
+    def reset(self):
+        """
+        Resets all timers and counters.
+        """
+        with self.lock:
+            self.started = time.time()
+            self.phases = defaultdict(lambda: {'calls': 0, 'seconds': 0.0, 'bytes': 0})
+            self.counters = defaultdict(int)
+
+    def record(self, phase, seconds, size=0):
+        """
+        :param str phase: the phase's name
+        :param float seconds: the duration of the call
+        :param int size: the number of bytes processed by the call
+        """
+        with self.lock:
+            totals = self.phases[phase]
+            totals['calls'] += 1
+            totals['seconds'] += seconds
+            totals['bytes'] += size
+
+    def increment(self, counter, value=1):
+        """
+        :param str counter: the counter's name
+        :param int value: the amount by which to increment the counter
+        """
+        with self.lock:
+            self.counters[counter] += value
+
+    @contextmanager
+    def timer(self, phase, size=0):
+        """
+        Times a call to a phase.
+
+        If the number of bytes is not known in advance, set the ``bytes`` key of the yielded dict.
+
+        :param str phase: the phase's name
+        :param int size: the number of bytes processed by the call
+        """
+        measurement = {'bytes': size}
+        profiling = self.profiler is not None and self.profiler.start(phase)
+        start = time.perf_counter()
+        try:
+            yield measurement
+        finally:
+            self.record(phase, time.perf_counter() - start, measurement['bytes'])
+            if profiling:
+                self.profiler.stop()
+
+    def timed(self, phase):
+        """
+        Returns a decorator that times each call to the decorated function.
+
+        :param str phase: the phase's name
+        """
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(phase):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def iterate(self, phase, iterable):
+        """
+        Yields the items of an iterable, timing only the retrieval of each item.
+
+        :param str phase: the phase's name
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.timer(phase):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def summary(self):
+        """
+        :returns: the start time and duration of the process, the totals and throughput of each phase, and the value
+                  of each counter
+        :rtype: dict
+        """
+        with self.lock:
+            phases = {}
+            for phase, totals in sorted(self.phases.items()):
+                phases[phase] = dict(totals)
+                phases[phase]['bytes_per_second'] = totals['bytes'] / totals['seconds'] if totals['seconds'] else None
+
+            return {
+                'started': datetime.datetime.utcfromtimestamp(self.started).isoformat() + 'Z',
+                'seconds': time.time() - self.started,
+                'phases': phases,
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def write_json(self, filename):
+        """
+        Writes the summary to a JSON file.
+        """
+        _write(filename, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, filename):
+        """
+        Writes the summary to a file in Prometheus' text format, to be read by node_exporter's textfile collector.
+        """
+        summary = self.summary()
+
+        lines = []
+
+        def add(name, kind, description, samples):
+            lines.append(f'# HELP {PROMETHEUS_PREFIX}_{name} {description}')
+            lines.append(f'# TYPE {PROMETHEUS_PREFIX}_{name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{PROMETHEUS_PREFIX}_{name}{labels} {value}')
+
+        phases = summary['phases'].items()
+        add('phase_calls', 'gauge', 'The number of calls to the phase in the last run.',
+            [(f'{{phase="{phase}"}}', totals['calls']) for phase, totals in phases])
+        add('phase_seconds', 'gauge', 'The duration of the calls to the phase in the last run.',
+            [(f'{{phase="{phase}"}}', totals['seconds']) for phase, totals in phases])
+        add('phase_bytes', 'gauge', 'The bytes processed by the calls to the phase in the last run.',
+            [(f'{{phase="{phase}"}}', totals['bytes']) for phase, totals in phases])
+        add('count', 'gauge', 'The value of the counter in the last run.',
+            [(f'{{name="{name}"}}', value) for name, value in summary['counters'].items()])
+        add('last_run_timestamp_seconds', 'gauge', 'The start time of the last run.', [('', self.started)])
+        add('last_run_seconds', 'gauge', 'The duration of the last run.', [('', summary['seconds'])])
+
+        _write(filename, '\n'.join(lines) + '\n')
+
+
+def _write(filename, content):
+    # Write to a temporary file and rename it, so that a reader never reads a partial file.
+    file_descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+    with os.fdopen(file_descriptor, 'w') as f:
+        f.write(content)
+    os.chmod(temporary, 0o644)
+    os.replace(temporary, filename)
+
+
+metrics = Metrics()
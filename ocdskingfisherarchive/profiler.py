@@ -0,0 +1,85 @@
+import cProfile
+import pstats
+import threading
+from contextlib import contextmanager
+
+from ocdskingfisherarchive.metrics import metrics
+
+
+class Profiler:
+    """
+    Profiles the archival process, or only selected phases of it, with cProfile.
+
+    To profile selected phases, the profiler is enabled whenever a timer of
+    :data:`ocdskingfisherarchive.metrics.metrics` for one of those phases is running. If phases run concurrently in
+    different threads, only one is profiled at a time.
+
+    .. code:: python
+
+       profiler = Profiler(phases=['crawl.checksum'])
+       with profiler.profiling():
+           Archiver(...).run()
+       profiler.write('archive.prof')
+    """
+
+    def __init__(self, phases=()):
+        """
+        :param list phases: the names of the phases to profile, or none to profile everything
+        """
+        self.phases = set(phases)
+        self.profile = cProfile.Profile()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def profiling(self):
+        """
+        Profiles the code within the context, or only the selected phases of it.
+        """
+        if self.phases:
+            metrics.profiler = self
+            try:
+                yield
+            finally:
+                metrics.profiler = None
+        else:
+            self.profile.enable()
+            try:
+                yield
+            finally:
+                self.profile.disable()
+
+    def start(self, phase):
+        """
+        Enables the profiler, if the phase is selected and no other phase is being profiled.
+
+        :returns: whether the profiler was enabled
+        :rtype: bool
+        """
+        # A nested phase in the same thread fails to acquire the lock, but is profiled by the outer phase.
+        if phase in self.phases and self.lock.acquire(blocking=False):
+            self.profile.enable()
+            return True
+        return False
+
+    def stop(self):
+        """
+        Disables the profiler, after :meth:`start` returns ``True``.
+        """
+        self.profile.disable()
+        self.lock.release()
+
+    def write(self, filename):
+        """
+        Writes the results to a file in pstats format, which can be read by ``python -m pstats`` and by tools like
+        `SnakeViz <https://jiffyclub.github.io/snakeviz/>`__.
+        """
+        self.profile.dump_stats(filename)
+
+    def print_stats(self, stream, limit=20):
+        """
+        Prints the functions with the highest cumulative time.
+
+        :param stream: a file-like object
+        :param int limit: the number of functions to print
+        """
+        pstats.Stats(self.profile, stream=stream).sort_stats('cumulative').print_stats(limit)
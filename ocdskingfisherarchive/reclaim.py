@@ -0,0 +1,166 @@
+import errno
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from ocdskingfisherarchive.metrics import metrics
+from ocdskingfisherarchive.throttle import throttle
+
+logger = logging.getLogger('ocdskingfisher.archive')
+
+# The number of seconds for which to keep a crawl that is not archived (because it was rejected, or because another
+# crawl was archived for the same source and month), after it was first evaluated.
+RETENTION_PERIOD = 7776000  # 90 * 24 * 60 * 60
+# The maximum number of files in a directory to delete in one task.
+BATCH_SIZE = 1000
+
+
+class Reclaimer:
+    """
+    Deletes crawl directories in the background, using a pool of threads.
+
+    A crawl directory is first moved to the reclaim directory, outside the data directory, so that it is removed from
+    the data directory at once. If the reclaim directory is on a different filesystem, the crawl directory is deleted
+    where it is, instead. Then, each of its sub-directories, and each batch of its files, is deleted by a
+    different thread, so that a directory of many small files is deleted faster than by a single thread. Deletions are
+    throttled (see :meth:`ocdskingfisherarchive.throttle.Throttle.delete`), so as not to stall Kingfisher Collect.
+
+    If the process is interrupted, the remaining files are deleted by :meth:`resume`.
+    """
+
+    def __init__(self, directory, jobs=4):
+        """
+        :param str directory: the directory to which to move crawl directories before deleting them, which should be
+                              outside Kingfisher Collect's FILES_STORE directory, on the same filesystem
+        :param int jobs: the maximum number of threads deleting files at once
+        """
+        self.directory = directory
+        self.jobs = jobs
+        self.executor = None
+        self.futures = []
+        # The number of tasks remaining for each directory being deleted.
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def delete(self, path):
+        """
+        Moves a directory to the reclaim directory, and deletes it in the background.
+
+        :param str path: the directory to delete
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        root = tempfile.mkdtemp(prefix=f'{os.path.basename(path)}-', dir=self.directory)
+        try:
+            os.rename(path, os.path.join(root, os.path.basename(path)))
+        except OSError as e:
+            os.rmdir(root)
+            if e.errno != errno.EXDEV:
+                raise
+            logger.warning('%s is on a different filesystem than %s, deleting it in place', self.directory, path)
+            self._submit(path, [path])
+        else:
+            self._submit(root)
+
+    def resume(self):
+        """
+        Deletes, in the background, any directories whose deletion was interrupted.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for entry in os.scandir(self.directory):
+            with self.lock:
+                if entry.path in self.pending:
+                    continue
+            logger.info('Resuming the deletion of %s', entry.name)
+            self._submit(entry.path)
+
+    def wait(self):
+        """
+        Waits for all deletions to finish.
+        """
+        with self.lock:
+            futures, self.futures = self.futures, []
+        wait(futures)
+        for future in futures:
+            if future.exception():
+                logger.error('Failed to delete files', exc_info=future.exception())
+        try:
+            os.rmdir(self.directory)
+        except OSError:  # the directory doesn't exist or isn't empty
+            pass
+
+    def close(self):
+        """
+        Waits for all deletions to finish, and stops the threads.
+        """
+        self.wait()
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+    def _submit(self, root, directories=None):
+        """
+        :param str root: the directory to remove once its crawl directories are deleted
+        :param list directories: the crawl directories to delete (defaults to the sub-directories of ``root``)
+        """
+        if directories is None:
+            directories = [entry.path for entry in os.scandir(root) if entry.is_dir(follow_symlinks=False)]
+
+        tasks = []
+        for directory in directories:
+            # Delete each sub-directory of the crawl directory in a different task.
+            dirs = []
+            files = []
+            for entry in os.scandir(directory):
+                (dirs if entry.is_dir() else files).append(entry.path)
+            tasks.extend((_remove_tree, path) for path in dirs)
+            tasks.extend((_remove_files, files[i:i + BATCH_SIZE]) for i in range(0, len(files), BATCH_SIZE))
+
+        if not tasks:
+            shutil.rmtree(root)
+            return
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.jobs)
+            self.pending[root] = len(tasks)
+            for function, argument in tasks:
+                self.futures.append(self.executor.submit(self._run, root, function, argument))
+
+    def _run(self, root, function, argument):
+        try:
+            with metrics.timer('reclaim'):
+                function(argument)
+        finally:
+            with self.lock:
+                self.pending[root] -= 1
+                done = not self.pending[root]
+                if done:
+                    del self.pending[root]
+            if done:
+                # Delete the emptied directories.
+                shutil.rmtree(root)
+
+
+def _remove_files(paths):
+    for path in paths:
+        throttle.delete()
+        os.unlink(path)
+
+
+def _remove_tree(path):
+    if os.path.islink(path):
+        os.unlink(path)
+        return
+    for top, dirs, files in os.walk(path, topdown=False):
+        _remove_files([os.path.join(top, name) for name in files])
+        for name in dirs:
+            directory = os.path.join(top, name)
+            if os.path.islink(directory):
+                os.unlink(directory)
+            else:
+                os.rmdir(directory)
+    os.rmdir(path)
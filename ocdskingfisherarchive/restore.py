@@ -0,0 +1,156 @@
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from lz4.frame import LZ4FrameFile
+from xxhash import xxh3_128
+
+from ocdskingfisherarchive.crawl import Crawl
+from ocdskingfisherarchive.exceptions import ArchiveNotFoundError, ChecksumMismatchError
+from ocdskingfisherarchive.storage import RANGE_SIZE
+from ocdskingfisherarchive.tarfile import LZ4TarFile
+
+logger = logging.getLogger('ocdskingfisher.archive')
+
+
+def restore(s3, source_id, year, month, destination, concurrency=4, range_size=RANGE_SIZE):
+    """
+    Restores an archived crawl into a directory with the same layout as Kingfisher Collect's FILES_STORE directory.
+
+    If the crawl was archived in content-addressed mode, the files are extracted from each archive referenced by its
+    manifest. Otherwise, the files are extracted from its data file (or from the data file's member of its bundle, if
+    archived in a bundle).
+
+    Each archive is downloaded using concurrent ranged requests, and decompressed and extracted as a stream, without
+    writing an intermediate file. The restored crawl is verified against the archived crawl's checksum. If the
+    archive's members are in the order in which the checksum is calculated, it is calculated while extracting;
+    otherwise, it is calculated from the restored crawl directory.
+
+    :param s3: an instance of a subclass of the :class:`~ocdskingfisherarchive.storage.Storage` class
+    :param str source_id: the spider's name
+    :param int year: the year of the archived crawl
+    :param int month: the month of the archived crawl
+    :param str destination: the directory into which to restore the crawl
+    :param int concurrency: the maximum number of concurrent ranged requests
+    :param int range_size: the size of each ranged request
+    :returns: the full path to the restored crawl directory
+    :rtype: str
+    :raises ArchiveNotFoundError: if no crawl is archived for the source, year and month
+    :raises ChecksumMismatchError: if the restored crawl's checksum differs from the archived crawl's checksum
+    """
+    remote_directory = f'{source_id}/{year}/{month:02d}'
+
+    crawl = s3.load(source_id, year, month)
+    if not crawl:
+        raise ArchiveNotFoundError(f'No archive found: {remote_directory}')
+
+    local_directory = os.path.join(destination, source_id, crawl.format_data_version())
+
+    extract = partial(_extract, s3, local_directory=local_directory, concurrency=concurrency, range_size=range_size)
+
+    manifest = s3.get_manifest(remote_directory)
+    if manifest:
+        # The members of each archive are extracted to any number of paths, so the checksum is calculated from disk.
+        for archive, members in manifest.archives().items():
+            extract(archive, names=lambda name: members.get(name, ()))
+        checksum = None
+    else:
+        prefix = f'{source_id}/{crawl.format_data_version()}'
+        key, offset, size = s3.locate(remote_directory, 'data.tar.lz4')
+        checksum = extract(key, names=lambda name: _strip(name, prefix), offset=offset, size=size)
+
+    expected = crawl.asdict()['checksum']
+    if expected is None:
+        logger.warning('Not verifying %s, because its metadata has no checksum', remote_directory)
+    else:
+        if checksum is None:
+            checksum = Crawl(source_id, crawl.data_version, destination).checksum
+        if checksum != expected:
+            raise ChecksumMismatchError(f'Checksum mismatch: {remote_directory} ({checksum} != {expected})')
+
+    logger.info('Restored %s to %s', remote_directory, local_directory)
+    return local_directory
+
+
+def restore_all(s3, source_id, periods, destination, jobs=4, **kwargs):
+    """
+    Restores archived crawls for a source in parallel (see :func:`restore`).
+
+    :param s3: an instance of a subclass of the :class:`~ocdskingfisherarchive.storage.Storage` class
+    :param str source_id: the spider's name
+    :param list periods: (year, month) tuples
+    :param str destination: the directory into which to restore the crawls
+    :param int jobs: the maximum number of crawls to restore at once
+    :param kwargs: keyword arguments to :func:`restore`
+    :returns: the full path to each restored crawl directory, in the order of the periods
+    :rtype: list
+    """
+    with ThreadPoolExecutor(jobs) as executor:
+        futures = [executor.submit(restore, s3, source_id, year, month, destination, **kwargs)
+                   for year, month in periods]
+        return [future.result() for future in futures]
+
+
+def _strip(name, prefix):
+    # Data files written without a manifest have member names like "path/to/FILES_STORE/source_id/data_version/...".
+    name = f'/{name}'
+    index = name.find(f'/{prefix}/')
+    if index > -1:
+        return (name[index + len(prefix) + 2:],)
+    return ()
+
+
+def _walk_key(name):
+    # Crawl._walk() yields a directory's files in alphabetical order, then its sub-directories' files.
+    *directories, file = name.split('/')
+    return tuple((1, directory) for directory in directories) + ((0, file),)
+
+
+def _extract(s3, remote_file_name, local_directory, names, concurrency=4, range_size=RANGE_SIZE, offset=0, size=None):
+    """
+    :param function names: a function that returns the paths (relative to the crawl directory) to which to extract a
+                           member, given its name
+    :param int offset: the offset of the archive within the file
+    :param int size: the size of the archive (defaults to the rest of the file)
+    :returns: the checksum of the extracted files, if each member was extracted to one path, in the order in which
+              :attr:`ocdskingfisherarchive.crawl.Crawl.checksum` is calculated
+    :rtype: str
+    """
+    stream = s3.open(remote_file_name, range_size=range_size, concurrency=concurrency, offset=offset, size=size)
+    if not stream:
+        raise ArchiveNotFoundError(f'No archive found: {remote_file_name}')
+
+    base = os.path.join(os.path.normpath(local_directory), '')
+    hasher = xxh3_128()
+    previous = None
+    with stream, LZ4TarFile.open(fileobj=LZ4FrameFile(stream), mode='r|') as tar:
+        for tarinfo in tar:
+            if not tarinfo.isfile():
+                continue
+            paths = names(tarinfo.name)
+            if hasher:
+                key = _walk_key(paths[0]) if len(paths) == 1 else None
+                if key is None or previous is not None and key <= previous:
+                    hasher = None
+                previous = key
+            first = None
+            for name in paths:
+                path = os.path.normpath(os.path.join(base, name))
+                if not path.startswith(base):
+                    raise ValueError(f'Member outside of crawl directory: {name}')
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # A member of a stream can be read only once, so identical files are copied from the first path.
+                if first:
+                    shutil.copyfile(first, path)
+                    continue
+                with tar.extractfile(tarinfo) as src, open(path, 'wb') as dst:
+                    for chunk in iter(partial(src.read, 65536), b''):  # 64KB
+                        if hasher:
+                            hasher.update(chunk)
+                        dst.write(chunk)
+                first = path
+
+    if hasher:
+        return hasher.hexdigest()
@@ -1,30 +1,78 @@
-import json
+import base64
+import hashlib
+import io
 import logging
 import os
 import tempfile
+import threading
+import time
 from contextlib import contextmanager
 
-import boto3
 from botocore.exceptions import ClientError
-from dotenv import load_dotenv
 
-from ocdskingfisherarchive.crawl import Crawl
+from ocdskingfisherarchive.buffers import pool
+from ocdskingfisherarchive.exceptions import ConcurrentArchivalError
+from ocdskingfisherarchive.metrics import metrics
+from ocdskingfisherarchive.storage import Storage
+from ocdskingfisherarchive.throttle import throttle
 
-load_dotenv()
-client = boto3.client('s3')
-logger = logging.getLogger('ocdskingfisher.archive')
+# Conditional writes are supported by Amazon S3 but not by this version of botocore. The `IfMatch` and `IfNoneMatch`
+# parameters are removed before botocore validates the parameters, and are set as headers before the request is signed.
+CONDITIONAL_PARAMETERS = {
+    'IfMatch': 'If-Match',
+    'IfNoneMatch': 'If-None-Match',
+}
 
 
-def _find_latest_year_month_to_load(data, year, month):
-    while year >= 2018:
-        if data.get(year, {}).get(month):
-            return year, month
-        if month > 1:
-            month = month - 1
-        else:
-            year = year - 1
-            month = 12
-    return None, None
+def _pop_conditional_parameters(params, context, **kwargs):
+    for parameter, header in CONDITIONAL_PARAMETERS.items():
+        if parameter in params:
+            context.setdefault('conditional_headers', {})[header] = params.pop(parameter)
+
+
+def _set_conditional_headers(request, **kwargs):
+    request.headers.update(request.context.get('conditional_headers', {}))
+
+
+class LazyClient:
+    """
+    A boto3 client for Amazon S3, which is created on first use.
+
+    Importing boto3 and creating a client take a significant fraction of the time to run a command that makes no
+    requests, like ``--help``.
+    """
+
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = _create_client()
+        return getattr(self._client, name)
+
+
+def _create_client():
+    import boto3
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    s3_client = boto3.client('s3')
+    for operation in ('PutObject', 'DeleteObject'):
+        s3_client.meta.events.register(f'before-parameter-build.s3.{operation}', _pop_conditional_parameters)
+        s3_client.meta.events.register(f'before-sign.s3.{operation}', _set_conditional_headers)
+    return s3_client
+
+
+client = LazyClient()
+logger = logging.getLogger('ocdskingfisher.archive')
+
+# The minimum size of each part of a resumable upload. Files no larger than this are uploaded in a single request.
+PART_SIZE = 64 * 1024 * 1024  # 64MB
+# Amazon S3 allows at most 10,000 parts per multipart upload.
+MAX_PARTS = 10000
 
 
 @contextmanager
@@ -36,77 +84,360 @@ def _try(s3):
         raise e
 
 
-class S3:
+def _base64(digest):
+    # The Content-MD5 header is the base64-encoded binary digest.
+    return base64.b64encode(digest).decode()
+
+
+class _Body(io.RawIOBase):
+    """
+    A read-only, seekable file object over a buffer, to pass as a request's body. botocore doesn't accept a
+    ``memoryview``, and, unlike ``io.BytesIO``, this doesn't copy the buffer.
+
+    Each read is throttled (see :meth:`~ocdskingfisherarchive.throttle.Throttle.upload`), so that a body is throttled
+    as it is sent.
+    """
+
+    def __init__(self, source):
+        """
+        :param memoryview source: the buffer
+        """
+        super().__init__()
+        self.source = source
+        self.size = len(source)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        count = max(0, min(len(b), self.size - self.position))
+        b[:count] = self.source[self.position:self.position + count]
+        throttle.upload(count)
+        self.position += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+
+class S3(Storage):
+    """
+    Stores archived crawls in an Amazon S3 bucket.
+    """
+
     def __init__(self, bucket_name):
         self.bucket_name = bucket_name
 
-    def load_exact(self, source_id, data_version):
+    def upload_file_to_staging(self, local_file_name, remote_file_name, journal=None):
+        """
+        Uploads a file to the staging directory.
+
+        A file larger than :data:`PART_SIZE` is uploaded in parts. If a journal is provided, the upload ID and the
+        completed parts are recorded in the journal, so that an interrupted upload can be resumed.
+
+        Each request carries the MD5 digest of its body, so that Amazon S3 rejects a corrupted request. The checksum of
+        the file is calculated from these digests, like the ETag of an object that is not encrypted with SSE-KMS: the
+        MD5 digest of the file, or, if uploaded in parts, the MD5 digest of the concatenated digests of the parts,
+        followed by "-" and the number of parts.
+
+        :param journal: an instance of the :class:`~ocdskingfisherarchive.cache.Cache` class
+        :returns: the checksum of the file, or ``None`` if a resumed upload's earlier parts have no recorded digest
+        :rtype: str
+        """
+        with metrics.timer('s3.upload', os.path.getsize(local_file_name)):
+            return self._upload(local_file_name, f'staging/{remote_file_name}', journal)
+
+    def upload_file(self, local_file_name, remote_file_name, journal=None):
+        """
+        Uploads a file to its final key, like :meth:`upload_file_to_staging`.
+        """
+        with metrics.timer('s3.upload', os.path.getsize(local_file_name)):
+            return self._upload(local_file_name, remote_file_name, journal, {'StorageClass': 'STANDARD_IA'})
+
+    def commit_file(self, local_file_name, remote_file_name, etag=None):
+        """
+        Uploads a file to its final key, if the current object's ETag is the given ETag, or, if no ETag is given, if no
+        object exists.
+
+        Each request carries the MD5 digest of its body, like :meth:`upload_file_to_staging`. A file larger than
+        :data:`PART_SIZE` is uploaded in parts, and the condition is checked when the upload is completed, so that
+        the file is read once.
+
+        :returns: the checksum of the file (see :meth:`upload_file_to_staging`)
+        :rtype: str
+        :raises ConcurrentArchivalError: if the condition is not met
+        """
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        size = os.path.getsize(local_file_name)
+        try:
+            with metrics.timer('s3.upload', size):
+                if size <= PART_SIZE:
+                    return self._put_file(local_file_name, remote_file_name,
+                                          {'StorageClass': 'STANDARD_IA', **condition})
+                return self._upload(local_file_name, remote_file_name, None, {'StorageClass': 'STANDARD_IA'},
+                                    condition)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', '412'):
+                raise ConcurrentArchivalError(f'{remote_file_name} was written concurrently ({condition})')
+            logger.error(e)
+            raise e
+
+    @metrics.timed('s3.put')
+    def put(self, key, body, etag=None):
         """
-        Loads an archive from S3 for source && exact year/month, if it exists.
+        Writes a small object, if the current object's ETag is the given ETag, or, if no ETag is given, if no object
+        exists.
+
+        :param bytes body: the object's content
+        :returns: the new object's ETag
+        :rtype: str
+        :raises ConcurrentArchivalError: if the condition is not met
+        """
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            return client.put_object(Bucket=self.bucket_name, Key=key, Body=io.BytesIO(body), **condition)['ETag']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', '412', 'ConditionalRequestConflict'):
+                raise ConcurrentArchivalError(f'{key} was written concurrently ({condition})')
+            logger.error(e)
+            raise e
+
+    @metrics.timed('s3.get')
+    def get(self, key, size=None):
+        """
+        :param int size: the number of bytes to read from the start of the object (defaults to all)
+        :returns: the content and ETag of a small object, if it exists
+        :rtype: tuple
+        """
+        kwargs = {} if size is None else {'Range': f'bytes=0-{size - 1}'}
+        try:
+            response = client.get_object(Bucket=self.bucket_name, Key=key, **kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            logger.error(e)
+            raise e
+        return response['Body'].read(), response['ETag']
+
+    @metrics.timed('s3.head')
+    def head(self, remote_file_name):
+        """
+        :returns: the ETag and size of the object, if it exists
+        :rtype: dict
         """
-        return self._load(source_id, data_version.year, data_version.month)
+        try:
+            response = client.head_object(Bucket=self.bucket_name, Key=remote_file_name)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            logger.error(e)
+            raise e
+        return {'etag': response['ETag'], 'size': response['ContentLength']}
+
+    def _put_file(self, local_file_name, key, extra_args):
+        """
+        Uploads a file no larger than :data:`PART_SIZE` in a single request, with the MD5 digest of its body.
+
+        :returns: the MD5 digest of the file
+        :rtype: str
+        """
+        size = os.path.getsize(local_file_name)
+        with pool.open(local_file_name) as f:
+            if size <= pool.block_size:
+                # Small files, like metadata files, are read into a reusable buffer of the block size.
+                with pool.buffer() as buffer:
+                    return self._put_buffer(f, buffer, key, extra_args)
+            # Larger files are read into a buffer of their size, which is freed once uploaded, instead of being kept in
+            # the pool.
+            return self._put_buffer(f, bytearray(size), key, extra_args)
+
+    def _put_buffer(self, f, buffer, key, extra_args):
+        body = memoryview(buffer)[:pool.readinto(f, buffer)]
+        digest = hashlib.md5(body).digest()
+        client.put_object(Bucket=self.bucket_name, Key=key, Body=_Body(body), ContentMD5=_base64(digest), **extra_args)
+        return digest.hex()
+
+    def _upload(self, local_file_name, key, journal, extra_args=None, condition=None):
+        size = os.path.getsize(local_file_name)
+        extra_args = extra_args or {}
+
+        # Each request carries the MD5 digest of its body, which Amazon S3 verifies. The digest is calculated from the
+        # buffer that is uploaded, so the file is read once.
+        if size <= PART_SIZE:
+            with _try(self):
+                return self._put_file(local_file_name, key, extra_args)
+
+        upload_id = journal and journal.get_upload(key)
+        if upload_id:
+            logger.info('Resuming upload of %s', key)
+        else:
+            with _try(self):
+                upload_id = client.create_multipart_upload(Bucket=self.bucket_name, Key=key, **extra_args)['UploadId']
+            if journal:
+                journal.set_upload(key, upload_id)
+
+        # The ETag and MD5 digest of each completed part.
+        parts = journal.get_parts(upload_id) if journal else {}
+        part_size = max(PART_SIZE, -(-size // MAX_PARTS))
+
+        try:
+            # Read each part into the same buffer, instead of allocating a new `bytes` object per part.
+            with pool.open(local_file_name) as f, pool.buffer(part_size) as buffer:
+                for part_number, offset in enumerate(range(0, size, part_size), 1):
+                    if part_number in parts:
+                        continue
+                    f.seek(offset)
+                    count = pool.readinto(f, buffer)
+                    body = buffer if count == part_size else buffer[:count]
+                    digest = hashlib.md5(body).digest()
+                    throttle.upload(len(body))
+                    response = client.upload_part(Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                                                  PartNumber=part_number, Body=body, ContentMD5=_base64(digest))
+                    parts[part_number] = (response['ETag'], digest.hex())
+                    if journal:
+                        journal.set_part(upload_id, part_number, response['ETag'], digest.hex())
+
+            client.complete_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id, MultipartUpload={
+                'Parts': [{'ETag': etag, 'PartNumber': part_number}
+                          for part_number, (etag, _) in sorted(parts.items())],
+            }, **(condition or {}))
+        except ClientError as e:
+            if condition and e.response['Error']['Code'] in ('PreconditionFailed', '412'):
+                # The upload can't be completed, so its parts are discarded.
+                self.abort_upload(key, upload_id)
+                if journal:
+                    journal.delete_upload(key)
+                raise e
+            if e.response['Error']['Code'] == 'NoSuchUpload' and journal:
+                # The upload was aborted or expired. Start over.
+                logger.warning('Restarting upload of %s (%s)', key, e)
+                journal.delete_upload(key)
+                return self._upload(local_file_name, key, journal, extra_args, condition)
+            logger.error(e)
+            raise e
+
+        if journal:
+            journal.delete_upload(key)
+
+        digests = [digest for _, digest in (parts[part_number] for part_number in sorted(parts))]
+        # Parts recorded by earlier versions have no digest.
+        if None in digests:
+            return None
+        return f'{hashlib.md5(bytes.fromhex("".join(digests))).hexdigest()}-{len(digests)}'
 
-    def load_latest(self, source_id, data_version):
+    @metrics.timed('s3.abort_upload')
+    def abort_upload(self, key, upload_id):
         """
-        Loads an archive from S3 for source && the latest year/month up to the one passed, if any exist.
+        Aborts a multipart upload.
+
+        :param str key: the key of the object being uploaded, including any staging directory
         """
-        data = self.get_years_and_months_for_source(source_id)
-        year, month = _find_latest_year_month_to_load(data, data_version.year, data_version.month)
-        if year and month:
-            return self._load(source_id, year, month)
+        with _try(self):
+            client.abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id)
 
-    def _load(self, source_id, year, month):
-        remote_filename = f'{source_id}/{year}/{month:02d}/metadata.json'
-        filename = self.get_file(remote_filename)
-        if filename:
-            with open(filename) as f:
-                metadata = json.load(f)
-                crawl = Crawl(**metadata)
-            os.unlink(filename)
-            return crawl
+    @metrics.timed('s3.list_uploads')
+    def list_uploads(self, seconds=0):
+        """
+        :param float seconds: list only the uploads initiated at least this many seconds ago
+        :returns: the multipart uploads in progress, as (key, upload ID) tuples
+        :rtype: list
+        """
+        before = time.time() - seconds
+        uploads = []
+        kwargs = {}
+        with _try(self):
+            while True:
+                response = client.list_multipart_uploads(Bucket=self.bucket_name, **kwargs)
+                uploads.extend((upload['Key'], upload['UploadId']) for upload in response.get('Uploads', [])
+                               if upload['Initiated'].timestamp() <= before)
+                if not response.get('IsTruncated'):
+                    return uploads
+                kwargs = {'KeyMarker': response['NextKeyMarker'], 'UploadIdMarker': response['NextUploadIdMarker']}
 
-    def upload_file_to_staging(self, local_file_name, remote_file_name):
+    @metrics.timed('s3.list')
+    def _list(self, prefix):
+        contents = []
+        kwargs = {}
         with _try(self):
-            client.upload_file(local_file_name, self.bucket_name, f'staging/{remote_file_name}')
+            while True:
+                response = client.list_objects_v2(Bucket=self.bucket_name, Prefix=prefix, **kwargs)
+                contents.extend(response.get('Contents', []))
+                if not response.get('IsTruncated'):
+                    return contents
+                kwargs = {'ContinuationToken': response['NextContinuationToken']}
 
+    @metrics.timed('s3.copy')
     def move_file_from_staging_to_real(self, remote_file_name):
         copy_source = {
             'Bucket': self.bucket_name,
             'Key': f'staging/{remote_file_name}',
         }
+        from boto3.s3.transfer import TransferConfig
+
+        # Copy in parts of the same size as the upload's parts, so that the ETag is the checksum of the upload (see
+        # upload_file_to_staging()), for files up to MAX_PARTS * PART_SIZE bytes.
+        config = TransferConfig(multipart_threshold=PART_SIZE + 1, multipart_chunksize=PART_SIZE)
         with _try(self):
             client.copy(copy_source, self.bucket_name, remote_file_name, ExtraArgs={
                 'MetadataDirective': 'COPY',
                 'StorageClass': 'STANDARD_IA',
-            })
+            }, Config=config)
 
+    @metrics.timed('s3.delete')
     def remove_staging_file(self, remote_file_name):
         with _try(self):
             client.delete_object(Bucket=self.bucket_name, Key=f'staging/{remote_file_name}')
 
-    def get_file(self, remote_file_name):
+    @metrics.timed('s3.delete')
+    def delete_file(self, key, etag=None):
+        """
+        :param str key: the key of the object, including any staging directory
+        :param str etag: if set, delete the object only if its ETag is this ETag
+        :raises ConcurrentArchivalError: if the object's ETag is not the given ETag
+        """
+        condition = {'IfMatch': etag} if etag else {}
         try:
-            with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as file:
-                client.download_fileobj(self.bucket_name, remote_file_name, file)
-                return file.name
+            client.delete_object(Bucket=self.bucket_name, Key=key, **condition)
         except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', '412'):
+                raise ConcurrentArchivalError(f'{key} was written concurrently ({condition})')
+            logger.error(e)
+            raise e
+
+    def get_file(self, remote_file_name, suffix='.json'):
+        try:
+            with metrics.timer('s3.download') as measurement:
+                with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as file:
+                    client.download_fileobj(self.bucket_name, remote_file_name, file)
+                    measurement['bytes'] = file.tell()
+                    return file.name
+        except ClientError as e:
+            os.unlink(file.name)
             if e.response['Error']['Code'] == "404":
                 return None
             else:
                 logger.error(e)
                 raise e
 
-    def get_years_and_months_for_source(self, source_id):
-        with _try(self):
-            # This is max 1000 responses but given how many files we should have per source this should be fine
-            response = client.list_objects_v2(Bucket=self.bucket_name, Prefix=f'{source_id}/')
-            if response['KeyCount'] == 0:
-                return {}
-            out = {}
-            for c in response['Contents']:
-                key_bits = c['Key'].split('/')
-                year = int(key_bits[1])
-                month = int(key_bits[2])
-                out.setdefault(year, {})
-                out[year][month] = True
-            return out
+    def get_range(self, remote_file_name, start, end):
+        """
+        :param int start: the offset of the first byte to read
+        :param int end: the offset of the last byte to read
+        :returns: the bytes of the object in the range
+        :rtype: bytes
+        """
+        with metrics.timer('s3.download', end - start + 1), _try(self):
+            response = client.get_object(Bucket=self.bucket_name, Key=remote_file_name, Range=f'bytes={start}-{end}')
+            return response['Body'].read()
@@ -0,0 +1,82 @@
+import logging
+import time
+
+logger = logging.getLogger('ocdskingfisher.archive')
+
+# The orders in which to archive groups of crawls.
+POLICIES = {
+    # The order in which crawl directories are found.
+    'scan': None,
+    # The group with the largest crawl first, to reclaim the most disk space first.
+    'largest': lambda crawls: -max(crawl.bytes for crawl in crawls),
+    # The group with the oldest crawl first.
+    'oldest': lambda crawls: min(crawl.data_version for crawl in crawls),
+}
+
+
+class Scheduler:
+    """
+    Orders the groups of crawls to archive, and enforces the budget of a run.
+
+    A run can be limited to a number of bytes, in which case a crawl that would exceed the limit is skipped, and to a
+    number of seconds, in which case the run stops before the next group of crawls once the time is up.
+    """
+
+    def __init__(self, policy='scan', max_bytes=None, max_seconds=None):
+        """
+        :param str policy: the order in which to archive groups of crawls, one of the keys of :data:`POLICIES`
+        :param int max_bytes: the maximum number of bytes of crawls to archive in a run
+        :param float max_seconds: the maximum number of seconds after which to start archiving a group of crawls
+        """
+        if policy not in POLICIES:
+            raise ValueError(f'policy must be one of {", ".join(POLICIES)}, not {policy!r}')
+
+        self.policy = policy
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.start()
+
+    def start(self):
+        """
+        Starts the budget of a run.
+        """
+        self.deadline = None if self.max_seconds is None else time.monotonic() + self.max_seconds
+        self.scheduled_bytes = 0
+
+    def order(self, groups):
+        """
+        With the ``scan`` policy, the groups are returned as is, so that a generator of groups is consumed only as the
+        groups are archived. Other policies read all groups, to sort them.
+
+        :param groups: lists of crawls, one per remote directory
+        :returns: the groups, in the order in which to archive them
+        :rtype: iterable
+        """
+        key = POLICIES[self.policy]
+        if key is None:
+            return groups
+        return sorted(groups, key=key)
+
+    def expired(self):
+        """
+        :returns: whether the time is up
+        :rtype: bool
+        """
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            logger.info('Stopping, because the time is up (%ss)', self.max_seconds)
+            return True
+        return False
+
+    def schedule(self, crawl):
+        """
+        Adds the crawl's bytes to the run's total, unless this would exceed the maximum.
+
+        :returns: whether the crawl is within the budget
+        :rtype: bool
+        """
+        if self.max_bytes is not None and self.scheduled_bytes + crawl.bytes > self.max_bytes:
+            logger.info('Skipping %s, because its %s bytes exceed the remaining budget of %s bytes', crawl,
+                        crawl.bytes, self.max_bytes - self.scheduled_bytes)
+            return False
+        self.scheduled_bytes += crawl.bytes
+        return True
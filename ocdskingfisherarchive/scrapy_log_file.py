@@ -2,16 +2,28 @@ import ast
 import datetime
 import os
 import re
-from collections import defaultdict
+import threading
+from collections import OrderedDict, defaultdict
 
-from logparser import parse
-from logparser.common import DATETIME_PATTERN, Common
+from ocdskingfisherarchive.metrics import metrics
 
 # Kingfisher Collect logs an INFO message starting with "Spider arguments:".
 SPIDER_ARGUMENTS_SEARCH_STRING = ' INFO: Spider arguments: '
+# The maximum number of log files to index. The least recently used log files are removed from the index first.
+MAX_INDEXED = 1024
 
-# Hotfix: https://github.com/my8100/logparser/pull/19
-Common.SIGTERM_PATTERN = re.compile(r'^%s[ ].+?:[ ](Received[ ]SIG(?:BREAK|INT|TERM)([ ]twice)?),' % DATETIME_PATTERN)
+
+def _parse(text, **kwargs):
+    # logparser is imported on first use, because it is slow to import, and most runs parse no log files.
+    from logparser import parse
+    from logparser.common import DATETIME_PATTERN, Common
+
+    # Hotfix: https://github.com/my8100/logparser/pull/19
+    Common.SIGTERM_PATTERN = re.compile(
+        r'^%s[ ].+?:[ ](Received[ ]SIG(?:BREAK|INT|TERM)([ ]twice)?),' % DATETIME_PATTERN
+    )
+
+    return parse(text, **kwargs)
 
 
 class ScrapyLogFile():
@@ -19,6 +31,12 @@ class ScrapyLogFile():
     A representation of a Scrapy log file.
     """
 
+    # Log files, keyed by path, with the modification time and size at which they were indexed, so that a long-running
+    # process doesn't read an unchanged log file again. The index is ordered from least to most recently used, and
+    # holds at most MAX_INDEXED log files.
+    _index = OrderedDict()
+    _lock = threading.Lock()
+
     @classmethod
     def find(cls, logs_directory, source_id, data_version):
         """
@@ -34,10 +52,44 @@ class ScrapyLogFile():
         if os.path.isdir(source_directory):
             for entry in os.scandir(source_directory):
                 if entry.name.endswith('.log'):
-                    scrapy_log_file = ScrapyLogFile(entry.path)
+                    scrapy_log_file = cls.get(entry.path)
                     if scrapy_log_file.match(data_version):
                         return scrapy_log_file
 
+    @classmethod
+    def get(cls, name):
+        """
+        Returns the indexed log file, unless it has changed since indexed, in which case the log file is indexed again.
+
+        :param str name: the full path to the log file
+        :rtype: ocdskingfisherarchive.scrapy.ScrapyLogFile
+        """
+        stat = os.stat(name)
+        key = (stat.st_mtime_ns, stat.st_size)
+
+        with cls._lock:
+            indexed = cls._index.get(name)
+            if indexed and indexed[0] == key:
+                cls._index.move_to_end(name)
+                return indexed[1]
+
+            scrapy_log_file = cls(name)
+            cls._index[name] = (key, scrapy_log_file)
+            cls._index.move_to_end(name)
+            while len(cls._index) > MAX_INDEXED:
+                cls._index.popitem(last=False)
+            return scrapy_log_file
+
+    @classmethod
+    def forget(cls, name):
+        """
+        Removes the log file from the index.
+
+        :param str name: the full path to the log file
+        """
+        with cls._lock:
+            cls._index.pop(name, None)
+
     def __init__(self, name):
         """
         :param str name: the full path to the log file
@@ -52,6 +104,7 @@ class ScrapyLogFile():
         """
         Deletes the log file and any log summary ending in ``.stats``.
         """
+        self.forget(self.name)
         if os.path.isfile(self.name):
             os.remove(self.name)
         summary = f'{self.name}.stats'
@@ -67,9 +120,9 @@ class ScrapyLogFile():
         :rtype: dict
         """
         if self._logparser is None:
-            with open(self.name) as f:
+            with metrics.timer('log.logparser', os.path.getsize(self.name)), open(self.name) as f:
                 # `taillines=0` sets the 'tail' key to all lines, so we set it to 1.
-                self._logparser = parse(f.read(), headlines=0, taillines=1)
+                self._logparser = _parse(f.read(), headlines=0, taillines=1)
 
         return self._logparser
 
@@ -149,7 +202,7 @@ class ScrapyLogFile():
         self._spider_arguments = {}
 
         buf = []
-        with open(self.name) as f:
+        with metrics.timer('log.lines', os.path.getsize(self.name)), open(self.name) as f:
             for line in f:
                 if buf or line.startswith('{'):
                     buf.append(line.rstrip())
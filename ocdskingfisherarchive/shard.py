@@ -0,0 +1,43 @@
+import hashlib
+
+
+class Shard:
+    """
+    Partitions sources across workers, so that several archival processes (on one or more hosts) can archive crawls
+    at once, each archiving different sources.
+
+    Sources are assigned using rendezvous hashing: each source is assigned to the worker with the highest hash of the
+    worker's index and the source's ID. Adding a worker moves only the sources that the new worker is assigned.
+    """
+
+    def __init__(self, index=0, count=1):
+        """
+        :param int index: this worker's index, from 0 to ``count - 1``
+        :param int count: the number of workers
+        """
+        if not 0 <= index < count:
+            raise ValueError(f'index must be between 0 and {count - 1}, not {index!r}')
+
+        self.index = index
+        self.count = count
+
+    def owner(self, source_id):
+        """
+        :returns: the index of the worker to which the source is assigned
+        :rtype: int
+        """
+        return max(range(self.count), key=lambda index: _hash(f'{index}:{source_id}'))
+
+    def owns(self, source_id):
+        """
+        :returns: whether the source is assigned to this worker
+        :rtype: bool
+        """
+        return self.count == 1 or self.owner(source_id) == self.index
+
+    def __str__(self):
+        return f'{self.index}/{self.count}'
+
+
+def _hash(string):
+    return int.from_bytes(hashlib.md5(string.encode()).digest()[:8], 'big')
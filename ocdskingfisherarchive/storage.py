@@ -0,0 +1,483 @@
+import asyncio
+import io
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import unquote, urlsplit
+
+from ocdskingfisherarchive.bundle import BUNDLE_NAME, HEADER_SIZE, LEGACY_NAMES, Bundle
+from ocdskingfisherarchive.crawl import Crawl
+from ocdskingfisherarchive.manifest import Manifest
+
+logger = logging.getLogger('ocdskingfisher.archive')
+
+# The size of each ranged request, when reading an object as a stream.
+RANGE_SIZE = 8 * 1024 * 1024  # 8MB
+
+
+def create_storage(url):
+    """
+    Returns the storage for a URL.
+
+    - ``file:///mnt/archive``: the local directory ``/mnt/archive`` (see
+      :class:`~ocdskingfisherarchive.filesystem.FileSystem`)
+    - ``s3://bucket`` or ``bucket``: the Amazon S3 bucket ``bucket`` (see :class:`~ocdskingfisherarchive.s3.S3`)
+
+    :param str url: a URL or an Amazon S3 bucket name
+    :returns: an instance of a subclass of the :class:`~ocdskingfisherarchive.storage.Storage` class
+    :raises ValueError: if the URL's scheme is not supported
+    """
+    parts = urlsplit(url or '')
+    if parts.scheme == 'file':
+        from ocdskingfisherarchive.filesystem import FileSystem
+
+        if parts.netloc not in ('', 'localhost'):
+            raise ValueError(f'file:// URLs must have an absolute path: {url}')
+        return FileSystem(unquote(parts.path))
+
+    from ocdskingfisherarchive.s3 import S3
+
+    if parts.scheme == 's3':
+        return S3(parts.netloc)
+    if parts.scheme:
+        raise ValueError(f'Unsupported storage URL: {url}')
+    return S3(url)
+
+
+def _find_latest_year_month_to_load(data, year, month):
+    while year >= 2018:
+        if data.get(year, {}).get(month):
+            return year, month
+        if month > 1:
+            month = month - 1
+        else:
+            year = year - 1
+            month = 12
+    return None, None
+
+
+class Storage:
+    """
+    The storage of archived crawls, like an Amazon S3 bucket (:class:`~ocdskingfisherarchive.s3.S3`) or a local
+    directory (:class:`~ocdskingfisherarchive.filesystem.FileSystem`).
+
+    Files are stored by key, like "source_id/2020/01/metadata.json". Subclasses implement the methods that read, write,
+    list and delete files. This class implements the methods that load archived crawls and manifests, and that list
+    archives, using those methods.
+
+    An archived crawl is stored either as multiple files (``metadata.json``, ``data.tar.lz4`` and ``scrapy.log``), or
+    as one bundle (see :class:`~ocdskingfisherarchive.bundle.Bundle`). If both exist in a remote directory, the
+    multiple files are used.
+    """
+
+    def load_exact(self, source_id, data_version):
+        """
+        Loads an archive for source && exact year/month, if it exists.
+        """
+        return self.load(source_id, data_version.year, data_version.month)
+
+    def load_latest(self, source_id, data_version):
+        """
+        Loads an archive for source && the latest year/month up to the one passed, if any exist. Incomplete archives
+        are skipped.
+        """
+        data = self.get_years_and_months_for_source(source_id)
+        year, month = data_version.year, data_version.month
+        while True:
+            year, month = _find_latest_year_month_to_load(data, year, month)
+            if not (year and month):
+                return None
+            crawl = self.load(source_id, year, month)
+            if crawl:
+                return crawl
+            year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+
+    def load_manifest(self, source_id, data_version):
+        """
+        Loads a manifest for source && the latest year/month up to the one passed, if any exist.
+        """
+        data = self.get_years_and_months_for_source(source_id)
+        year, month = _find_latest_year_month_to_load(data, data_version.year, data_version.month)
+        if year and month:
+            return self.get_manifest(f'{source_id}/{year}/{month:02d}')
+
+    def get_manifest(self, remote_directory):
+        """
+        Loads a manifest for the remote directory, if it exists (i.e. if archived in content-addressed mode).
+        """
+        filename = self.get_file(f'{remote_directory}/manifest.json')
+        if filename:
+            with open(filename) as f:
+                manifest = Manifest(**json.load(f))
+            os.unlink(filename)
+            return manifest
+
+    def get_bundle(self, remote_directory):
+        """
+        Reads the header of the remote directory's bundle, if it exists, with one ranged request (or two, if the index
+        is larger than :data:`~ocdskingfisherarchive.bundle.HEADER_SIZE`).
+
+        :param str remote_directory: a remote directory, like "source_id/2020/01"
+        :returns: the bundle's index
+        :rtype: ocdskingfisherarchive.bundle.Bundle
+        """
+        key = f'{remote_directory}/{BUNDLE_NAME}'
+        current = self.get(key, size=HEADER_SIZE)
+        if not current:
+            return None
+        data, _ = current
+        header_size = Bundle.get_header_size(data)
+        if header_size > len(data):
+            data += self.get_range(key, len(data), header_size - 1)
+        return Bundle.from_header(data)
+
+    def locate(self, remote_directory, name):
+        """
+        Returns the location of a file of an archived crawl, in either layout.
+
+        :param str remote_directory: a remote directory, like "source_id/2020/01"
+        :param str name: the file's name, like "data.tar.lz4"
+        :returns: the key, and the offset and size of the file within the object (``None`` if the whole object)
+        :rtype: tuple
+        """
+        if not self.head(f'{remote_directory}/metadata.json'):
+            bundle = self.get_bundle(remote_directory)
+            if bundle and name in bundle.members:
+                offset, size = bundle.range(name)
+                return f'{remote_directory}/{BUNDLE_NAME}', offset, size
+        return f'{remote_directory}/{name}', 0, None
+
+    def delete_legacy_files(self, remote_directory):
+        """
+        Deletes the files of a crawl archived as multiple files to the remote directory, once a bundle replaces them.
+        The metadata file is deleted first, so that the remaining files are never read as a complete archive.
+
+        Content-addressed archives, like ``data-20200101_000000.tar.lz4``, are kept, as later manifests can reference
+        them.
+
+        :param str remote_directory: a remote directory, like "source_id/2020/01"
+        """
+        keys = {c['Key'] for c in self._list(f'{remote_directory}/')}
+        for name in LEGACY_NAMES:
+            key = f'{remote_directory}/{name}'
+            if key in keys:
+                self.delete_file(key)
+
+    def load(self, source_id, year, month):
+        """
+        Loads an archive for source && year/month, if it exists and is complete.
+
+        :param str source_id: the spider's name
+        :param int year: the year of the archived crawl
+        :param int month: the month of the archived crawl
+        :returns: the archived crawl
+        :rtype: ocdskingfisherarchive.crawl.Crawl
+        """
+        remote_directory = f'{source_id}/{year}/{month:02d}'
+        filename = self.get_file(f'{remote_directory}/metadata.json')
+        if filename:
+            with open(filename) as f:
+                metadata = json.load(f)
+            os.unlink(filename)
+
+            # A metadata file that lists objects was committed after uploading the objects to their final keys. If an
+            # object differs, a later archival was interrupted before committing its metadata file.
+            objects = metadata.pop('objects', {})
+            metadata.pop('checksums', None)
+            for name, expected in objects.items():
+                actual = self.head(f'{remote_directory}/{name}')
+                if actual != expected:
+                    logger.warning('Ignoring incomplete archive %s/%s/%02d (%s: %r != %r)', source_id, year, month,
+                                   name, actual, expected)
+                    return None
+        else:
+            bundle = self.get_bundle(remote_directory)
+            if not bundle:
+                return None
+            metadata = bundle.metadata
+
+        crawl = Crawl(**metadata)
+        # The metadata file is written before the crawl is archived.
+        crawl.archived = True
+        return crawl
+
+    def list_staging_files(self, seconds=0):
+        """
+        :param float seconds: list only the files last modified at least this many seconds ago
+        :returns: the keys of the files in the staging directory
+        :rtype: list
+        """
+        before = time.time() - seconds
+        return [c['Key'] for c in self._list('staging/') if c['LastModified'].timestamp() <= before]
+
+    def list_archives(self, source_id=None):
+        """
+        :param str source_id: list only this source's archives
+        :returns: the ETag of the metadata file (or bundle) of each archived crawl, keyed by its remote directory, like
+                  "source_id/2020/01"
+        :rtype: dict
+        """
+        archives = {}
+        for c in self._list(f'{source_id}/' if source_id else ''):
+            # The metadata file or bundle indicates a complete archive. Staged files have longer keys.
+            parts = c['Key'].split('/')
+            if len(parts) == 4 and parts[3] == 'metadata.json':
+                archives['/'.join(parts[:3])] = c['ETag']
+            elif len(parts) == 4 and parts[3] == BUNDLE_NAME:
+                archives.setdefault('/'.join(parts[:3]), c['ETag'])
+        return archives
+
+    def get_years_and_months_for_source(self, source_id):
+        """
+        :returns: the months with an archived crawl, keyed by year
+        :rtype: dict
+        """
+        out = {}
+        for c in self._list(f'{source_id}/'):
+            # The metadata file or bundle indicates a complete archive.
+            if not c['Key'].endswith(('/metadata.json', f'/{BUNDLE_NAME}')):
+                continue
+            key_bits = c['Key'].split('/')
+            year = int(key_bits[1])
+            month = int(key_bits[2])
+            out.setdefault(year, {})
+            out[year][month] = True
+        return out
+
+    def open(self, remote_file_name, range_size=RANGE_SIZE, concurrency=4, offset=0, size=None):
+        """
+        Opens a file for reading as a stream, using concurrent ranged requests (see :class:`RangedReader`).
+
+        :param int range_size: the size of each ranged request
+        :param int concurrency: the maximum number of concurrent requests
+        :param int offset: the offset at which to start reading
+        :param int size: the number of bytes to read (defaults to the rest of the file)
+        :returns: a buffered, non-seekable file object, if the file exists
+        :rtype: io.BufferedReader
+        """
+        current = self.head(remote_file_name)
+        if not current:
+            return None
+        if size is None:
+            size = current['size'] - offset
+        return io.BufferedReader(RangedReader(self, remote_file_name, size, range_size, concurrency, offset),
+                                 buffer_size=range_size)
+
+    def upload_file_to_staging(self, local_file_name, remote_file_name, journal=None):
+        """
+        Uploads a file to the staging directory.
+
+        :param journal: an instance of the :class:`~ocdskingfisherarchive.cache.Cache` class, to resume interrupted
+                        uploads
+        :returns: the checksum of the file, if known
+        :rtype: str
+        """
+        raise NotImplementedError
+
+    def upload_file(self, local_file_name, remote_file_name, journal=None):
+        """
+        Uploads a file to its final key, like :meth:`upload_file_to_staging`.
+        """
+        raise NotImplementedError
+
+    def commit_file(self, local_file_name, remote_file_name, etag=None):
+        """
+        Uploads a file to its final key, if the current file's ETag is the given ETag, or, if no ETag is given, if no
+        file exists.
+
+        :returns: the MD5 digest of the file
+        :rtype: str
+        :raises ConcurrentArchivalError: if the condition is not met
+        """
+        raise NotImplementedError
+
+    def put(self, key, body, etag=None):
+        """
+        Writes a small file, if the current file's ETag is the given ETag, or, if no ETag is given, if no file exists.
+
+        :param bytes body: the file's content
+        :returns: the new file's ETag
+        :rtype: str
+        :raises ConcurrentArchivalError: if the condition is not met
+        """
+        raise NotImplementedError
+
+    def get(self, key, size=None):
+        """
+        :param int size: the number of bytes to read from the start of the file (defaults to all)
+        :returns: the content and ETag of a small file, if it exists
+        :rtype: tuple
+        """
+        raise NotImplementedError
+
+    def head(self, remote_file_name):
+        """
+        :returns: the ETag and size of the file, if it exists
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    def get_file(self, remote_file_name, suffix='.json'):
+        """
+        Downloads a file to a temporary file, which the caller must delete.
+
+        :returns: the name of the temporary file, if the file exists
+        :rtype: str
+        """
+        raise NotImplementedError
+
+    def get_range(self, remote_file_name, start, end):
+        """
+        :param int start: the offset of the first byte to read
+        :param int end: the offset of the last byte to read
+        :returns: the bytes of the file in the range
+        :rtype: bytes
+        """
+        raise NotImplementedError
+
+    def move_file_from_staging_to_real(self, remote_file_name):
+        """
+        Moves a file from the staging directory to its final key. The file in the staging directory might remain,
+        until :meth:`remove_staging_file` is called.
+        """
+        raise NotImplementedError
+
+    def remove_staging_file(self, remote_file_name):
+        """
+        Deletes a file from the staging directory, if it exists.
+        """
+        raise NotImplementedError
+
+    def delete_file(self, key, etag=None):
+        """
+        :param str key: the key of the file, including any staging directory
+        :param str etag: if set, delete the file only if its ETag is this ETag
+        :raises ConcurrentArchivalError: if the file's ETag is not the given ETag
+        """
+        raise NotImplementedError
+
+    def list_uploads(self, seconds=0):
+        """
+        :param float seconds: list only the uploads started at least this many seconds ago
+        :returns: the uploads in progress, as (key, upload ID) tuples
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def abort_upload(self, key, upload_id):
+        """
+        Aborts an upload in progress.
+
+        :param str key: the key of the file being uploaded, including any staging directory
+        """
+        raise NotImplementedError
+
+    def _list(self, prefix):
+        """
+        :returns: the key (``Key``), ETag (``ETag``), size (``Size``) and last modified time (``LastModified``, as a
+                  timezone-aware datetime) of each file whose key starts with the prefix, in order of key
+        :rtype: list
+        """
+        raise NotImplementedError
+
+
+class AsyncStorage:
+    """
+    An asyncio interface to an instance of a subclass of the :class:`~ocdskingfisherarchive.storage.Storage` class.
+
+    Functions that make requests to the storage are run in a thread pool. boto3 clients are thread-safe, and botocore
+    releases the GIL while waiting on the network, so many requests can be in flight at once. The thread pool is
+    created when first used, and shut down by :meth:`close`.
+    """
+
+    def __init__(self, storage, max_workers=None):
+        """
+        :param storage: an instance of a subclass of the :class:`~ocdskingfisherarchive.storage.Storage` class
+        :param int max_workers: the maximum number of concurrent requests
+        """
+        self.storage = storage
+        self.max_workers = max_workers
+        self.executor = None
+
+    def run(self, function, *args, **kwargs):
+        """
+        Runs a function that makes requests to the storage in the thread pool.
+
+        :returns: a future
+        :rtype: asyncio.Future
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.max_workers)
+        return asyncio.get_event_loop().run_in_executor(self.executor, partial(function, *args, **kwargs))
+
+    async def load_exact(self, source_id, data_version):
+        return await self.run(self.storage.load_exact, source_id, data_version)
+
+    async def load_latest(self, source_id, data_version):
+        return await self.run(self.storage.load_latest, source_id, data_version)
+
+    def close(self):
+        """
+        Shuts down the thread pool, once its functions return.
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+class RangedReader(io.RawIOBase):
+    """
+    Reads a file as a stream, requesting the next ranges concurrently while earlier ranges are read.
+
+    At most ``concurrency`` ranges are requested or waiting to be read at once, which bounds memory use.
+    """
+
+    def __init__(self, s3, remote_file_name, size, range_size=RANGE_SIZE, concurrency=4, offset=0):
+        """
+        :param s3: an instance of the :class:`~ocdskingfisherarchive.storage.Storage` class
+        :param str remote_file_name: the key of the file
+        :param int size: the number of bytes to read
+        :param int range_size: the size of each ranged request
+        :param int concurrency: the maximum number of concurrent requests
+        :param int offset: the offset at which to start reading
+        """
+        super().__init__()
+        self.s3 = s3
+        self.remote_file_name = remote_file_name
+        self.end = offset + size
+        self.range_size = range_size
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(concurrency)
+        # The requested ranges, in order.
+        self.futures = deque()
+        # The offset of the next range to request.
+        self.offset = offset
+        self.buffer = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            while len(self.futures) < self.concurrency and self.offset < self.end:
+                end = min(self.offset + self.range_size, self.end) - 1
+                self.futures.append(self.executor.submit(self.s3.get_range, self.remote_file_name, self.offset, end))
+                self.offset = end + 1
+            if not self.futures:
+                return 0
+            self.buffer = memoryview(self.futures.popleft().result())
+
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self):
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown(wait=False)
+        super().close()
@@ -1,7 +1,12 @@
+import copy
+import os
 import tarfile
+from stat import S_IMODE, S_ISDIR, S_ISREG
 
 from lz4.frame import LZ4FrameFile
 
+from ocdskingfisherarchive.buffers import pool
+
 
 class LZ4TarFile(tarfile.TarFile):
     """
@@ -12,6 +17,10 @@ class LZ4TarFile(tarfile.TarFile):
        with LZ4TarFile.open('compressed.lz4', 'w:lz4') as tar:
            tar.add(filename)
 
+       # Or, without further system calls, given a stat() result.
+       with LZ4TarFile.open('compressed.lz4', 'w:lz4') as tar:
+           tar.add_stat(filename, os.stat(filename))
+
        with LZ4TarFile.open('compressed.lz4', 'r:lz4') as tar:
            for tarinfo in tar:
                assert tarinfo.name == filename
@@ -21,6 +30,85 @@ class LZ4TarFile(tarfile.TarFile):
         'lz4': 'lz4open',
     }
 
+    #: A function to call with the size of each block read from an added file, for example, to throttle reads.
+    on_read = None
+
+    def addfile(self, tarinfo, fileobj=None):
+        # Unlike TarFile.addfile(), which reads a new `bytes` object per 16KB, read the file in blocks into a buffer
+        # from the pool (see ocdskingfisherarchive.buffers), and drop its pages from the page cache once read.
+        if fileobj is None or not hasattr(fileobj, 'readinto'):
+            super().addfile(tarinfo, fileobj)
+            return
+
+        self._check('awx')
+
+        tarinfo = copy.copy(tarinfo)
+        self._write(tarinfo, fileobj)
+        self.members.append(tarinfo)
+
+    def add_stat(self, name, stat, arcname=None):
+        """
+        Adds a regular file or a directory, using the result of an earlier ``stat()`` call, like the ``stat()`` method
+        of an :class:`os.DirEntry` from a directory walk.
+
+        Unlike :meth:`tarfile.TarFile.add`, this doesn't call ``lstat()``, look up the names of the owner's user and
+        group, or add directories recursively. Ownership is numeric, and the modification time is truncated to an
+        integer, so that no extended header is written. The member isn't retained in :attr:`members`, so that memory
+        use is constant, however many members are added. A symbolic link is added as the file or directory to which it
+        points.
+
+        :param str name: the path to the file or directory
+        :param os.stat_result stat: the file's or directory's ``stat()`` result
+        :param str arcname: the member's name (defaults to ``name``, like :meth:`tarfile.TarFile.add`)
+        """
+        self._check('awx')
+
+        if arcname is None:
+            arcname = name
+        arcname = os.path.splitdrive(arcname)[1].replace(os.sep, '/').lstrip('/')
+
+        tarinfo = self.tarinfo(arcname)
+        tarinfo.mode = S_IMODE(stat.st_mode)
+        tarinfo.uid = stat.st_uid
+        tarinfo.gid = stat.st_gid
+        tarinfo.mtime = int(stat.st_mtime)
+
+        if S_ISDIR(stat.st_mode):
+            tarinfo.type = tarfile.DIRTYPE
+            self._write(tarinfo)
+        elif S_ISREG(stat.st_mode):
+            tarinfo.type = tarfile.REGTYPE
+            tarinfo.size = stat.st_size
+            with open(name, 'rb', buffering=0) as f:
+                self._write(tarinfo, f)
+        else:
+            raise ValueError(f'{name} is neither a regular file nor a directory')
+
+    def _write(self, tarinfo, fileobj=None):
+        buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
+        self.fileobj.write(buf)
+        self.offset += len(buf)
+
+        if fileobj is None:
+            return
+
+        pool.advise(fileobj)
+        remaining = tarinfo.size
+        for block in pool.read_blocks(fileobj, tarinfo.size):
+            if self.on_read:
+                self.on_read(len(block))
+            self.fileobj.write(block)
+            remaining -= len(block)
+        pool.release(fileobj)
+        if remaining:
+            raise OSError('unexpected end of data')
+
+        blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+        if remainder > 0:
+            self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        self.offset += blocks * tarfile.BLOCKSIZE
+
     @classmethod
     def lz4open(cls, name, mode='r', fileobj=None, **kwargs):
         """
@@ -0,0 +1,126 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('ocdskingfisher.archive')
+
+
+class TokenBucket:
+    """
+    Limits the rate at which tokens (like bytes) are consumed.
+
+    The bucket fills at the given rate, up to its capacity. Consuming more tokens than are in the bucket blocks the
+    caller until the deficit is refilled, so that bursts are allowed up to the capacity, and the average rate never
+    exceeds the given rate. The bucket is thread-safe: callers in different threads share the rate.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param float rate: the number of tokens added per second
+        :param float capacity: the maximum number of tokens in the bucket (defaults to one second of tokens)
+        """
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, tokens):
+        """
+        Consumes tokens, blocking until the bucket has refilled any deficit.
+
+        :param float tokens: the number of tokens to consume
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+class Throttle:
+    """
+    Limits the read bandwidth, upload bandwidth, file deletions and CPU usage of the archival process, so that it can
+    run alongside Kingfisher Collect.
+
+    Reads are throttled when calculating checksums and when compressing crawl directories. Uploads are throttled as
+    data is sent to Amazon S3. Deletions are throttled when deleting crawl directories. CPU usage (of all threads, in
+    CPU-seconds per second) is checked each time data is read, uploaded or deleted, and the process sleeps if it
+    exceeds its limit.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configure()
+
+    def configure(self, read_rate=None, upload_rate=None, cpu=None, delete_rate=None):
+        """
+        :param float read_rate: the maximum bytes read per second
+        :param float upload_rate: the maximum bytes uploaded per second
+        :param float cpu: the maximum CPU-seconds per second (for example, 0.5 for half of one CPU)
+        :param float delete_rate: the maximum files deleted per second
+        """
+        self.read_bucket = TokenBucket(read_rate) if read_rate else None
+        self.upload_bucket = TokenBucket(upload_rate) if upload_rate else None
+        self.delete_bucket = TokenBucket(delete_rate) if delete_rate else None
+        self.cpu_bucket = TokenBucket(cpu) if cpu else None
+        self.cpu_time = time.process_time()
+
+    def read(self, size):
+        """
+        Blocks until the bytes can be read.
+        """
+        if self.read_bucket:
+            self.read_bucket.consume(size)
+        self._cpu()
+
+    def upload(self, size):
+        """
+        Blocks until the bytes can be uploaded. Can be used as the ``Callback`` of a boto3 transfer.
+        """
+        if self.upload_bucket:
+            self.upload_bucket.consume(size)
+        self._cpu()
+
+    def delete(self, count=1):
+        """
+        Blocks until the files can be deleted.
+        """
+        if self.delete_bucket:
+            self.delete_bucket.consume(count)
+        self._cpu()
+
+    def _cpu(self):
+        if self.cpu_bucket:
+            with self.lock:
+                now = time.process_time()
+                used = now - self.cpu_time
+                self.cpu_time = now
+            self.cpu_bucket.consume(used)
+
+
+def lower_priority(increment=0, idle_io=False):
+    """
+    Lowers the CPU and I/O scheduling priority of the process.
+
+    :param int increment: the amount by which to increase the process' niceness
+    :param bool idle_io: whether to set the process' I/O scheduling class to idle (Linux only), so that it only uses
+                         the disk when no other process does
+    """
+    if increment:
+        os.nice(increment)
+    if idle_io:
+        import psutil
+
+        if hasattr(psutil, 'IOPRIO_CLASS_IDLE'):
+            psutil.Process().ionice(psutil.IOPRIO_CLASS_IDLE)
+        else:
+            logger.warning('The idle I/O scheduling class is not supported on this platform')
+
+
+throttle = Throttle()
@@ -0,0 +1,338 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+from ocdskingfisherarchive.crawl import QUIET_PERIOD, Crawl
+from ocdskingfisherarchive.scrapy_log_file import ScrapyLogFile
+
+logger = logging.getLogger('ocdskingfisher.archive')
+
+# See https://man7.org/linux/man-pages/man7/inotify.7.html
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_ONLYDIR = 0x01000000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+
+# The events that change a directory's modification time.
+IN_ENTRIES = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+
+EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """
+    A minimal interface to Linux's inotify API, using ctypes.
+
+    .. code:: python
+
+       inotify = Inotify()
+       inotify.add('/path/to/directory', IN_CREATE)
+       for path, mask, name in inotify.read(timeout=60):
+           ...
+    """
+
+    def __init__(self):
+        """
+        :raises OSError: if inotify is unavailable
+        """
+        if not sys.platform.startswith('linux'):
+            raise OSError('inotify is only available on Linux')
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        # The path of each watched directory, keyed by watch descriptor.
+        self.paths = {}
+
+    def add(self, path, mask):
+        """
+        Watches a directory.
+
+        :param str path: the path to the directory
+        :param int mask: the events to watch
+        :raises OSError: if the directory can't be watched (for example, if it doesn't exist)
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask | IN_ONLYDIR)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.paths[wd] = path
+
+    def read(self, timeout=None):
+        """
+        Waits for events.
+
+        :param float timeout: the maximum number of seconds to wait
+        :returns: the events, as (directory path, mask, entry name) tuples
+        :rtype: list
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+
+        events = []
+        try:
+            buffer = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return events
+
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = EVENT.unpack_from(buffer, offset)
+            offset += EVENT.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_IGNORED:
+                # The directory was deleted or unwatched.
+                path = self.paths.pop(wd, None)
+            else:
+                path = self.paths.get(wd)
+            events.append((path, mask, name))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    """
+    Archives each crawl once its crawl directory is quiet, in a long-running process.
+
+    The archiver (and its connection to Amazon S3 and its SQLite database) is kept between archivals. Log files are
+    indexed by :meth:`ocdskingfisherarchive.scrapy_log_file.ScrapyLogFile.get`, so that a log file is read again only
+    if it changed. If an archival run fails, the error is logged, and the crawls are retried at the next interval.
+
+    On Linux, inotify is used to track when crawl directories are created, deleted and modified, and when log files
+    are written. Otherwise, or if inotify fails, the directories are scanned at each interval.
+    """
+
+    def __init__(self, archiver, interval=3600, quiet_period=QUIET_PERIOD):
+        """
+        :param archiver: an instance of the :class:`~ocdskingfisherarchive.archive.Archiver` class
+        :param float interval: the number of seconds between scans (if inotify is unavailable), and between attempts
+                               to archive crawls that were not archived in a previous attempt
+        :param float quiet_period: the number of seconds after which to archive a crawl directory, once modified
+        """
+        self.archiver = archiver
+        self.data_directory = os.path.normpath(os.fspath(archiver.data_directory))
+        self.logs_directory = os.path.normpath(os.fspath(archiver.logs_directory))
+        self.interval = interval
+        self.quiet_period = quiet_period
+
+        # The modification time of each crawl directory, keyed by (source_id, data_version) tuples.
+        self.crawls = {}
+        # The modification time of each crawl directory when it was last considered for archival.
+        self.attempted = {}
+        self.retried = time.monotonic()
+
+        try:
+            self.inotify = Inotify()
+        except OSError as e:
+            logger.warning('Scanning directories every %ss, instead of using inotify (%s)', interval, e)
+            self.inotify = None
+
+    def run(self, callback=None, iterations=None):
+        """
+        Runs until interrupted.
+
+        :param function callback: a function to call after each archival
+        :param int iterations: the number of iterations after which to return, for testing
+        """
+        self.scan()
+
+        while iterations is None or iterations > 0:
+            crawls = self.due()
+            if crawls:
+                logger.info('Archiving %d quiet crawls', len(crawls))
+                try:
+                    self.archiver.run(crawls=[crawl for _, crawl in crawls])
+                except Exception:
+                    logger.exception('Failed to archive %d quiet crawls', len(crawls))
+                self.prune(crawls)
+                if callback:
+                    callback()
+
+            self.wait()
+            if iterations is not None:
+                iterations -= 1
+
+    def scan(self):
+        """
+        Finds all crawl directories, and watches them.
+        """
+        data_directory = self.data_directory
+        logs_directory = self.logs_directory
+
+        self.crawls = {}
+        if self.inotify:
+            self._watch(data_directory, IN_ENTRIES)
+            self._watch(logs_directory, IN_ENTRIES)
+
+        for source in _directories(data_directory):
+            if self.inotify:
+                self._watch(source.path, IN_ENTRIES)
+            for crawl in _directories(source.path):
+                self._track(source.name, crawl.name, crawl.path)
+
+        if self.inotify:
+            for source in _directories(logs_directory):
+                self._watch(source.path, IN_ENTRIES | IN_CLOSE_WRITE)
+
+    def due(self):
+        """
+        Returns the crawls whose directories have been quiet for the quiet period, and that haven't been considered
+        since last modified (or, at each interval, that weren't archived).
+
+        Other quiet crawls for the same source and month are also returned, so that the archiver can select the best
+        crawl for the month, as in a full scan.
+
+        :returns: the crawls, as (key, crawl) tuples
+        :rtype: list
+        """
+        now = time.time()
+        retry = time.monotonic() - self.retried >= self.interval
+        if retry:
+            self.retried = time.monotonic()
+
+        quiet = [key for key, mtime in self.crawls.items() if mtime < now - self.quiet_period]
+        # The data version is in the format "YYYYMMDD_HHMMSS".
+        months = {(source_id, data_version[:6]) for source_id, data_version in quiet
+                  if retry or self.attempted.get((source_id, data_version)) != self.crawls[(source_id, data_version)]}
+
+        crawls = []
+        for key in quiet:
+            source_id, data_version = key
+            if (source_id, data_version[:6]) in months:
+                crawl = Crawl(source_id, Crawl.parse_data_version(data_version), data_directory=self.data_directory,
+                              logs_directory=self.logs_directory)
+                crawls.append((key, crawl))
+        return crawls
+
+    def prune(self, crawls):
+        """
+        Stops tracking the crawls that were archived or that are not to be archived.
+        """
+        for key, crawl in crawls:
+            if key not in self.crawls:
+                continue
+            if not os.path.isdir(crawl.local_directory) or self.archiver.cache.get(crawl).archived is False:
+                del self.crawls[key]
+                self.attempted.pop(key, None)
+            else:
+                self.attempted[key] = self.crawls[key]
+
+    def wait(self):
+        """
+        Waits until the next crawl is due or until the interval passes, processing any filesystem events.
+        """
+        now = time.time()
+        timeout = self.interval
+        for key, mtime in self.crawls.items():
+            if self.attempted.get(key) != mtime:
+                timeout = min(timeout, max(0, mtime + self.quiet_period - now))
+
+        if not self.inotify:
+            time.sleep(timeout)
+            self.scan()
+            return
+
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                events = self.inotify.read(timeout=max(0, deadline - time.monotonic()))
+            except OSError as e:
+                logger.warning('Scanning directories every %ss, instead of using inotify (%s)', self.interval, e)
+                self.inotify = None
+                return
+            for event in events:
+                self._handle(*event)
+            if not events or time.monotonic() >= deadline:
+                return
+
+    def _handle(self, path, mask, name):
+        data_directory = self.data_directory
+        logs_directory = self.logs_directory
+
+        if mask & IN_Q_OVERFLOW:
+            logger.warning('Scanning directories, because inotify events were lost')
+            self.scan()
+            return
+        if path is None or not name:
+            return
+
+        full_path = os.path.join(path, name)
+        is_dir = mask & IN_ISDIR
+        created = mask & (IN_CREATE | IN_MOVED_TO)
+        deleted = mask & (IN_DELETE | IN_MOVED_FROM)
+        parent = os.path.dirname(path)
+
+        if path == data_directory:
+            # A source directory.
+            if is_dir and created:
+                self._watch(full_path, IN_ENTRIES)
+                for crawl in _directories(full_path):
+                    self._track(name, crawl.name, crawl.path)
+            elif is_dir and deleted:
+                for key in [key for key in self.crawls if key[0] == name]:
+                    del self.crawls[key]
+        elif parent == data_directory:
+            # A crawl directory.
+            source_id = os.path.basename(path)
+            if is_dir and created:
+                self._track(source_id, name, full_path)
+            elif is_dir and deleted:
+                self.crawls.pop((source_id, name), None)
+        elif os.path.dirname(parent) == data_directory:
+            # An entry in a crawl directory, which changes its modification time.
+            self._track(os.path.basename(parent), os.path.basename(path), path)
+        elif path == logs_directory:
+            # A source directory of log files.
+            if is_dir and created:
+                self._watch(full_path, IN_ENTRIES | IN_CLOSE_WRITE)
+        elif parent == logs_directory and name.endswith('.log'):
+            # A log file. Index it once it's written. Its spider arguments are read when a crawl looks up its log file.
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                ScrapyLogFile.get(full_path)
+            elif deleted:
+                ScrapyLogFile.forget(full_path)
+
+    def _track(self, source_id, data_version, path):
+        # Like Crawl.all(), ignore sample crawls and other directories.
+        if source_id.endswith('_sample') or source_id.startswith('.') or not Crawl.parse_data_version(data_version):
+            return
+        try:
+            self.crawls[(source_id, data_version)] = os.stat(path).st_mtime
+        except FileNotFoundError:
+            self.crawls.pop((source_id, data_version), None)
+            return
+        if self.inotify:
+            self._watch(path, IN_ENTRIES)
+
+    def _watch(self, path, mask):
+        try:
+            self.inotify.add(path, mask)
+        except OSError as e:
+            logger.debug('Not watching %s (%s)', path, e)
+
+
+def _directories(path):
+    try:
+        return [entry for entry in os.scandir(path) if entry.is_dir()]
+    except FileNotFoundError:
+        return []
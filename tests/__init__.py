@@ -37,3 +37,21 @@ def assert_log(caplog, levelname, message):
     assert caplog.records[0].name == 'ocdskingfisher.archive'
     assert caplog.records[0].levelname == levelname, f'{caplog.records[0].levelname!r} == {levelname!r}'
     assert caplog.records[0].message == message, f'{caplog.records[0].message!r} == {message!r}'
+
+
+def create_crawl(tmpdir, data_version, files, source_id='scotland', mtime=1):
+    """
+    Creates a crawl directory with the given files (a dict of relative path to content), and a log file of a finished,
+    complete and clean crawl, whose spider arguments match the data version.
+    """
+    crawl_directory = tmpdir.join('data', source_id).ensure(data_version, dir=True)
+    for name, content in files.items():
+        crawl_directory.join(name).write(content, ensure=True)
+    os.utime(crawl_directory, (mtime, mtime))
+
+    crawl_time = Crawl.parse_data_version(data_version).strftime('%Y-%m-%dT%H:%M:%S')
+    with open(path('log_error1.log')) as f:
+        content = f.read().replace("'crawl_time': None", f"'crawl_time': '{crawl_time}'")
+    tmpdir.join('logs', 'kingfisher', source_id, f'{data_version}.log').write(content, ensure=True)
+
+    return Crawl(source_id, data_version, tmpdir.join('data'), tmpdir.join('logs', 'kingfisher'))
@@ -0,0 +1,163 @@
+import base64
+import hashlib
+import io
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+# boto3's managed transfers use multipart operations for objects larger than this.
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+
+class S3StandIn:
+    """
+    An in-memory stand-in for the methods of a boto3 S3 client that are used by this package.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        # The ETags of objects that were uploaded or copied in parts. Other objects' ETags are their MD5 digests.
+        self.etags = {}
+        # The last modified time of objects, if not now.
+        self.modified = {}
+        self.uploads = {}
+        self.requests = []
+
+    def _record(self, operation, key):
+        self.requests.append((operation, key))
+
+    def upload_file(self, Filename, Bucket, Key, Callback=None, **kwargs):
+        self._record('upload_file', Key)
+        with open(Filename, 'rb') as f:
+            self.objects[Key] = f.read()
+        if Callback:
+            Callback(len(self.objects[Key]))
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, ContentMD5=None, **kwargs):
+        self._record('put_object', Key)
+        if IfMatch and (Key not in self.objects or self._etag(Key) != IfMatch) or IfNoneMatch and Key in self.objects:
+            raise ClientError(error_response={'Error': {'Code': 'PreconditionFailed'}}, operation_name='PutObject')
+        # Like botocore, accept bytes, a bytearray or a file object, but not a memoryview.
+        body = bytes(Body) if isinstance(Body, (bytes, bytearray)) else Body.read()
+        self._verify(body, ContentMD5)
+        self._put(Key, body)
+        return {'ETag': self._etag(Key)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._record('head_object', Key)
+        return {'ETag': self._etag(Key), 'ContentLength': len(self._get(Key))}
+
+    def copy(self, CopySource, Bucket, Key, Config=None, **kwargs):
+        # Like boto3's managed copy, get the size of the source, then copy it in one or more requests.
+        threshold = Config.multipart_threshold if Config else MULTIPART_THRESHOLD
+        chunksize = Config.multipart_chunksize if Config else MULTIPART_THRESHOLD
+        body = self.head_object(Bucket, CopySource['Key']) and self._get(CopySource['Key'])
+        if len(body) >= threshold:
+            self._record('create_multipart_upload', Key)
+            for _ in range(0, len(body), chunksize):
+                self._record('upload_part_copy', Key)
+            self._record('complete_multipart_upload', Key)
+            self._put(Key, body, _composite([body[i:i + chunksize] for i in range(0, len(body), chunksize)]))
+        else:
+            self._record('copy_object', Key)
+            self._put(Key, body)
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self._record('get_object', Key)
+        body = self._get(Key)
+        if Range:
+            start, end = Range[len('bytes='):].split('-')
+            body = body[int(start):int(end) + 1]
+        return {'Body': io.BytesIO(body), 'ETag': self._etag(Key)}
+
+    def delete_object(self, Bucket, Key, IfMatch=None, **kwargs):
+        self._record('delete_object', Key)
+        if IfMatch and Key in self.objects and self._etag(Key) != IfMatch:
+            raise ClientError(error_response={'Error': {'Code': 'PreconditionFailed'}}, operation_name='DeleteObject')
+        self.objects.pop(Key, None)
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        self._record('download_fileobj', Key)
+        Fileobj.write(self._get(Key))
+
+    def list_objects_v2(self, Bucket, Prefix='', **kwargs):
+        self._record('list_objects_v2', Prefix)
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        return {
+            'KeyCount': len(keys),
+            'Contents': [{'Key': key, 'Size': len(self.objects[key]), 'ETag': self._etag(key),
+                          'LastModified': self.modified.get(key, datetime.now(timezone.utc))} for key in keys],
+        }
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._record('create_multipart_upload', Key)
+        upload_id = f'upload-{len(self.requests)}'
+        self.uploads[upload_id] = {'Key': Key, 'Parts': {}, 'Initiated': datetime.now(timezone.utc)}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentMD5=None, **kwargs):
+        self._record('upload_part', Key)
+        upload = self._get_upload(UploadId)
+        self._verify(Body, ContentMD5)
+        # The body might be a buffer that is reused for the next part.
+        upload['Parts'][PartNumber] = bytes(Body)
+        return {'ETag': f'"{hashlib.md5(Body).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, IfMatch=None, IfNoneMatch=None,
+                                  **kwargs):
+        self._record('complete_multipart_upload', Key)
+        if IfMatch and (Key not in self.objects or self._etag(Key) != IfMatch) or IfNoneMatch and Key in self.objects:
+            raise ClientError(error_response={'Error': {'Code': 'PreconditionFailed'}},
+                              operation_name='CompleteMultipartUpload')
+        upload = self._get_upload(UploadId)
+        parts = [upload['Parts'][part['PartNumber']] for part in MultipartUpload['Parts']]
+        self._put(Key, b''.join(parts), _composite(parts))
+        del self.uploads[UploadId]
+        return {'ETag': self._etag(Key)}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._record('abort_multipart_upload', Key)
+        self._get_upload(UploadId)
+        del self.uploads[UploadId]
+
+    def list_multipart_uploads(self, Bucket, Prefix='', **kwargs):
+        self._record('list_multipart_uploads', Prefix)
+        return {
+            'Uploads': [{'Key': upload['Key'], 'UploadId': upload_id, 'Initiated': upload['Initiated']}
+                        for upload_id, upload in self.uploads.items() if upload['Key'].startswith(Prefix)],
+        }
+
+    def _get_upload(self, upload_id):
+        try:
+            return self.uploads[upload_id]
+        except KeyError:
+            raise ClientError(error_response={'Error': {'Code': 'NoSuchUpload'}}, operation_name='')
+
+    def _put(self, key, body, etag=None):
+        self.objects[key] = body
+        self.modified.pop(key, None)
+        if etag:
+            self.etags[key] = etag
+        else:
+            self.etags.pop(key, None)
+
+    def _verify(self, body, content_md5):
+        # Like Amazon S3, reject a body that doesn't match its Content-MD5 header.
+        if content_md5 and base64.b64encode(hashlib.md5(body).digest()).decode() != content_md5:
+            raise ClientError(error_response={'Error': {'Code': 'BadDigest'}}, operation_name='')
+
+    def _etag(self, key):
+        body = self._get(key)
+        return self.etags.get(key) or f'"{hashlib.md5(body).hexdigest()}"'
+
+    def _get(self, key):
+        try:
+            return self.objects[key]
+        except KeyError:
+            raise ClientError(error_response={'Error': {'Code': '404'}}, operation_name='')
+
+
+def _composite(parts):
+    # The ETag of an object uploaded in parts.
+    digests = b''.join(hashlib.md5(part).digest() for part in parts)
+    return f'"{hashlib.md5(digests).hexdigest()}-{len(parts)}"'
@@ -1,10 +1,22 @@
+import datetime
+import hashlib
+import json
 import os
+import tempfile
 
+import pytest
 from botocore.exceptions import ClientError
 from botocore.stub import Stubber
 
 import ocdskingfisherarchive.s3
-from tests import create_crawl_directory
+from ocdskingfisherarchive.audit import MISMATCH, OK, Auditor
+from ocdskingfisherarchive.crawl import Crawl
+from ocdskingfisherarchive.lease import Leases
+from ocdskingfisherarchive.restore import restore
+from ocdskingfisherarchive.shard import Shard
+from ocdskingfisherarchive.storage import AsyncStorage
+from tests import create_crawl, create_crawl_directory
+from tests.stand_in import S3StandIn
 
 
 def test_process_crawl(archiver, tmpdir, caplog, monkeypatch):
@@ -14,16 +26,21 @@ def test_process_crawl(archiver, tmpdir, caplog, monkeypatch):
     def list_objects_v2(*args, **kwargs):
         return {'KeyCount': 0}
 
+    def list_multipart_uploads(*args, **kwargs):
+        return {}
+
     create_crawl_directory(tmpdir, ['data.json'], 'log_error1.log')
     os.utime(tmpdir.join('data', 'scotland', '20200902_052458'), (1, 1))
 
     stubber = Stubber(ocdskingfisherarchive.s3.client)
     monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stubber)
     # See https://github.com/boto/botocore/issues/974
-    for method in ('upload_file', 'copy', 'delete_object'):
+    for method in ('put_object', 'copy', 'delete_object'):
         monkeypatch.setattr(stubber, method, lambda *args, **kwargs: None, raising=False)
     monkeypatch.setattr(stubber, 'download_fileobj', download_fileobj, raising=False)
+    monkeypatch.setattr(stubber, 'get_object', download_fileobj, raising=False)
     monkeypatch.setattr(stubber, 'list_objects_v2', list_objects_v2, raising=False)
+    monkeypatch.setattr(stubber, 'list_multipart_uploads', list_multipart_uploads, raising=False)
     stubber.activate()
 
     archiver.run()
@@ -42,3 +59,429 @@ def test_process_crawl(archiver, tmpdir, caplog, monkeypatch):
     assert filenames == {'cache.sqlite3'}
     assert directories == {'data', os.path.join('data', 'scotland'), 'logs', os.path.join('logs', 'kingfisher'),
                            os.path.join('logs', 'kingfisher', 'scotland')}
+
+
+@pytest.mark.parametrize('asynchronous', [False, True])
+def test_run(asynchronous, archiver, tmpdir, monkeypatch):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    archiver.asynchronous = asynchronous
+    archiver.async_s3 = AsyncStorage(archiver.s3)
+
+    # An archived crawl from an earlier month, with identical data.
+    create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'})
+    archiver.run()
+    # Crawls in the same month.
+    create_crawl(tmpdir, '20200902_000000', {'a.json': 'a'})
+    create_crawl(tmpdir, '20201001_000000', {'a.json': 'a', 'b.json': 'b'})
+    create_crawl(tmpdir, '20201002_000000', {'a.json': 'a', 'b.json': 'b', 'c.json': 'c'})
+    # Another source.
+    create_crawl(tmpdir, '20200902_000000', {'a.json': 'a'}, source_id='wales')
+    archiver.run()
+
+    # The thread pool is shut down at the end of each run.
+    assert archiver.async_s3.executor is None
+    assert sorted(stand_in.objects) == [
+        'scotland/2020/08/data.tar.lz4',
+        'scotland/2020/08/metadata.json',
+        'scotland/2020/08/scrapy.log',
+        'scotland/2020/10/data.tar.lz4',
+        'scotland/2020/10/metadata.json',
+        'scotland/2020/10/scrapy.log',
+        'wales/2020/09/data.tar.lz4',
+        'wales/2020/09/metadata.json',
+        'wales/2020/09/scrapy.log',
+    ]
+    assert stand_in.objects['scotland/2020/10/metadata.json'].count(b'20201002_000000')
+
+    # The metadata file records the checksums of the other files, which match the ETags of the copied objects.
+    metadata = json.loads(stand_in.objects['scotland/2020/10/metadata.json'])
+    assert {name: f'"{checksum}"' for name, checksum in metadata['checksums'].items()} == {
+        'data.tar.lz4': stand_in._etag('scotland/2020/10/data.tar.lz4'),
+        'scrapy.log': stand_in._etag('scotland/2020/10/scrapy.log'),
+    }
+    assert sorted(os.listdir(tmpdir.join('data', 'scotland'))) == ['20200902_000000', '20201001_000000']
+    assert os.listdir(tmpdir.join('data', 'wales')) == []
+
+
+def test_run_pipeline_failure(archiver, tmpdir, monkeypatch, caplog):
+    class FailingStandIn(S3StandIn):
+        def put_object(self, Bucket, Key, Body, **kwargs):
+            if Key.startswith('staging/wales/'):
+                raise ClientError(error_response={'Error': {'Code': '500'}}, operation_name='')
+            return super().put_object(Bucket, Key, Body, **kwargs)
+
+    stand_in = FailingStandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir.mkdir('tmp')))
+    # Exercise the backpressure: there is space only if no compressed files are waiting to be uploaded.
+    monkeypatch.setattr(archiver, '_has_space', lambda crawl: not os.listdir(tmpdir.join('tmp')))
+    archiver.asynchronous = True
+    archiver.async_s3 = AsyncStorage(archiver.s3)
+    archiver.queue_size = 2
+
+    # The failing crawl is archived last, so that its leftover files don't affect the others.
+    archiver.scheduler.policy = 'oldest'
+    create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'}, source_id='england')
+    create_crawl(tmpdir, '20200802_000000', {'a.json': 'a'}, source_id='scotland')
+    create_crawl(tmpdir, '20200803_000000', {'a.json': 'a'}, source_id='wales')
+    archiver.run()
+
+    assert sorted(key for key in stand_in.objects if key.endswith('data.tar.lz4')) == [
+        'england/2020/08/data.tar.lz4',
+        'scotland/2020/08/data.tar.lz4',
+    ]
+    assert os.listdir(tmpdir.join('data', 'wales')) == ['20200803_000000']
+    assert len(os.listdir(tmpdir.join('tmp'))) == 2
+    assert 'Failed to archive wales/20200803_000000' in caplog.messages
+
+    # The archival is resumed on the next run.
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', S3StandIn())
+    archiver.run()
+
+    assert ocdskingfisherarchive.s3.client.objects.keys() == {
+        'wales/2020/08/data.tar.lz4',
+        'wales/2020/08/metadata.json',
+        'wales/2020/08/scrapy.log',
+    }
+    assert os.listdir(tmpdir.join('data', 'wales')) == []
+    assert os.listdir(tmpdir.join('tmp')) == []
+
+
+def test_resume(archiver, tmpdir, monkeypatch):
+    class InterruptedStandIn(S3StandIn):
+        def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+            if PartNumber == 3:
+                raise KeyboardInterrupt
+            return super().upload_part(Bucket, Key, UploadId, PartNumber, Body, **kwargs)
+
+    stand_in = InterruptedStandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'PART_SIZE', 64)
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir.mkdir('tmp')))
+
+    content = os.urandom(1000).hex()  # incompressible
+    create_crawl(tmpdir, '20200801_000000', {'a.json': content})
+    # Leftover files from an unrecorded archival.
+    old = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    stand_in.objects['staging/other/2020/01/data.tar.lz4'] = b''
+    stand_in.modified['staging/other/2020/01/data.tar.lz4'] = old
+    upload_id = stand_in.create_multipart_upload(Bucket=None, Key='staging/other/2020/01/data.tar.lz4')['UploadId']
+    stand_in.uploads[upload_id]['Initiated'] = old
+    # Files from another host's archival in progress.
+    stand_in.objects['staging/foreign/2020/01/scrapy.log'] = b''
+    foreign_id = stand_in.create_multipart_upload(Bucket=None, Key='staging/foreign/2020/01/data.tar.lz4')['UploadId']
+
+    with pytest.raises(KeyboardInterrupt):
+        archiver.run()
+
+    assert [archival['state'] for archival in archiver.cache.get_archivals()] == ['compressed']
+    assert ('abort_multipart_upload', 'staging/other/2020/01/data.tar.lz4') in stand_in.requests
+    assert ('delete_object', 'staging/other/2020/01/data.tar.lz4') in stand_in.requests
+    assert foreign_id in stand_in.uploads
+    assert 'staging/foreign/2020/01/scrapy.log' in stand_in.objects
+
+    stand_in.__class__ = S3StandIn
+    stand_in.requests = []
+    archiver.run()
+
+    def parts(key):
+        return -(-len(stand_in.objects[key]) // 64)
+
+    uploaded = [key for operation, key in stand_in.requests if operation == 'upload_part']
+    # The first two parts of the data file were uploaded before the interruption. The metadata file is uploaded last.
+    assert uploaded.count('staging/scotland/2020/08/data.tar.lz4') == parts('scotland/2020/08/data.tar.lz4') - 2
+    assert uploaded.count('staging/scotland/2020/08/metadata.json') == parts('scotland/2020/08/metadata.json')
+    assert ('create_multipart_upload', 'staging/scotland/2020/08/data.tar.lz4') not in stand_in.requests
+    # The checksum of the resumed upload is calculated from the recorded digests of the earlier parts.
+    metadata = json.loads(stand_in.objects['scotland/2020/08/metadata.json'])
+    assert metadata['checksums']['data.tar.lz4'].endswith(f'-{parts("scotland/2020/08/data.tar.lz4")}')
+    assert f'"{metadata["checksums"]["data.tar.lz4"]}"' == stand_in._etag('scotland/2020/08/data.tar.lz4')
+    assert sorted(stand_in.objects) == [
+        'scotland/2020/08/data.tar.lz4',
+        'scotland/2020/08/metadata.json',
+        'scotland/2020/08/scrapy.log',
+        'staging/foreign/2020/01/scrapy.log',
+    ]
+    assert list(stand_in.uploads) == [foreign_id]
+    assert archiver.cache.get_archivals() == []
+    assert archiver.cache.get_uploads() == {}
+    assert os.listdir(tmpdir.join('tmp')) == []
+    assert os.listdir(tmpdir.join('data', 'scotland')) == []
+
+
+@pytest.mark.parametrize('asynchronous', [False, True])
+def test_run_direct(asynchronous, archiver, tmpdir, monkeypatch):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir.mkdir('tmp')))
+    archiver.direct = True
+    archiver.asynchronous = asynchronous
+    archiver.async_s3 = AsyncStorage(archiver.s3)
+    archivals = []
+    set_archival = archiver.cache.set_archival
+    monkeypatch.setattr(archiver.cache, 'set_archival',
+                        lambda crawl, archival: archivals.append(dict(archival)) or set_archival(crawl, archival))
+
+    crawl = create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'})
+    archiver.run()
+
+    assert sorted(stand_in.objects) == [
+        'scotland/2020/08/data.tar.lz4',
+        'scotland/2020/08/metadata.json',
+        'scotland/2020/08/scrapy.log',
+    ]
+    assert not [key for operation, key in stand_in.requests
+                if key.startswith('staging/') and not operation.startswith('list_')]
+    assert ('put_object', 'scotland/2020/08/metadata.json') in stand_in.requests
+
+    metadata = json.loads(stand_in.objects['scotland/2020/08/metadata.json'])
+    assert set(metadata['checksums']) == {'data.tar.lz4', 'scrapy.log'}
+    assert metadata['objects'] == {
+        'data.tar.lz4': {
+            'etag': stand_in._etag('scotland/2020/08/data.tar.lz4'),
+            'size': len(stand_in.objects['scotland/2020/08/data.tar.lz4']),
+        },
+        'scrapy.log': {
+            'etag': stand_in._etag('scotland/2020/08/scrapy.log'),
+            'size': len(stand_in.objects['scotland/2020/08/scrapy.log']),
+        },
+    }
+    assert archiver.s3.load_exact('scotland', crawl.data_version).format_data_version() == '20200801_000000'
+    assert archiver.cache.get_archivals() == []
+    assert os.listdir(tmpdir.join('tmp')) == []
+    # The checksum of the committed metadata file is recorded with the other files' checksums.
+    assert archivals[-1]['checksums'] == {
+        key: hashlib.md5(stand_in.objects[key]).hexdigest() for key in stand_in.objects
+    }
+
+    # A later archival is interrupted after uploading the data file.
+    class InterruptedStandIn(S3StandIn):
+        def put_object(self, Bucket, Key, Body, **kwargs):
+            if Key.endswith('metadata.json'):
+                raise KeyboardInterrupt
+            return super().put_object(Bucket, Key, Body, **kwargs)
+
+    stand_in.__class__ = InterruptedStandIn
+    crawl = create_crawl(tmpdir, '20200802_000000', {'a.json': 'a', 'b.json': 'b'})
+    # In asynchronous mode, the interruption would be raised in a task, which is noisy.
+    archiver.asynchronous = False
+    with pytest.raises(KeyboardInterrupt):
+        archiver.run()
+    archiver.asynchronous = asynchronous
+
+    # The committed archive no longer matches its metadata file, so it is treated as incomplete.
+    assert archiver.s3.load_exact('scotland', crawl.data_version) is None
+
+    # The archival is committed on the next run.
+    stand_in.__class__ = S3StandIn
+    archiver.run()
+
+    assert archiver.s3.load_exact('scotland', crawl.data_version).format_data_version() == '20200802_000000'
+    assert archiver.cache.get_archivals() == []
+
+
+@pytest.mark.parametrize('direct', [False, True])
+def test_run_bundle(direct, archiver, tmpdir, monkeypatch):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir.mkdir('tmp')))
+    archiver.direct = direct
+
+    # A crawl archived as multiple files.
+    create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'})
+    archiver.run()
+
+    archiver.bundle = True
+    stand_in.requests = []
+    archivals = []
+    set_archival = archiver.cache.set_archival
+    monkeypatch.setattr(archiver.cache, 'set_archival',
+                        lambda crawl, archival: archivals.append(dict(archival)) or set_archival(crawl, archival))
+    crawl = create_crawl(tmpdir, '20200802_000000', {'a.json': 'a', 'b.json': 'b'})
+    archiver.run()
+
+    assert sorted(stand_in.objects) == ['scotland/2020/08/archive.bundle']
+    # The bundle is written with one request, or copied with one request from the staging directory.
+    assert [(operation, key) for operation, key in stand_in.requests
+            if key.endswith('/archive.bundle') and operation != 'head_object'] == (
+        [('put_object', 'scotland/2020/08/archive.bundle')] if direct else [
+            ('put_object', 'staging/scotland/2020/08/archive.bundle'),
+            ('copy_object', 'scotland/2020/08/archive.bundle'),
+            ('delete_object', 'staging/scotland/2020/08/archive.bundle'),
+        ]
+    )
+    assert [key for operation, key in stand_in.requests if operation == 'delete_object'][-3:] == [
+        'scotland/2020/08/metadata.json',
+        'scotland/2020/08/data.tar.lz4',
+        'scotland/2020/08/scrapy.log',
+    ]
+    assert archiver.s3.load_exact('scotland', crawl.data_version).format_data_version() == '20200802_000000'
+    assert archiver.s3.get_years_and_months_for_source('scotland') == {2020: {8: True}}
+    assert list(archiver.s3.list_archives()) == ['scotland/2020/08']
+    assert archiver.cache.get_archivals() == []
+    assert os.listdir(tmpdir.join('tmp')) == []
+    assert not os.path.exists(tmpdir.join('logs', 'kingfisher', 'scotland', '20200802_000000.log'))
+
+    bundle = archiver.s3.get_bundle('scotland/2020/08')
+
+    assert bundle.metadata['data_version'] == '20200802_000000'
+    assert list(bundle.members) == ['data.tar.lz4', 'scrapy.log']
+    # The checksum of the bundle is recorded, like the checksums of other files.
+    content = stand_in.objects['scotland/2020/08/archive.bundle']
+    assert archivals[-1]['checksums'] == {'scotland/2020/08/archive.bundle': hashlib.md5(content).hexdigest()}
+    assert Auditor(archiver.s3, archiver.cache).audit('scotland/2020/08') == (OK, bundle.metadata['checksum'])
+
+    restore(archiver.s3, 'scotland', 2020, 8, str(tmpdir.join('restored')))
+
+    assert sorted(os.listdir(tmpdir.join('restored', 'scotland', '20200802_000000'))) == ['a.json', 'b.json']
+
+    # The digest of each member of the bundle is verified.
+    offset, size = bundle.range('scrapy.log')
+    content = bytearray(content)
+    content[offset] ^= 1
+    stand_in.objects['scotland/2020/08/archive.bundle'] = bytes(content)
+
+    assert Auditor(archiver.s3, archiver.cache).audit('scotland/2020/08') == (MISMATCH, None)
+
+
+def test_run_direct_concurrent(archiver, tmpdir, monkeypatch, caplog):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir.mkdir('tmp')))
+    archiver.direct = True
+
+    # Another process commits an archival for the same source and period, after this archival starts.
+    prepare = archiver._prepare
+
+    def concurrent_prepare(crawl):
+        stand_in.objects['scotland/2020/08/metadata.json'] = b'{}'
+        return prepare(crawl)
+
+    monkeypatch.setattr(archiver, '_prepare', concurrent_prepare)
+
+    create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'})
+    archiver.run()
+
+    assert stand_in.objects['scotland/2020/08/metadata.json'] == b'{}'
+    assert 'Abandoning scotland/20200801_000000 (scotland/2020/08/metadata.json was written concurrently ' \
+           "({'IfNoneMatch': '*'}))" in caplog.messages
+    assert archiver.cache.get_archivals() == []
+    assert os.listdir(tmpdir.join('tmp')) == []
+    assert os.listdir(tmpdir.join('data', 'scotland')) == ['20200801_000000']
+
+
+def test_run_streaming(archiver, tmpdir, monkeypatch):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+
+    crawls = [
+        create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'}),
+        create_crawl(tmpdir, '20200802_000000', {'a.json': 'a', 'b.json': 'b'}),
+        create_crawl(tmpdir, '20200901_000000', {'a.json': 'aa'}),
+        create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'}, source_id='wales'),
+        create_crawl(tmpdir, '20200901_000000', {'a.json': 'aa'}, source_id='wales'),
+    ]
+    # The archived crawls, as each crawl is discovered.
+    discovered = []
+
+    def all(data_directory, logs_directory):
+        for crawl in crawls:
+            discovered.append(sorted(key for key in stand_in.objects if key.endswith('data.tar.lz4')))
+            yield crawl
+
+    monkeypatch.setattr(Crawl, 'all', all)
+    archiver.run()
+
+    # Each group is archived as soon as the next group's first crawl is discovered.
+    assert discovered == [
+        [],
+        [],
+        [],
+        ['scotland/2020/08/data.tar.lz4'],
+        ['scotland/2020/08/data.tar.lz4', 'scotland/2020/09/data.tar.lz4'],
+    ]
+    assert sorted(key for key in stand_in.objects if key.endswith('data.tar.lz4')) == [
+        'scotland/2020/08/data.tar.lz4',
+        'scotland/2020/09/data.tar.lz4',
+        'wales/2020/08/data.tar.lz4',
+        'wales/2020/09/data.tar.lz4',
+    ]
+
+
+@pytest.mark.parametrize('asynchronous', [False, True])
+def test_run_sharded(asynchronous, archiver, tmpdir, monkeypatch, caplog):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    archiver.asynchronous = asynchronous
+    archiver.async_s3 = AsyncStorage(archiver.s3)
+    archiver.shard = Shard(0, 2)
+    archiver.leases = Leases(archiver.s3, 'a')
+
+    sources = [f'source_{i}' for i in range(6)]
+    for source_id in sources:
+        create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'}, source_id=source_id)
+    # Another worker holds a lease.
+    held = next(source_id for source_id in sources if archiver.shard.owns(source_id))
+    Leases(archiver.s3, 'b').acquire(f'{held}/2020/08')
+    # Leftover files from another worker's archival.
+    other = next(source_id for source_id in sources if not archiver.shard.owns(source_id))
+    stand_in.objects[f'staging/{other}/2020/08/data.tar.lz4'] = b''
+    stand_in.objects[f'staging/{held}/2020/08/data.tar.lz4'] = b''
+
+    archiver.run()
+
+    archived = sorted(key.split('/')[0] for key in stand_in.objects if key.endswith('/metadata.json'))
+    assert archived == [source_id for source_id in sources if archiver.shard.owns(source_id) and source_id != held]
+    assert f'Skipping {held}/2020/08, because b holds its lease' in caplog.messages
+    assert sorted(key for key in stand_in.objects if key.startswith(('leases/', 'staging/'))) == sorted([
+        f'leases/{held}/2020/08.json',
+        f'staging/{held}/2020/08/data.tar.lz4',
+        f'staging/{other}/2020/08/data.tar.lz4',
+    ])
+
+
+def test_run_report(archiver, tmpdir, monkeypatch):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+
+    create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'})
+    create_crawl(tmpdir, '20200802_000000', {'a.json': 'a'})
+    archiver.run()
+
+    sources = archiver.cache.get_sources()
+    data = stand_in.objects['scotland/2020/08/data.tar.lz4']
+
+    assert sources['scotland']['archived']['crawls'] == 1
+    assert sources['scotland']['archived']['compressed_bytes'] == len(data)
+    assert sources['scotland']['ignored'] == {'crawls': 1, 'bytes': 1}
+    assert sources['scotland']['pending'] == {'crawls': 0, 'bytes': 0}
+
+
+def test_run_expire(archiver, tmpdir, monkeypatch):
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', S3StandIn())
+
+    create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'})
+    create_crawl(tmpdir, '20200802_000000', {'a.json': 'a'})
+    archiver.run()
+
+    # The ignored crawl is kept for the retention period.
+    assert os.listdir(tmpdir.join('data', 'scotland')) == ['20200802_000000']
+
+    archiver.run()
+
+    assert os.listdir(tmpdir.join('data', 'scotland')) == ['20200802_000000']
+
+    # The retention period passes.
+    archiver.cache.conn.execute("UPDATE crawl SET evaluated_at = '2020-01-01T00:00:00Z'")
+    archiver.run()
+
+    assert os.listdir(tmpdir.join('data', 'scotland')) == []
+    assert os.listdir(tmpdir.join('logs', 'kingfisher', 'scotland')) == []
+    assert os.listdir(tmpdir.join('data')) == ['scotland']
+    assert archiver.cache.get_expired(archiver.retention_seconds) == []
+
+
+def test_reclaim_directory(archiver, tmpdir):
+    # Crawl directories are moved outside the data directory, beside it, to stay on the same filesystem.
+    assert archiver.reclaimer.directory == str(tmpdir.join('.reclaim'))
@@ -0,0 +1,108 @@
+import json
+import os
+
+import pytest
+
+import ocdskingfisherarchive.s3
+from ocdskingfisherarchive.audit import Auditor, checksum
+from ocdskingfisherarchive.restore import _strip
+from ocdskingfisherarchive.tarfile import LZ4TarFile
+from tests import create_crawl
+from tests.stand_in import S3StandIn
+
+
+@pytest.fixture()
+def stand_in(monkeypatch):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    return stand_in
+
+
+@pytest.mark.parametrize('buffer_size,passes', [(0, 4), (1024, 2)])
+def test_checksum(buffer_size, passes, archiver, stand_in, tmpdir):
+    # Archives written by TarFile.add() store sub-directories' files before later files, and "b/e.json" before
+    # "c.json". The checksum reads them in the order: "a.json", "d.json", "child/c.json", "child/b/e.json".
+    files = {'a.json': 'a', os.path.join('child', 'c.json'): 'c', 'd.json': 'd',
+             os.path.join('child', 'b', 'e.json'): 'e'}
+    crawl = create_crawl(tmpdir, '20200801_000000', files)
+    expected = crawl.checksum
+    filename = str(tmpdir.join('data.tar.lz4'))
+    with LZ4TarFile.open(filename, 'w:lz4') as tar:
+        tar.add(crawl.local_directory)
+    with open(filename, 'rb') as f:
+        stand_in.objects['scotland/2020/08/data.tar.lz4'] = f.read()
+
+    actual = checksum(archiver.s3, 'scotland/2020/08/data.tar.lz4',
+                      lambda name: _strip(name, 'scotland/20200801_000000'), buffer_size=buffer_size)
+
+    assert actual == expected
+    # The archive is read once to list its members, then again to read them in order. Without a buffer, it is read
+    # again for each member that is stored before an earlier member.
+    assert stand_in.requests.count(('get_object', 'scotland/2020/08/data.tar.lz4')) == passes
+
+
+def test_checksum_walk_order(archiver, stand_in, tmpdir):
+    files = {'a.json': 'a', os.path.join('child', 'c.json'): 'c', 'd.json': 'd',
+             os.path.join('child', 'b', 'e.json'): 'e'}
+    crawl = create_crawl(tmpdir, '20200801_000000', files)
+    expected = crawl.checksum
+    archiver.archive(crawl)
+    del stand_in.requests[:]
+
+    actual = checksum(archiver.s3, 'scotland/2020/08/data.tar.lz4',
+                      lambda name: _strip(name, 'scotland/20200801_000000'), buffer_size=0)
+
+    assert actual == expected
+    # Archives are written in the order in which the checksum is calculated, so they are read once.
+    assert stand_in.requests.count(('get_object', 'scotland/2020/08/data.tar.lz4')) == 1
+
+
+@pytest.mark.parametrize('deduplicate', [True, False])
+def test_run(deduplicate, archiver, stand_in, tmpdir):
+    archiver.deduplicate = deduplicate
+    archiver.archive(create_crawl(tmpdir, '20200801_000000', {'a.json': 'a', 'b.json': 'b'}))
+    archiver.archive(create_crawl(tmpdir, '20200902_000000', {'a.json': 'a', os.path.join('child', 'c.json'): 'c',
+                                                              'd.json': 'd'}))
+    archiver.archive(create_crawl(tmpdir, '20201001_000000', {'a.json': 'A'}))
+
+    auditor = Auditor(archiver.s3, archiver.cache, jobs=2, range_size=64)
+
+    assert auditor.run() == {'scotland/2020/08': 'ok', 'scotland/2020/09': 'ok', 'scotland/2020/10': 'ok'}
+    assert {key: value['status'] for key, value in archiver.cache.get_audits().items()} == {
+        'scotland/2020/08': 'ok',
+        'scotland/2020/09': 'ok',
+        'scotland/2020/10': 'ok',
+    }
+
+    # The audit is resumed.
+    assert auditor.run() == {}
+
+    # Archived crawls are changed.
+    metadata = json.loads(stand_in.objects['scotland/2020/08/metadata.json'])
+    metadata['checksum'] = '0' * 32
+    stand_in.objects['scotland/2020/08/metadata.json'] = json.dumps(metadata).encode()
+    if deduplicate:
+        stand_in.objects['scotland/2020/09/data-20200902_000000.tar.lz4'] = b'corrupt'
+    else:
+        del stand_in.objects['scotland/2020/09/data.tar.lz4']
+
+    assert auditor.run() == {'scotland/2020/08': 'ok' if deduplicate else 'mismatch'}
+    assert auditor.run(force=True) == {
+        'scotland/2020/08': 'ok' if deduplicate else 'mismatch',
+        'scotland/2020/09': 'corrupt' if deduplicate else 'missing',
+        'scotland/2020/10': 'ok',
+    }
+
+
+def test_run_sample(archiver, stand_in, tmpdir):
+    for data_version in ('20200801_000000', '20200902_000000', '20201001_000000'):
+        archiver.archive(create_crawl(tmpdir, data_version, {'a.json': data_version}))
+
+    auditor = Auditor(archiver.s3, archiver.cache)
+
+    first = auditor.run(sample=2, seed=1)
+    second = auditor.run(sample=2, seed=1)
+
+    assert len(first) == 2
+    assert len(second) == 1
+    assert sorted([*first, *second]) == ['scotland/2020/08', 'scotland/2020/09', 'scotland/2020/10']
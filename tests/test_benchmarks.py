@@ -0,0 +1,25 @@
+from benchmarks.generate import generate
+from benchmarks.startup import parse_importtime
+from ocdskingfisherarchive.crawl import Crawl
+
+
+def test_generate(tmpdir):
+    data_directory, logs_directory = generate(str(tmpdir), sources=2, months=2, crawls_per_month=2, files=10,
+                                              file_size=100, errors=3)
+
+    crawls = sorted(Crawl.all(data_directory, logs_directory), key=lambda crawl: (crawl.source_id, crawl.data_version))
+
+    assert len(crawls) == 8
+    assert [crawl.reject_reason for crawl in crawls] == [None] * 8
+    assert [crawl.files_count for crawl in crawls[:4]] == [11, 12, 13, 14]
+    assert [crawl.errors_count for crawl in crawls[:4]] == [3, 3, 3, 3]
+    assert crawls[0].checksum != crawls[1].checksum
+
+
+def test_parse_importtime():
+    stderr = """import time: self [us] | cumulative | imported package
+import time:       100 |        100 |   b
+import time:       200 |        300 | a
+"""
+
+    assert parse_importtime(stderr) == [('  b', 100, 100), ('a', 200, 300)]
@@ -0,0 +1,125 @@
+import io
+import os
+
+import pytest
+
+import ocdskingfisherarchive.s3
+from ocdskingfisherarchive.buffers import BufferPool, pool
+from ocdskingfisherarchive.tarfile import LZ4TarFile
+from tests.stand_in import S3StandIn
+
+
+@pytest.fixture()
+def advice(monkeypatch):
+    advice = []
+    monkeypatch.setattr(os, 'posix_fadvise', lambda fd, offset, length, value: advice.append(value), raising=False)
+    monkeypatch.setattr(os, 'POSIX_FADV_SEQUENTIAL', 2, raising=False)
+    monkeypatch.setattr(os, 'POSIX_FADV_DONTNEED', 4, raising=False)
+    return advice
+
+
+@pytest.fixture()
+def reset():
+    yield
+    pool.configure()
+
+
+def test_buffer():
+    instance = BufferPool()
+    instance.configure(block_size=16)
+
+    with instance.buffer() as first:
+        with instance.buffer() as second:
+            assert first is not second
+            assert len(first) == 16
+
+    # Buffers are reused.
+    with instance.buffer() as third:
+        assert third is second or third is first
+
+    with instance.buffer(32) as other:
+        assert len(other) == 32
+
+
+@pytest.mark.parametrize('size,expected', [(None, [b'0123', b'4567', b'89']), (6, [b'0123', b'45'])])
+def test_read_blocks(size, expected):
+    instance = BufferPool()
+    instance.configure(block_size=4)
+
+    blocks = [bytes(block) for block in instance.read_blocks(io.BytesIO(b'0123456789'), size)]
+
+    assert blocks == expected
+
+
+def test_readinto():
+    class ShortReader(io.RawIOBase):
+        def __init__(self, data):
+            self.data = data
+
+        def readinto(self, buffer):
+            # Read at most 3 bytes at a time.
+            count = min(3, len(buffer), len(self.data))
+            buffer[:count] = self.data[:count]
+            self.data = self.data[count:]
+            return count
+
+    buffer = bytearray(8)
+
+    assert pool.readinto(ShortReader(b'0123456789'), buffer) == 8
+    assert buffer == b'01234567'
+    assert pool.readinto(ShortReader(b'01'), buffer) == 2
+
+
+@pytest.mark.parametrize('drop_cache,expected', [(True, [2, 4]), (False, [2])])
+def test_open(drop_cache, expected, advice, tmpdir, reset):
+    tmpdir.join('file').write('x')
+    pool.configure(drop_cache=drop_cache)
+
+    with pool.open(str(tmpdir.join('file'))) as f:
+        assert f.read() == b'x'
+
+    assert advice == expected
+
+
+def test_tarfile(advice, tmpdir, reset):
+    pool.configure(block_size=64)
+    tmpdir.join('file').write('x' * 1000)
+    tmpdir.join('empty').write('')
+
+    with LZ4TarFile.open(str(tmpdir.join('archive.tar.lz4')), 'w:lz4') as tar:
+        tar.add(str(tmpdir.join('file')), 'file')
+        tar.add(str(tmpdir.join('empty')), 'empty')
+        tar.addfile(tar.gettarinfo(str(tmpdir.join('file')), 'copy'), io.BytesIO(b'y' * 1000))
+
+    with LZ4TarFile.open(str(tmpdir.join('archive.tar.lz4')), 'r:lz4') as tar:
+        assert [(tarinfo.name, tar.extractfile(tarinfo).read()) for tarinfo in tar] == [
+            ('file', b'x' * 1000),
+            ('empty', b''),
+            ('copy', b'y' * 1000),
+        ]
+
+    # The added files are advised as sequential, then dropped from the page cache.
+    assert advice[:4] == [2, 4, 2, 4]
+
+
+def test_tarfile_short(tmpdir):
+    tmpdir.join('file').write('x' * 10)
+
+    with LZ4TarFile.open(str(tmpdir.join('archive.tar.lz4')), 'w:lz4') as tar:
+        tarinfo = tar.gettarinfo(str(tmpdir.join('file')), 'file')
+        tarinfo.size = 20
+        with pytest.raises(OSError, match='unexpected end of data'):
+            tar.addfile(tarinfo, io.BytesIO(b'x' * 10))
+
+
+def test_upload_parts(monkeypatch, archiver, tmpdir):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'PART_SIZE', 4)
+    tmpdir.join('file').write('0123456789')
+
+    archiver.s3.upload_file(str(tmpdir.join('file')), 'file', journal=archiver.cache)
+
+    # The parts are read into the same buffer, and are uploaded intact.
+    assert stand_in.objects['file'] == b'0123456789'
+    assert stand_in.requests.count(('upload_part', 'file')) == 3
@@ -0,0 +1,67 @@
+import hashlib
+import os
+
+import pytest
+
+from ocdskingfisherarchive.bundle import PREFIX, Bundle
+
+
+@pytest.fixture()
+def members(tmpdir):
+    tmpdir.join('scrapy.log').write_binary(b'log')
+    tmpdir.join('data.tar.lz4').write_binary(b'data' * 100)
+    return {'scrapy.log': str(tmpdir.join('scrapy.log')), 'data.tar.lz4': str(tmpdir.join('data.tar.lz4'))}
+
+
+def test_write_file(members):
+    filename = Bundle.write_file({'source_id': 'scotland', 'checksum': 'abc'}, members)
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    finally:
+        os.unlink(filename)
+
+    bundle = Bundle.from_header(data)
+
+    assert bundle.metadata == {'source_id': 'scotland', 'checksum': 'abc'}
+    assert list(bundle.members) == ['data.tar.lz4', 'scrapy.log']
+    assert bundle.header_size == Bundle.get_header_size(data[:PREFIX.size])
+    assert len(data) == bundle.header_size + 3 + 400
+    for name, expected in (('scrapy.log', b'log'), ('data.tar.lz4', b'data' * 100)):
+        offset, size = bundle.range(name)
+        assert data[offset:offset + size] == expected
+        assert bundle.members[name]['md5'] == hashlib.md5(expected).hexdigest()
+
+
+def test_from_header_extra_bytes(members):
+    filename = Bundle.write_file({}, members)
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    finally:
+        os.unlink(filename)
+
+    # The header is read with a ranged request that can include the start of the members.
+    assert Bundle.from_header(data[:-1]).members == Bundle.from_header(data).members
+
+
+@pytest.mark.parametrize('data,message', [
+    (b'KFBUNDLE', 'Truncated bundle'),
+    (PREFIX.pack(b'KFBUNDLE', 10) + b'{}', 'Truncated bundle'),
+    (PREFIX.pack(b'PK\x03\x04\x00\x00\x00\x00', 2) + b'{}', 'Not a bundle'),
+])
+def test_from_header_invalid(data, message):
+    with pytest.raises(ValueError) as excinfo:
+        Bundle.from_header(data)
+
+    assert str(excinfo.value) == message
+
+
+def test_write_file_short(members, tmpdir, monkeypatch):
+    monkeypatch.setattr(os.path, 'getsize', lambda path: 1000)
+    monkeypatch.setattr('tempfile.tempdir', str(tmpdir.mkdir('tmp')))
+
+    with pytest.raises(OSError):
+        Bundle.write_file({}, members)
+
+    assert os.listdir(tmpdir.join('tmp')) == []
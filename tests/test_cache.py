@@ -1,3 +1,5 @@
+import sqlite3
+
 from ocdskingfisherarchive.cache import Cache
 from ocdskingfisherarchive.crawl import Crawl
 
@@ -32,6 +34,7 @@ def test_cache(tmpdir):
         'files_count': None,
         'reject_reason': 'no_data_directory',
         'archived': True,
+        'fingerprint': None,
     }
 
     # Set and get existing.
@@ -49,9 +52,139 @@ def test_cache(tmpdir):
         'files_count': None,
         'reject_reason': 'no_data_directory',
         'archived': False,
+        'fingerprint': None,
     }
 
     # Delete.
     cache.delete(crawl)
 
     assert cache.get(query) == query
+
+
+def test_cache_fingerprint(tmpdir):
+    query = Crawl('scotland', '20200902_052458')
+
+    crawl = Crawl('scotland', '20200902_052458', tmpdir, None)
+    crawl.fingerprint
+
+    cache = Cache(str(tmpdir.join('cache.sqlite3')))
+    cache.set(crawl)
+
+    assert cache.get(query).fingerprint == {
+        'files': 0,
+        'bytes': 0,
+        'manifest': '99aa06d3014798d86001c324468d497f',
+        'sample': '99aa06d3014798d86001c324468d497f',
+    }
+
+
+def test_cache_migration(tmpdir):
+    filename = str(tmpdir.join('cache.sqlite3'))
+    conn = sqlite3.connect(filename)
+    conn.execute("""
+        CREATE TABLE crawl (
+            id TEXT PRIMARY KEY NOT NULL,
+            source_id TEXT NOT NULL,
+            data_version TEXT NOT NULL,
+            bytes INTEGER,
+            checksum TEXT,
+            files_count INTEGER,
+            errors_count INTEGER,
+            reject_reason TEXT,
+            archived BOOLEAN,
+            UNIQUE (source_id, data_version)
+        )
+    """)
+    conn.execute("INSERT INTO crawl (id, source_id, data_version, archived) "
+                 "VALUES ('scotland/20200902_052458', 'scotland', '20200902_052458', 1)")
+    conn.commit()
+    conn.close()
+
+    crawl = Cache(filename).get(Crawl('scotland', '20200902_052458'))
+
+    assert crawl.archived is True
+    assert crawl.fingerprint is None
+
+
+def test_cache_expired(tmpdir):
+    crawl = Crawl('scotland', '20200902_052458', tmpdir, None)
+    crawl.archived = True
+
+    Cache(str(tmpdir.join('cache.sqlite3'))).set(crawl)
+
+    query = Crawl('scotland', '20200902_052458')
+
+    assert Cache(str(tmpdir.join('cache.sqlite3')), expired=True).get(query) is query
+
+
+def test_cache_report(tmpdir):
+    cache = Cache(str(tmpdir.join('cache.sqlite3')))
+
+    pending = Crawl('scotland', '20200902_052458', bytes=10)
+    cache.set(pending)
+    evaluated_at = cache.conn.execute("SELECT evaluated_at FROM crawl").fetchone()[0]
+    cache.set(Crawl('scotland', '20200801_000000', bytes=20, archived=False))
+    cache.set(Crawl('scotland', '20200701_000000', bytes=30, reject_reason='no_data_directory', archived=False))
+    cache.set(Crawl('wales', '20200902_052458', bytes=40))
+    cache.set_archived(Crawl('wales', '20200902_052458'), 4)
+    # An archival that was resumed from before crawls were recorded.
+    cache.set_archived(Crawl('wales', '20200801_000000'), 3)
+
+    # The time of the first evaluation is kept.
+    cache.set(pending)
+
+    assert cache.conn.execute("SELECT evaluated_at FROM crawl WHERE id = 'scotland/20200902_052458'").fetchone()[0] \
+        == evaluated_at
+    # Archived crawls are ignored.
+    query = Crawl('wales', '20200902_052458')
+    assert cache.get(query) is query
+
+    sources = cache.get_sources()
+
+    assert list(sources) == ['scotland', 'wales']
+    assert sources['scotland']['pending'] == {'crawls': 1, 'bytes': 10}
+    assert sources['scotland']['ignored'] == {'crawls': 1, 'bytes': 20}
+    assert sources['scotland']['rejected'] == {'crawls': 1, 'bytes': 30}
+    assert sources['scotland']['archived']['crawls'] == 0
+    assert sources['wales']['archived']['crawls'] == 2
+    assert sources['wales']['archived']['bytes'] == 40
+    assert sources['wales']['archived']['compressed_bytes'] == 7
+    assert sources['wales']['archived']['last_archived_at'].endswith('Z')
+
+    assert list(cache.get_sources('wales')) == ['wales']
+    assert [(crawl['source_id'], crawl['data_version'], crawl['reject_reason']) for crawl in cache.get_rejected()] == [
+        ('scotland', '20200701_000000', 'no_data_directory'),
+    ]
+    assert cache.get_rejected('wales') == []
+    assert [(crawl['source_id'], crawl['data_version'], crawl['bytes']) for crawl in cache.get_crawls()] == [
+        ('scotland', '20200801_000000', 20),
+        ('scotland', '20200902_052458', 10),
+        ('wales', '20200801_000000', None),
+        ('wales', '20200902_052458', 40),
+    ]
+    assert [crawl['data_version'] for crawl in cache.get_crawls('wales')] == ['20200801_000000', '20200902_052458']
+
+    indexes = {row[0] for row in cache.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {'crawl_source_id_idx', 'crawl_archived_idx', 'crawl_reject_reason_idx'} <= indexes
+
+
+def test_cache_expired_crawls(tmpdir):
+    cache = Cache(str(tmpdir.join('cache.sqlite3')))
+
+    cache.set(Crawl('scotland', '20200801_000000', archived=False))
+    cache.set(Crawl('scotland', '20200802_000000', reject_reason='no_data_directory', archived=False))
+    cache.set(Crawl('scotland', '20200901_000000', archived=False))
+    cache.set(Crawl('scotland', '20201001_000000'))
+    cache.conn.execute("UPDATE crawl SET evaluated_at = '2020-01-01T00:00:00Z'")
+    # A crawl evaluated before the time of evaluation was recorded.
+    cache.conn.execute("UPDATE crawl SET evaluated_at = NULL WHERE data_version = '20200901_000000'")
+
+    assert cache.get_expired(86400) == [('scotland', '20200801_000000'), ('scotland', '20200802_000000')]
+
+    cache.set_deleted(Crawl('scotland', '20200801_000000'))
+
+    assert cache.get_expired(86400) == [('scotland', '20200802_000000')]
+    # The crawl evaluated before the time of evaluation was recorded is recorded as evaluated now.
+    assert cache.conn.execute(
+        "SELECT evaluated_at FROM crawl WHERE data_version = '20200901_000000'"
+    ).fetchone()[0].endswith('Z')
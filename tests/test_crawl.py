@@ -7,13 +7,21 @@ from xxhash import xxh3_128
 
 from ocdskingfisherarchive.crawl import Crawl
 from ocdskingfisherarchive.exceptions import FutureDataVersionError, SourceMismatchError
-from tests import crawl_fixture, create_crawl_directory, path
+from ocdskingfisherarchive.tarfile import LZ4TarFile
+from tests import crawl_fixture, create_crawl, create_crawl_directory, path
 
 with open(path('data.json'), 'rb') as f:
     checksum = xxh3_128(f.read()).hexdigest()
 
 size = 239
 
+fingerprint = {
+    'files': 1,
+    'bytes': size,
+    'manifest': '2a2cb98b048d7ca470ad3d9a6e217ddd',
+    'sample': checksum,
+}
+
 current_time = time.time()
 
 
@@ -37,6 +45,21 @@ def test_all(mtime, expected, tmpdir, caplog):
                                                              '307e8331edc801c691e21690db130256.log')
 
 
+def test_all_sorted(tmpdir):
+    for source_id, data_version in (('wales', '20200801_000000'), ('scotland', '20200902_000000'),
+                                    ('scotland', '20200801_000000'), ('england', '20201001_000000')):
+        create_crawl(tmpdir, data_version, {'a.json': 'a'}, source_id=source_id)
+
+    crawls = Crawl.all(tmpdir.join('data'), tmpdir.join('logs', 'kingfisher'))
+
+    assert [str(crawl) for crawl in crawls] == [
+        'england/20201001_000000',
+        'scotland/20200801_000000',
+        'scotland/20200902_000000',
+        'wales/20200801_000000',
+    ]
+
+
 def test_all_not_existing(tmpdir):
     assert list(Crawl.all(tmpdir, None)) == []
 
@@ -54,6 +77,12 @@ def test_all_spider_sample(tmpdir):
     assert list(Crawl.all(tmpdir.join('data'), tmpdir.join('logs', 'kingfisher'))) == []
 
 
+def test_all_hidden_directory(tmpdir):
+    create_crawl_directory(tmpdir, ['data.json'], 'log_error1.log', source_id='.reclaim')
+
+    assert list(Crawl.all(tmpdir.join('data'), tmpdir.join('logs', 'kingfisher'))) == []
+
+
 def test_all_crawl_file(tmpdir):
     file = tmpdir.mkdir('source_id').join('20200902_052458')
     file.write('content')
@@ -165,6 +194,24 @@ def test_reject_reason_cached(tmpdir):
     (['data.json'], 'log_error1.log',
      {'data_version': '20200101_000000', 'bytes': size + 1, 'errors_count': 0, 'files_count': 2},
      (False, '2020_1_not_distinct_maybe')),
+    # Identical fingerprint
+    (['data.json'], 'log_error1.log',
+     {'data_version': '20200101_000000', 'checksum': checksum, 'bytes': size, 'errors_count': 1, 'files_count': 2,
+      'fingerprint': fingerprint},
+     (False, '2020_1_not_distinct')),
+    # Distinct fingerprint (the checksum isn't compared)
+    (['data.json'], 'log_error1.log',
+     {'data_version': '20200101_000000', 'checksum': checksum, 'bytes': size, 'errors_count': 1, 'files_count': 2,
+      'fingerprint': dict(fingerprint, files=2)},
+     (True, 'new_period')),
+    (['data.json'], 'log_error1.log',
+     {'data_version': '20200101_000000', 'checksum': checksum, 'bytes': size, 'errors_count': 1, 'files_count': 2,
+      'fingerprint': dict(fingerprint, manifest='other')},
+     (True, 'new_period')),
+    (['data.json'], 'log_error1.log',
+     {'data_version': '20200101_000000', 'checksum': checksum, 'bytes': size, 'errors_count': 1, 'files_count': 2,
+      'fingerprint': dict(fingerprint, sample='other')},
+     (True, 'new_period')),
 ])
 def test_compare(data_files, log_file, remote, expected, archiver, tmpdir, caplog, monkeypatch):
     create_crawl_directory(tmpdir, data_files, log_file)
@@ -191,6 +238,13 @@ def test_compare_bad_data_version():
     assert str(excinfo.value) == 'Future data version: 2020-02-01 00:00:00 > 2020-01-01 00:00:00'
 
 
+def test_compare_earlier_year():
+    crawl = Crawl('scotland', '20200101_000000', bytes=1, files_count=1, errors_count=0, checksum='a')
+    other = Crawl('scotland', '20191201_000000', bytes=1, files_count=1, errors_count=0, checksum='b')
+
+    assert crawl.compare(other) == (True, 'new_period')
+
+
 def test_checksum(tmpdir):
     file = tmpdir.join('test.json')
     file.write('{"id": 1}')
@@ -212,6 +266,31 @@ def test_checksum(tmpdir):
     assert crawl.checksum == '06bbee76269a3bd770704840395e8e10'
 
 
+def test_write_data_file(tmpdir):
+    files = {'a.json': 'a', os.path.join('child', 'c.json'): 'c', 'd.json': 'd',
+             os.path.join('child', 'b', 'e.json'): 'e'}
+    crawl = create_crawl(tmpdir, '20200902_052458', files)
+    prefix = str(tmpdir.join('data', 'scotland', '20200902_052458')).lstrip('/')
+
+    filename = crawl.write_data_file()
+    try:
+        with LZ4TarFile.open(filename, 'r:lz4') as tar:
+            members = [(tarinfo.name, tarinfo.isdir() or tar.extractfile(tarinfo).read()) for tarinfo in tar]
+    finally:
+        os.unlink(filename)
+
+    # Members are in the order in which the checksum is calculated.
+    assert members == [
+        (prefix, True),
+        (f'{prefix}/a.json', b'a'),
+        (f'{prefix}/d.json', b'd'),
+        (f'{prefix}/child', True),
+        (f'{prefix}/child/c.json', b'c'),
+        (f'{prefix}/child/b', True),
+        (f'{prefix}/child/b/e.json', b'e'),
+    ]
+
+
 def test_checksum_empty(tmpdir):
     crawl = Crawl('scotland', '20200902_052458', tmpdir, None)
 
@@ -245,6 +324,27 @@ def test_bytes_empty(tmpdir):
     assert crawl.bytes == 0
 
 
+def test_fingerprint(tmpdir):
+    spider_directory = tmpdir.mkdir('scotland')
+    crawl_directory = spider_directory.mkdir('20200902_052458')
+    file = crawl_directory.join('test.json')
+    file.write('{"id": 1}')  # 9
+
+    sub_directory = crawl_directory.mkdir('child')
+    file = sub_directory.join('test.json')
+    file.write('x' * 10000)
+
+    crawl = Crawl('scotland', '20200902_052458', tmpdir, None)
+
+    assert crawl.fingerprint == {
+        'files': 2,
+        'bytes': 10009,
+        'manifest': xxh3_128(f'test.json\x009\n{os.path.join("child", "test.json")}\x0010000\n'.encode()).hexdigest(),
+        'sample': xxh3_128(b'{"id": 1}' + b'x' * 8192).hexdigest(),
+    }
+    assert crawl.bytes == 10009
+
+
 def test_asdict(tmpdir):
     create_crawl_directory(tmpdir, ['data.json'], 'log_error1.log')
 
@@ -258,6 +358,7 @@ def test_asdict(tmpdir):
         'errors_count': None,
         'reject_reason': None,
         'archived': None,
+        'fingerprint': None,
     }
 
 
@@ -274,4 +375,5 @@ def test_asdict_cached(tmpdir):
         'errors_count': 1,
         'reject_reason': None,
         'archived': None,
+        'fingerprint': fingerprint,
     }
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+
+import pytest
+
+from ocdskingfisherarchive.archive import Archiver
+from ocdskingfisherarchive.exceptions import ConcurrentArchivalError
+from ocdskingfisherarchive.filesystem import FileSystem
+from ocdskingfisherarchive.restore import restore
+from ocdskingfisherarchive.s3 import S3
+from ocdskingfisherarchive.storage import AsyncStorage, create_storage
+from tests import create_crawl
+
+
+def read_directory(directory):
+    contents = {}
+    for root, _, files in os.walk(directory):
+        for file in files:
+            with open(os.path.join(root, file), 'rb') as f:
+                contents[os.path.relpath(os.path.join(root, file), directory).replace(os.sep, '/')] = f.read()
+    return contents
+
+
+@pytest.fixture()
+def archiver(tmpdir):
+    return Archiver(
+        f'file://{tmpdir.join("archive")}',
+        tmpdir.join('data'),
+        tmpdir.join('logs', 'kingfisher'),
+        str(tmpdir.join('cache.sqlite3')),
+    )
+
+
+def test_create_storage():
+    storage = create_storage('file:///mnt/archive')
+
+    assert isinstance(storage, FileSystem)
+    assert storage.directory == '/mnt/archive'
+    assert create_storage('s3://bucket').bucket_name == 'bucket'
+    assert isinstance(create_storage('bucket'), S3)
+    assert create_storage('bucket').bucket_name == 'bucket'
+
+
+@pytest.mark.parametrize('url', ['ftp://host/path', 'file://host/path'])
+def test_create_storage_invalid(url):
+    with pytest.raises(ValueError):
+        create_storage(url)
+
+
+@pytest.mark.parametrize('asynchronous', [False, True])
+@pytest.mark.parametrize('direct', [False, True])
+def test_run(direct, asynchronous, archiver, tmpdir):
+    archiver.asynchronous = asynchronous
+    archiver.async_s3 = AsyncStorage(archiver.s3)
+    archiver.direct = direct
+
+    create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'})
+    archiver.run()
+    create_crawl(tmpdir, '20200902_000000', {'a.json': 'a', 'b.json': 'b'})
+    archiver.run()
+
+    contents = read_directory(tmpdir.join('archive'))
+
+    assert sorted(key for key in contents if not key.startswith('.')) == [
+        'scotland/2020/08/data.tar.lz4',
+        'scotland/2020/08/metadata.json',
+        'scotland/2020/08/scrapy.log',
+        'scotland/2020/09/data.tar.lz4',
+        'scotland/2020/09/metadata.json',
+        'scotland/2020/09/scrapy.log',
+    ]
+    assert not os.listdir(tmpdir.join('archive', '.tmp'))
+
+    metadata = json.loads(contents['scotland/2020/09/metadata.json'])
+    assert metadata['checksums'] == {
+        'data.tar.lz4': hashlib.md5(contents['scotland/2020/09/data.tar.lz4']).hexdigest(),
+        'scrapy.log': hashlib.md5(contents['scotland/2020/09/scrapy.log']).hexdigest(),
+    }
+    assert archiver.s3.get_years_and_months_for_source('scotland') == {2020: {8: True, 9: True}}
+    assert sorted(archiver.s3.list_archives()) == ['scotland/2020/08', 'scotland/2020/09']
+    assert archiver.cache.get_archivals() == []
+
+    restore(archiver.s3, 'scotland', 2020, 9, str(tmpdir.join('restored')))
+
+    assert read_directory(tmpdir.join('restored')) == {
+        'scotland/20200902_000000/a.json': b'a',
+        'scotland/20200902_000000/b.json': b'b',
+    }
+
+
+@pytest.mark.parametrize('direct', [False, True])
+def test_run_bundle(direct, archiver, tmpdir):
+    archiver.direct = direct
+
+    create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'})
+    archiver.run()
+    archiver.bundle = True
+    create_crawl(tmpdir, '20200802_000000', {'a.json': 'a', 'b.json': 'b'})
+    archiver.run()
+
+    contents = read_directory(tmpdir.join('archive'))
+
+    assert sorted(key for key in contents if not key.startswith('.')) == ['scotland/2020/08/archive.bundle']
+    assert archiver.s3.load('scotland', 2020, 8).format_data_version() == '20200802_000000'
+    assert sorted(archiver.s3.list_archives()) == ['scotland/2020/08']
+    assert archiver.cache.get_archivals() == []
+
+    restore(archiver.s3, 'scotland', 2020, 8, str(tmpdir.join('restored')))
+
+    assert read_directory(tmpdir.join('restored')) == {
+        'scotland/20200802_000000/a.json': b'a',
+        'scotland/20200802_000000/b.json': b'b',
+    }
+
+
+def test_conditional_writes(tmpdir):
+    storage = FileSystem(str(tmpdir))
+
+    etag = storage.put('leases/scotland/2020/08.json', b'a')
+
+    assert storage.get('leases/scotland/2020/08.json') == (b'a', etag)
+    with pytest.raises(ConcurrentArchivalError):
+        storage.put('leases/scotland/2020/08.json', b'b')
+
+    new = storage.put('leases/scotland/2020/08.json', b'b', etag=etag)
+
+    assert new != etag
+    with pytest.raises(ConcurrentArchivalError):
+        storage.put('leases/scotland/2020/08.json', b'c', etag=etag)
+    with pytest.raises(ConcurrentArchivalError):
+        storage.delete_file('leases/scotland/2020/08.json', etag=etag)
+
+    storage.delete_file('leases/scotland/2020/08.json', etag=new)
+
+    assert storage.get('leases/scotland/2020/08.json') is None
+    assert storage.list_uploads() == []
+
+
+def test_move(tmpdir):
+    storage = FileSystem(str(tmpdir.join('archive')))
+    tmpdir.join('file').write('content')
+
+    checksum = storage.upload_file_to_staging(str(tmpdir.join('file')), 'scotland/2020/08/scrapy.log')
+    storage.move_file_from_staging_to_real('scotland/2020/08/scrapy.log')
+    # A resumed archival moves the file again.
+    storage.move_file_from_staging_to_real('scotland/2020/08/scrapy.log')
+    storage.remove_staging_file('scotland/2020/08/scrapy.log')
+
+    assert checksum == hashlib.md5(b'content').hexdigest()
+    assert storage.list_staging_files() == []
+    assert [c['Key'] for c in storage._list('')] == ['scotland/2020/08/scrapy.log']
+    with storage.open('scotland/2020/08/scrapy.log') as f:
+        assert f.read() == b'content'
+
+    with pytest.raises(FileNotFoundError):
+        storage.move_file_from_staging_to_real('scotland/2020/09/scrapy.log')
+
+
+def test_sweep(archiver, tmpdir):
+    # A file left over by an interrupted write.
+    leftover = tmpdir.join('archive', '.tmp', 'staging%2Fscotland%2F2020%2F08%2Fdata.tar.lz4.abc123')
+    leftover.write('x', ensure=True)
+    leftover.setmtime(0)
+    # A file being written by another host.
+    tmpdir.join('archive', '.tmp', 'staging%2Fwales%2F2020%2F08%2Fdata.tar.lz4.def456').write('x')
+
+    assert archiver.s3.list_uploads(60) == [('staging/scotland/2020/08/data.tar.lz4',
+                                             'staging%2Fscotland%2F2020%2F08%2Fdata.tar.lz4.abc123')]
+
+    archiver.resume()
+
+    assert archiver.s3.list_uploads() == [('staging/wales/2020/08/data.tar.lz4',
+                                           'staging%2Fwales%2F2020%2F08%2Fdata.tar.lz4.def456')]
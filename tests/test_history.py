@@ -0,0 +1,137 @@
+import random
+from collections import defaultdict
+
+import numpy as np
+import pytest
+
+import ocdskingfisherarchive.crawl
+import ocdskingfisherarchive.s3
+from ocdskingfisherarchive.crawl import Crawl
+from ocdskingfisherarchive.history import History, report, simulate, variants
+from tests import create_crawl
+from tests.stand_in import S3StandIn
+
+
+def generate(seed, sources=5, crawls=60, fingerprints=False):
+    rng = random.Random(seed)
+    records = []
+    for source in range(sources):
+        for index in range(crawls):
+            # About 3 crawls per month, with some identical crawls.
+            month, day = divmod(index * 9 + rng.randrange(9), 28)
+            records.append({
+                'source_id': f'source{source}',
+                'data_version': f'{2018 + month // 12}{month % 12 + 1:02d}{day + 1:02d}_000000',
+                'bytes': rng.choice([100, 120, 140, 200, 300]),
+                'files_count': rng.choice([10, 12, 14, 20]),
+                'errors_count': rng.choice([0, 0, 1, 5]),
+                'checksum': rng.choice(['a', 'b', 'c']),
+                'archived': None,
+                # Crawls with equal checksums can have distinct fingerprints, if files were renamed.
+                'fingerprint': {'manifest': rng.choice(['x', 'y'])} if fingerprints else None,
+            })
+    return records
+
+
+def replay(records):
+    by_source = defaultdict(list)
+    for record in records:
+        crawl = Crawl(**record)
+        by_source[crawl.source_id].append(crawl)
+
+    kept = set()
+    for crawls in by_source.values():
+        crawls.sort(key=lambda crawl: crawl.data_version)
+        best = None
+        for index, crawl in enumerate(crawls):
+            if best is None or crawl.compare(best)[0]:
+                best = crawl
+            month = (crawl.data_version.year, crawl.data_version.month)
+            following = crawls[index + 1] if index + 1 < len(crawls) else None
+            if not following or (following.data_version.year, following.data_version.month) != month:
+                if (best.data_version.year, best.data_version.month) == month:
+                    kept.add((best.source_id, best.format_data_version()))
+    return kept
+
+
+@pytest.mark.parametrize('fingerprints', [False, True])
+@pytest.mark.parametrize('seed', [1, 2, 3])
+@pytest.mark.parametrize('bytes_ratio,files_ratio', [(1.5, 1.5), (1.3, 1.5), (1.2, 1.1)])
+def test_simulate(seed, bytes_ratio, files_ratio, fingerprints, monkeypatch):
+    records = generate(seed, fingerprints=fingerprints)
+    history = History.from_records(records)
+
+    kept = simulate(history, [(1.5, 1.5), (bytes_ratio, files_ratio)])
+
+    monkeypatch.setattr(ocdskingfisherarchive.crawl, 'BYTES_RATIO', bytes_ratio)
+    monkeypatch.setattr(ocdskingfisherarchive.crawl, 'FILES_RATIO', files_ratio)
+
+    rows = np.flatnonzero(kept[1])
+    actual = {(history.sources[history.columns['source'][row]],
+               history.columns['data_version'][row].item().strftime('%Y%m%d_%H%M%S')) for row in rows}
+
+    assert actual == replay(records)
+
+
+def test_report(tmpdir):
+    history = History.from_records([
+        {'source_id': 'scotland', 'data_version': '20200801_000000', 'bytes': 100, 'files_count': 10,
+         'errors_count': 0, 'checksum': 'a', 'archived': True},
+        {'source_id': 'scotland', 'data_version': '20200802_000000', 'bytes': 140, 'files_count': 10,
+         'errors_count': 0, 'checksum': 'b', 'archived': False},
+        {'source_id': 'scotland', 'data_version': '20200901_000000', 'bytes': 140, 'files_count': 10,
+         'errors_count': 0, 'checksum': 'b', 'archived': None},
+    ])
+
+    assert report(history, variants([1.5, 1.3])) == [
+        {'bytes_ratio': 1.5, 'files_ratio': 1.5, 'archives': 2, 'bytes': 240},
+        {'bytes_ratio': 1.3, 'files_ratio': 1.5, 'archives': 1, 'bytes': 140},
+    ]
+
+    filename = str(tmpdir.join('history.npz'))
+    history.save(filename)
+    loaded = History.load(filename)
+
+    assert loaded.sources == ['scotland']
+    assert len(loaded) == 3
+    for key, value in history.columns.items():
+        assert np.array_equal(loaded.columns[key], value), key
+
+
+def test_load_without_fingerprints(tmpdir):
+    history = History.from_records(generate(1, sources=1, crawls=3))
+    filename = str(tmpdir.join('history.npz'))
+    np.savez_compressed(filename, sources=np.array(history.sources, dtype=str),
+                        **{key: value for key, value in history.columns.items() if key != 'fingerprint'})
+
+    assert list(History.load(filename).columns['fingerprint']) == [-1, -1, -1]
+
+
+def test_simulate_empty():
+    assert simulate(History.from_records([]), variants()).shape == (1, 0)
+
+
+def test_export(archiver, tmpdir, monkeypatch):
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', S3StandIn())
+
+    create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'})
+    create_crawl(tmpdir, '20200802_000000', {'a.json': 'a'})
+    archiver.run()
+    # A crawl in the bucket that isn't in the SQLite database.
+    archiver.archive(create_crawl(tmpdir, '20200901_000000', {'a.json': 'b'}))
+
+    history = History.export(archiver.cache, archiver.s3)
+
+    assert history.sources == ['scotland']
+    assert list(history.columns['data_version'].astype(str)) == [
+        '2020-08-01T00:00:00', '2020-08-02T00:00:00', '2020-09-01T00:00:00',
+    ]
+    assert list(history.columns['archived']) == [True, False, True]
+    # The values of archived crawls are read from their metadata files.
+    assert history.columns['checksum'][0] >= 0
+    # The fingerprints of archived crawls are read from their metadata files.
+    fingerprint = history.columns['fingerprint']
+    assert fingerprint[0] >= 0
+    assert fingerprint[2] >= 0
+    assert fingerprint[0] != fingerprint[2]
+    assert list(history.columns['bytes']) == [1, 1, 1]
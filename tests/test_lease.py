@@ -0,0 +1,73 @@
+import json
+import time
+
+import pytest
+
+import ocdskingfisherarchive.s3
+from ocdskingfisherarchive.lease import Leases
+from ocdskingfisherarchive.s3 import S3
+from tests.stand_in import S3StandIn
+
+
+@pytest.fixture()
+def stand_in(monkeypatch):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    return stand_in
+
+
+def test_acquire_release(stand_in):
+    leases = Leases(S3('bucket'), 'a')
+    other = Leases(S3('bucket'), 'b')
+
+    assert leases.acquire('scotland/2020/08')
+    assert json.loads(stand_in.objects['leases/scotland/2020/08.json'])['owner'] == 'a'
+    assert not other.acquire('scotland/2020/08')
+    assert other.acquire('wales/2020/08')
+
+    leases.release('scotland/2020/08')
+
+    assert 'leases/scotland/2020/08.json' not in stand_in.objects
+    assert other.acquire('scotland/2020/08')
+
+    other.release_all()
+
+    assert stand_in.objects == {}
+
+
+def test_acquire_same_owner(stand_in):
+    # For example, if the worker was interrupted.
+    assert Leases(S3('bucket'), 'a').acquire('scotland/2020/08')
+    assert Leases(S3('bucket'), 'a').acquire('scotland/2020/08')
+
+
+def test_acquire_expired(stand_in, caplog):
+    leases = Leases(S3('bucket'), 'a', seconds=-1)
+    other = Leases(S3('bucket'), 'b')
+
+    assert leases.acquire('scotland/2020/08')
+    assert other.acquire('scotland/2020/08')
+    assert 'Taking over the expired lease of a on scotland/2020/08' in caplog.messages
+
+    # The lease that was taken over isn't released.
+    leases.release('scotland/2020/08')
+
+    assert json.loads(stand_in.objects['leases/scotland/2020/08.json'])['owner'] == 'b'
+    assert 'Not releasing the lease on scotland/2020/08, because another worker took it over' in caplog.messages
+
+
+def test_acquire_concurrent(stand_in, caplog):
+    class ConcurrentStandIn(S3StandIn):
+        def get_object(self, Bucket, Key, **kwargs):
+            response = super().get_object(Bucket, Key, **kwargs)
+            # Another worker takes over the expired lease between the read and the write.
+            self.objects[Key] = json.dumps({'owner': 'c', 'expires': time.time() + 60}).encode()
+            return response
+
+    stand_in.__class__ = ConcurrentStandIn
+    stand_in.objects['leases/scotland/2020/08.json'] = json.dumps({'owner': 'b', 'expires': 0}).encode()
+    leases = Leases(S3('bucket'), 'a')
+
+    assert not leases.acquire('scotland/2020/08')
+    assert leases.held == {}
+    assert 'Skipping scotland/2020/08, because another worker acquired its lease' in caplog.messages
@@ -0,0 +1,91 @@
+import json
+import time
+
+import pytest
+
+import ocdskingfisherarchive.s3
+from ocdskingfisherarchive.metrics import Metrics, metrics
+from tests import create_crawl
+from tests.stand_in import S3StandIn
+
+
+def test_timer():
+    instance = Metrics()
+
+    with instance.timer('phase', 10):
+        time.sleep(0.01)
+    with instance.timer('phase') as measurement:
+        measurement['bytes'] = 5
+
+    totals = instance.summary()['phases']['phase']
+    assert totals['calls'] == 2
+    assert totals['bytes'] == 15
+    assert totals['seconds'] >= 0.01
+    assert totals['bytes_per_second'] == 15 / totals['seconds']
+
+
+def test_timer_exception():
+    instance = Metrics()
+
+    with pytest.raises(ValueError):
+        with instance.timer('phase', 10):
+            raise ValueError
+
+    assert instance.summary()['phases']['phase']['calls'] == 1
+
+
+def test_timed():
+    instance = Metrics()
+
+    @instance.timed('phase')
+    def function(value):
+        return value
+
+    assert function(1) == 1
+    assert instance.summary()['phases']['phase']['calls'] == 1
+
+
+def test_iterate():
+    instance = Metrics()
+
+    assert list(instance.iterate('phase', [1, 2])) == [1, 2]
+    # Two items, and the end of the iterator.
+    assert instance.summary()['phases']['phase']['calls'] == 3
+
+
+def test_write(tmpdir):
+    instance = Metrics()
+    instance.record('s3.upload', 2.0, 10)
+    instance.increment('crawls')
+
+    filename = tmpdir.join('metrics.json')
+    instance.write_json(str(filename))
+    summary = json.loads(filename.read())
+
+    assert summary['phases'] == {'s3.upload': {'calls': 1, 'seconds': 2.0, 'bytes': 10, 'bytes_per_second': 5.0}}
+    assert summary['counters'] == {'crawls': 1}
+
+    filename = tmpdir.join('metrics.prom')
+    instance.write_prometheus(str(filename))
+    lines = filename.read().splitlines()
+
+    assert '# TYPE kingfisher_archive_phase_seconds gauge' in lines
+    assert 'kingfisher_archive_phase_seconds{phase="s3.upload"} 2.0' in lines
+    assert 'kingfisher_archive_phase_bytes{phase="s3.upload"} 10' in lines
+    assert 'kingfisher_archive_count{name="crawls"} 1' in lines
+    assert tmpdir.listdir(sort=True) == [tmpdir.join('metrics.json'), tmpdir.join('metrics.prom')]
+
+
+def test_run(archiver, tmpdir, monkeypatch):
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', S3StandIn())
+
+    create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'})
+    archiver.run()
+
+    summary = metrics.summary()
+
+    assert summary['counters'] == {'crawls': 1, 'crawls_archived': 1}
+    for phase in ('crawl.all', 'crawl.checksum', 'crawl.write_data_file', 'log.lines', 'cache.read', 'cache.write',
+                  's3.list', 's3.upload', 's3.copy', 's3.delete', 'reclaim'):
+        assert summary['phases'][phase]['calls'], phase
+    assert summary['phases']['crawl.checksum']['bytes'] == 1
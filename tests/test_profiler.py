@@ -0,0 +1,57 @@
+import io
+
+import pytest
+
+from ocdskingfisherarchive.metrics import metrics
+from ocdskingfisherarchive.profiler import Profiler
+
+
+def other():
+    pass
+
+
+def hash_():
+    pass
+
+
+def compress():
+    pass
+
+
+def checksum():
+    with metrics.timer('crawl.checksum'):
+        hash_()
+
+
+def write_data_file():
+    with metrics.timer('crawl.write_data_file'):
+        compress()
+        # A nested phase is profiled by the outer phase.
+        checksum()
+
+
+@pytest.mark.parametrize('phases,expected', [
+    ((), {'other', 'hash_', 'compress'}),
+    (('crawl.checksum',), {'hash_'}),
+    (('crawl.write_data_file',), {'hash_', 'compress'}),
+])
+def test_profiling(phases, expected, tmpdir):
+    profiler = Profiler(phases=phases)
+    with profiler.profiling():
+        other()
+        checksum()
+        write_data_file()
+
+    profiler.profile.create_stats()
+    functions = {function for _, _, function in profiler.profile.stats}
+
+    assert functions & {'other', 'hash_', 'compress'} == expected
+    assert metrics.profiler is None
+    assert not profiler.lock.locked()
+
+    profiler.write(str(tmpdir.join('archive.prof')))
+    stream = io.StringIO()
+    profiler.print_stats(stream)
+
+    assert 'function calls' in stream.getvalue()
+    assert tmpdir.join('archive.prof').check()
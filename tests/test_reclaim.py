@@ -0,0 +1,92 @@
+import errno
+import os
+
+import pytest
+
+import ocdskingfisherarchive.reclaim
+from ocdskingfisherarchive.reclaim import Reclaimer
+
+
+def test_delete(tmpdir, monkeypatch):
+    monkeypatch.setattr(ocdskingfisherarchive.reclaim, 'BATCH_SIZE', 2)
+
+    crawl_directory = tmpdir.join('data', 'scotland', '20200902_000000')
+    for name in ('a.json', 'b.json', 'c.json', os.path.join('child', 'd.json'),
+                 os.path.join('child', 'grandchild', 'e.json')):
+        crawl_directory.join(name).write('{}', ensure=True)
+    # A symbolic link to a directory outside the crawl directory.
+    tmpdir.join('outside', 'f.json').write('{}', ensure=True)
+    os.symlink(tmpdir.join('outside'), crawl_directory.join('link'))
+
+    reclaimer = Reclaimer(str(tmpdir.join('reclaim')), jobs=2)
+    reclaimer.delete(str(crawl_directory))
+
+    # The crawl directory is moved immediately.
+    assert os.listdir(tmpdir.join('data', 'scotland')) == []
+
+    reclaimer.close()
+
+    assert os.listdir(tmpdir.join('data')) == ['scotland']
+    assert not tmpdir.join('reclaim').check()
+    assert tmpdir.join('outside', 'f.json').check()
+    assert reclaimer.pending == {}
+
+
+def test_delete_cross_device(tmpdir, monkeypatch, caplog):
+    crawl_directory = tmpdir.join('data', 'scotland', '20200902_000000')
+    for name in ('a.json', os.path.join('child', 'b.json')):
+        crawl_directory.join(name).write('{}', ensure=True)
+
+    def rename(src, dst):
+        raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+    monkeypatch.setattr(os, 'rename', rename)
+
+    reclaimer = Reclaimer(str(tmpdir.join('reclaim')), jobs=2)
+    reclaimer.delete(str(crawl_directory))
+    reclaimer.close()
+
+    assert os.listdir(tmpdir.join('data', 'scotland')) == []
+    # No temporary directory is left behind.
+    assert not tmpdir.join('reclaim').check()
+    assert reclaimer.pending == {}
+    assert 'deleting it in place' in caplog.text
+
+
+def test_delete_error(tmpdir, monkeypatch):
+    crawl_directory = tmpdir.join('data', 'scotland', '20200902_000000')
+    crawl_directory.join('a.json').write('{}', ensure=True)
+
+    def rename(src, dst):
+        raise OSError(errno.EACCES, 'Permission denied')
+
+    monkeypatch.setattr(os, 'rename', rename)
+
+    reclaimer = Reclaimer(str(tmpdir.join('reclaim')))
+    with pytest.raises(PermissionError):
+        reclaimer.delete(str(crawl_directory))
+
+    assert crawl_directory.join('a.json').check()
+    assert os.listdir(tmpdir.join('reclaim')) == []
+
+
+def test_resume(tmpdir):
+    root = tmpdir.join('reclaim', '20200902_000000-abc')
+    root.join('20200902_000000', 'child', 'a.json').write('{}', ensure=True)
+
+    reclaimer = Reclaimer(str(tmpdir.join('reclaim')))
+    reclaimer.resume()
+    reclaimer.close()
+
+    assert not tmpdir.join('reclaim').check()
+
+
+def test_resume_empty(tmpdir):
+    tmpdir.join('reclaim', '20200902_000000-abc', '20200902_000000').ensure(dir=True)
+
+    reclaimer = Reclaimer(str(tmpdir.join('reclaim')))
+    reclaimer.resume()
+    reclaimer.wait()
+
+    assert not tmpdir.join('reclaim').check()
+    assert reclaimer.executor is None
@@ -0,0 +1,169 @@
+import json
+import os
+
+import pytest
+
+import ocdskingfisherarchive.restore
+import ocdskingfisherarchive.s3
+from ocdskingfisherarchive.crawl import Crawl
+from ocdskingfisherarchive.exceptions import ArchiveNotFoundError, ChecksumMismatchError
+from ocdskingfisherarchive.restore import _walk_key, restore, restore_all
+from ocdskingfisherarchive.tarfile import LZ4TarFile
+from tests import create_crawl
+from tests.stand_in import S3StandIn
+
+
+def read_directory(directory):
+    contents = {}
+    for root, _, files in os.walk(directory):
+        for file in files:
+            with open(os.path.join(root, file)) as f:
+                contents[os.path.relpath(os.path.join(root, file), directory)] = f.read()
+    return contents
+
+
+def members(stand_in, key, tmpdir):
+    filename = tmpdir.join('member.tar.lz4')
+    filename.write_binary(stand_in.objects[key])
+    with LZ4TarFile.open(filename, 'r:lz4') as tar:
+        return sorted(tarinfo.name for tarinfo in tar)
+
+
+@pytest.fixture()
+def stand_in(monkeypatch):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    return stand_in
+
+
+@pytest.mark.parametrize('deduplicate', [True, False])
+def test_restore(deduplicate, archiver, stand_in, tmpdir):
+    archiver.deduplicate = deduplicate
+
+    first = {'a.json': 'a', 'b.json': 'b', os.path.join('child', 'c.json'): 'c'}
+    second = {'a.json': 'a', 'b.json': 'B', os.path.join('child', 'c.json'): 'c', 'd.json': 'b'}
+
+    archiver.archive(create_crawl(tmpdir, '20200801_000000', first))
+    archiver.archive(create_crawl(tmpdir, '20200902_000000', second))
+
+    assert not os.listdir(tmpdir.join('data', 'scotland'))
+    assert not [key for key in stand_in.objects if key.startswith('staging/')]
+
+    if deduplicate:
+        assert members(stand_in, 'scotland/2020/08/data-20200801_000000.tar.lz4', tmpdir) == [
+            'scotland/20200801_000000/a.json',
+            'scotland/20200801_000000/b.json',
+            'scotland/20200801_000000/child/c.json',
+        ]
+        assert members(stand_in, 'scotland/2020/09/data-20200902_000000.tar.lz4', tmpdir) == [
+            'scotland/20200902_000000/b.json',
+        ]
+
+    destination = tmpdir.join('restore')
+
+    for data_version, expected in (('20200801_000000', first), ('20200902_000000', second)):
+        local_directory = restore(archiver.s3, 'scotland', 2020, int(data_version[4:6]), destination)
+
+        assert local_directory == os.path.join(destination, 'scotland', data_version)
+        assert read_directory(local_directory) == expected
+
+
+def test_restore_identical_files(archiver, stand_in, tmpdir):
+    archiver.deduplicate = True
+    expected = {'a.json': 'x', 'b.json': 'x', os.path.join('child', 'c.json'): 'x'}
+
+    archiver.archive(create_crawl(tmpdir, '20200801_000000', expected))
+
+    # The files are stored once.
+    assert members(stand_in, 'scotland/2020/08/data-20200801_000000.tar.lz4', tmpdir) == [
+        'scotland/20200801_000000/a.json',
+    ]
+
+    local_directory = restore(archiver.s3, 'scotland', 2020, 8, tmpdir.join('restore'))
+
+    assert read_directory(local_directory) == expected
+
+
+@pytest.mark.parametrize('direct', [False, True])
+def test_restore_after_deduplicate(direct, archiver, stand_in, tmpdir):
+    archiver.direct = direct
+    archiver.deduplicate = True
+    archiver.archive(create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'}))
+
+    # The month is archived again, without deduplication.
+    archiver.deduplicate = False
+    expected = {'a.json': 'A', 'b.json': 'b'}
+    archiver.archive(create_crawl(tmpdir, '20200802_000000', expected))
+
+    # The stale manifest file is deleted, and its content-addressed archive is kept.
+    assert 'scotland/2020/08/manifest.json' not in stand_in.objects
+    assert 'scotland/2020/08/data-20200801_000000.tar.lz4' in stand_in.objects
+
+    local_directory = restore(archiver.s3, 'scotland', 2020, 8, tmpdir.join('restore'))
+
+    assert local_directory == os.path.join(tmpdir.join('restore'), 'scotland', '20200802_000000')
+    assert read_directory(local_directory) == expected
+
+
+def test_restore_not_found(archiver, stand_in, tmpdir):
+    with pytest.raises(ArchiveNotFoundError) as excinfo:
+        restore(archiver.s3, 'scotland', 2020, 1, tmpdir)
+
+    assert str(excinfo.value) == 'No archive found: scotland/2020/01'
+
+
+def test_restore_streaming(archiver, stand_in, tmpdir, monkeypatch):
+    expected = {'a.json': 'a' * 100, 'b.json': 'b' * 100, 'c.json': 'c' * 100}
+    archiver.archive(create_crawl(tmpdir, '20200801_000000', expected))
+    del stand_in.requests[:]
+
+    # The checksum is calculated while extracting, not from disk.
+    monkeypatch.setattr(Crawl, 'checksum', property(lambda self: pytest.fail('calculated from disk')))
+
+    local_directory = restore(archiver.s3, 'scotland', 2020, 8, tmpdir.join('restore'), concurrency=2, range_size=16)
+
+    assert read_directory(local_directory) == expected
+    size = len(stand_in.objects['scotland/2020/08/data.tar.lz4'])
+    assert stand_in.requests.count(('get_object', 'scotland/2020/08/data.tar.lz4')) == -(-size // 16)
+    assert not [key for key in os.listdir(tmpdir.join('restore')) if key != 'scotland']
+
+
+@pytest.mark.parametrize('deduplicate', [True, False])
+def test_restore_checksum_mismatch(deduplicate, archiver, stand_in, tmpdir):
+    archiver.deduplicate = deduplicate
+    archiver.archive(create_crawl(tmpdir, '20200801_000000', {'a.json': 'a', os.path.join('child', 'c.json'): 'c'}))
+
+    metadata = json.loads(stand_in.objects['scotland/2020/08/metadata.json'])
+    metadata['checksum'] = '0' * 32
+    stand_in.objects['scotland/2020/08/metadata.json'] = json.dumps(metadata).encode()
+
+    with pytest.raises(ChecksumMismatchError) as excinfo:
+        restore(archiver.s3, 'scotland', 2020, 8, tmpdir.join('restore'))
+
+    assert str(excinfo.value).startswith('Checksum mismatch: scotland/2020/08 (')
+
+
+def test_restore_all(archiver, stand_in, tmpdir):
+    archiver.archive(create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'}))
+    archiver.archive(create_crawl(tmpdir, '20200902_000000', {'a.json': 'A'}))
+
+    destination = tmpdir.join('restore')
+
+    assert restore_all(archiver.s3, 'scotland', [(2020, 9), (2020, 8)], destination, jobs=2) == [
+        os.path.join(destination, 'scotland', '20200902_000000'),
+        os.path.join(destination, 'scotland', '20200801_000000'),
+    ]
+    assert read_directory(destination) == {
+        os.path.join('scotland', '20200801_000000', 'a.json'): 'a',
+        os.path.join('scotland', '20200902_000000', 'a.json'): 'A',
+    }
+
+
+def test_walk_key(tmpdir):
+    names = ['b.json', 'a/z.json', 'a.json', 'a/b/c.json', 'a/a.json', 'ab/a.json']
+    for name in names:
+        tmpdir.join('source', '20200101_000000', *name.split('/')).write('', ensure=True)
+
+    walked = [name.replace(os.sep, '/') for name, _ in Crawl('source', '20200101_000000', tmpdir)._walk()]
+
+    assert sorted(names, key=_walk_key) == walked
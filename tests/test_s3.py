@@ -1,6 +1,22 @@
+import base64
+import datetime
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
 import pytest
+from botocore.exceptions import ClientError
 
-from ocdskingfisherarchive.s3 import _find_latest_year_month_to_load
+import ocdskingfisherarchive.s3
+import ocdskingfisherarchive.storage
+from ocdskingfisherarchive.buffers import pool
+from ocdskingfisherarchive.bundle import Bundle
+from ocdskingfisherarchive.exceptions import ConcurrentArchivalError
+from ocdskingfisherarchive.s3 import S3, LazyClient
+from ocdskingfisherarchive.storage import _find_latest_year_month_to_load
+from tests.stand_in import S3StandIn
 
 
 @pytest.mark.parametrize('year, expected_year, expected_month', [
@@ -13,3 +29,213 @@ def test_find_latest_year_month_to_load_same_year(year, expected_year, expected_
 
     assert actual_year == expected_year
     assert actual_month == expected_month
+
+
+def test_lazy_imports():
+    # Run in a new process, because other tests import these modules.
+    code = 'import sys, manage, ocdskingfisherarchive.archive; print({"boto3", "logparser"} & set(sys.modules))'
+    process = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, universal_newlines=True, check=True)
+
+    assert process.stdout == 'set()\n'
+
+
+def test_lazy_client(monkeypatch):
+    clients = []
+
+    class Client:
+        def head_object(self, **kwargs):
+            return kwargs
+
+    def create_client():
+        clients.append(Client())
+        return clients[-1]
+
+    monkeypatch.setattr('ocdskingfisherarchive.s3._create_client', create_client)
+    client = LazyClient()
+
+    assert clients == []
+    assert client.head_object(Key='key') == {'Key': 'key'}
+    assert client.head_object(Key='key') == {'Key': 'key'}
+    assert len(clients) == 1
+
+
+@pytest.mark.parametrize('content, parts', [(b'0123', 0), (b'0123456789', 3)])
+def test_upload_checksum(content, parts, monkeypatch, tmpdir):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'PART_SIZE', 4)
+    tmpdir.join('file').write_binary(content)
+    s3 = S3('bucket')
+
+    checksum = s3.upload_file_to_staging(str(tmpdir.join('file')), 'file')
+
+    # The checksum is the ETag of the uploaded object, and of the object copied from the staging directory.
+    assert stand_in.requests.count(('upload_part', 'staging/file')) == parts
+    assert f'"{checksum}"' == stand_in._etag('staging/file')
+
+    s3.move_file_from_staging_to_real('file')
+
+    assert f'"{checksum}"' == stand_in._etag('file')
+
+
+@pytest.mark.parametrize('content,chunks', [(b'0123', [b'0123']), (b'0123456789', [b'0123', b'4567', b'89'])])
+def test_commit_file_checksum(content, chunks, monkeypatch, tmpdir):
+    class RecordingStandIn(S3StandIn):
+        def put_object(self, Bucket, Key, Body, ContentMD5=None, **kwargs):
+            digests.append(ContentMD5)
+            return super().put_object(Bucket, Key, Body, ContentMD5=ContentMD5, **kwargs)
+
+        def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, ContentMD5=None, **kwargs):
+            digests.append(ContentMD5)
+            return super().upload_part(Bucket, Key, UploadId, PartNumber, Body, ContentMD5=ContentMD5, **kwargs)
+
+    def readinto(f, buffer):
+        count = original(f, buffer)
+        read.append(count)
+        return count
+
+    digests = []
+    uploaded = []
+    read = []
+    original = pool.readinto
+    stand_in = RecordingStandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'PART_SIZE', 4)
+    monkeypatch.setattr(ocdskingfisherarchive.s3.throttle, 'upload', uploaded.append)
+    monkeypatch.setattr(pool, 'readinto', readinto)
+    tmpdir.join('file').write_binary(content)
+
+    checksum = S3('bucket').commit_file(str(tmpdir.join('file')), 'file')
+
+    assert f'"{checksum}"' == stand_in._etag('file')
+    assert digests == [base64.b64encode(hashlib.md5(chunk).digest()).decode() for chunk in chunks]
+    assert stand_in.objects == {'file': content}
+    # The file is read once, and the body is throttled as it is read.
+    assert sum(read) == len(content)
+    assert sum(uploaded) == len(content)
+
+
+@pytest.mark.parametrize('content', [b'0123', b'0123456789'])
+def test_commit_file_concurrent(content, monkeypatch, tmpdir):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'PART_SIZE', 4)
+    tmpdir.join('file').write_binary(content)
+    stand_in.objects['file'] = b'other'
+
+    with pytest.raises(ConcurrentArchivalError):
+        S3('bucket').commit_file(str(tmpdir.join('file')), 'file')
+
+    assert stand_in.objects == {'file': b'other'}
+    # No multipart upload is left behind.
+    assert stand_in.uploads == {}
+
+
+def test_upload_buffer(monkeypatch, tmpdir):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'PART_SIZE', 8)
+    pool.configure(block_size=4)
+    tmpdir.join('a').write('ab')
+    tmpdir.join('b').write('cde')
+    tmpdir.join('c').write('fghijk')
+    s3 = S3('bucket')
+
+    try:
+        s3.upload_file(str(tmpdir.join('a')), 'a')
+        s3.upload_file(str(tmpdir.join('b')), 'b')
+        s3.upload_file(str(tmpdir.join('c')), 'c')
+
+        assert stand_in.objects == {'a': b'ab', 'b': b'cde', 'c': b'fghijk'}
+        # The block-sized buffer is returned to the pool, and reused. No part-sized buffer is kept.
+        assert {size: len(free) for size, free in pool.free.items()} == {4: 1}
+    finally:
+        pool.configure()
+
+
+def test_upload_checksum_mismatch(monkeypatch, tmpdir):
+    class CorruptingStandIn(S3StandIn):
+        def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+            return super().upload_part(Bucket, Key, UploadId, PartNumber, b'x' + Body[1:], **kwargs)
+
+    stand_in = CorruptingStandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'PART_SIZE', 4)
+    tmpdir.join('file').write('0123456789')
+
+    with pytest.raises(ClientError, match='BadDigest'):
+        S3('bucket').upload_file_to_staging(str(tmpdir.join('file')), 'file')
+
+    assert 'staging/file' not in stand_in.objects
+
+
+@pytest.mark.parametrize('header_size, requests', [(64 * 1024, 1), (16, 2)])
+def test_get_bundle(header_size, requests, monkeypatch, tmpdir):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    monkeypatch.setattr(ocdskingfisherarchive.storage, 'HEADER_SIZE', header_size)
+    tmpdir.join('data.tar.lz4').write_binary(b'data' * 100000)
+    filename = Bundle.write_file({'source_id': 'scotland'}, {'data.tar.lz4': str(tmpdir.join('data.tar.lz4'))})
+    with open(filename, 'rb') as f:
+        stand_in.objects['scotland/2020/08/archive.bundle'] = f.read()
+    os.unlink(filename)
+    s3 = S3('bucket')
+
+    bundle = s3.get_bundle('scotland/2020/08')
+
+    # The metadata is read without reading the members.
+    assert bundle.metadata == {'source_id': 'scotland'}
+    assert [operation for operation, key in stand_in.requests] == ['get_object'] * requests
+    assert s3.get_bundle('scotland/2020/09') is None
+
+    with s3.open('scotland/2020/08/archive.bundle', range_size=1000, offset=bundle.range('data.tar.lz4')[0],
+                 size=bundle.range('data.tar.lz4')[1]) as f:
+        assert f.read() == b'data' * 100000
+
+
+def test_load_latest_incomplete(monkeypatch):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    for data_version in ('20191201_000000', '20200801_000000', '20200901_000000'):
+        metadata = {'source_id': 'scotland', 'data_version': data_version, 'checksum': 'abc'}
+        if data_version != '20191201_000000':
+            metadata['objects'] = {'data.tar.lz4': {'etag': '"old"', 'size': 3}}
+        stand_in.objects[f'scotland/{data_version[:4]}/{data_version[4:6]}/metadata.json'] = json.dumps(
+            metadata).encode()
+    # Later archivals were interrupted after uploading the data file, or before, so the archives don't match their
+    # metadata files.
+    stand_in.objects['scotland/2020/08/data.tar.lz4'] = b'new'
+    s3 = S3('bucket')
+
+    # The latest complete archive is loaded, across years.
+    crawl = s3.load_latest('scotland', datetime.datetime(2020, 9, 2))
+    assert crawl.data_version == datetime.datetime(2019, 12, 1)
+    assert s3.load_latest('scotland', datetime.datetime(2019, 11, 1)) is None
+
+
+def test_load_layouts(monkeypatch, tmpdir):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    tmpdir.join('data.tar.lz4').write_binary(b'data')
+    metadata = {'source_id': 'scotland', 'data_version': '20200802_000000', 'checksum': 'abc'}
+    filename = Bundle.write_file(metadata, {'data.tar.lz4': str(tmpdir.join('data.tar.lz4'))})
+    with open(filename, 'rb') as f:
+        bundle = f.read()
+    os.unlink(filename)
+    stand_in.objects['scotland/2020/08/archive.bundle'] = bundle
+    stand_in.objects['scotland/2020/09/archive.bundle'] = bundle
+    metadata['data_version'] = '20200901_000000'
+    stand_in.objects['scotland/2020/09/metadata.json'] = json.dumps(metadata).encode()
+    s3 = S3('bucket')
+
+    # If both layouts exist, the multi-file layout is used.
+    assert s3.load('scotland', 2020, 8).data_version == datetime.datetime(2020, 8, 2)
+    assert s3.load('scotland', 2020, 9).data_version == datetime.datetime(2020, 9, 1)
+    assert s3.list_archives() == {
+        'scotland/2020/08': stand_in._etag('scotland/2020/08/archive.bundle'),
+        'scotland/2020/09': stand_in._etag('scotland/2020/09/metadata.json'),
+    }
+    assert s3.get_years_and_months_for_source('scotland') == {2020: {8: True, 9: True}}
+    assert s3.locate('scotland/2020/08', 'data.tar.lz4') == ('scotland/2020/08/archive.bundle',) + (
+        s3.get_bundle('scotland/2020/08').range('data.tar.lz4'))
+    assert s3.locate('scotland/2020/09', 'data.tar.lz4') == ('scotland/2020/09/data.tar.lz4', 0, None)
@@ -0,0 +1,103 @@
+import os
+import time
+
+import pytest
+
+import ocdskingfisherarchive.s3
+from ocdskingfisherarchive.scheduler import Scheduler
+from ocdskingfisherarchive.storage import AsyncStorage
+from tests import create_crawl
+from tests.stand_in import S3StandIn
+
+
+@pytest.fixture()
+def groups(tmpdir):
+    return {
+        'a/2020/08': [create_crawl(tmpdir, '20200801_000000', {'a.json': 'aa'}, source_id='a')],
+        'b/2020/07': [create_crawl(tmpdir, '20200701_000000', {'a.json': 'a'}, source_id='b')],
+        'c/2020/08': [create_crawl(tmpdir, '20200802_000000', {'a.json': 'aaa'}, source_id='c'),
+                      create_crawl(tmpdir, '20200803_000000', {'a.json': 'a'}, source_id='c')],
+    }
+
+
+@pytest.mark.parametrize('policy,expected', [
+    ('scan', ['a', 'b', 'c']),
+    ('largest', ['c', 'a', 'b']),
+    ('oldest', ['b', 'a', 'c']),
+])
+def test_order(policy, expected, groups):
+    assert [crawls[0].source_id for crawls in Scheduler(policy).order(groups.values())] == expected
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError) as excinfo:
+        Scheduler('random')
+
+    assert str(excinfo.value) == "policy must be one of scan, largest, oldest, not 'random'"
+
+
+def test_schedule(groups, caplog):
+    scheduler = Scheduler(max_bytes=3)
+
+    assert scheduler.schedule(groups['a/2020/08'][0])
+    assert not scheduler.schedule(groups['c/2020/08'][0])
+    assert scheduler.schedule(groups['b/2020/07'][0])
+    assert scheduler.scheduled_bytes == 3
+    assert 'Skipping c/20200802_000000, because its 3 bytes exceed the remaining budget of 1 bytes' in caplog.messages
+
+
+def test_expired():
+    assert not Scheduler().expired()
+    assert not Scheduler(max_seconds=60).expired()
+
+    scheduler = Scheduler(max_seconds=0.01)
+    time.sleep(0.01)
+
+    assert scheduler.expired()
+
+    scheduler.start()
+
+    assert not scheduler.expired()
+
+
+@pytest.mark.parametrize('asynchronous', [False, True])
+def test_run_budget(asynchronous, archiver, tmpdir, monkeypatch):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+    archiver.asynchronous = asynchronous
+    archiver.async_s3 = AsyncStorage(archiver.s3)
+    archiver.scheduler = Scheduler('largest', max_bytes=4)
+
+    create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'}, source_id='a')
+    create_crawl(tmpdir, '20200801_000000', {'a.json': 'aaa'}, source_id='b')
+    create_crawl(tmpdir, '20200801_000000', {'a.json': 'aa'}, source_id='c')
+    archiver.run()
+
+    assert sorted(key for key in stand_in.objects if key.endswith('data.tar.lz4')) == [
+        'a/2020/08/data.tar.lz4',
+        'b/2020/08/data.tar.lz4',
+    ]
+    assert os.listdir(tmpdir.join('data', 'c')) == ['20200801_000000']
+
+    # The time is up.
+    archiver.scheduler = Scheduler(max_seconds=0)
+    archiver.run()
+
+    assert os.listdir(tmpdir.join('data', 'c')) == ['20200801_000000']
+
+    archiver.scheduler = Scheduler()
+    archiver.run()
+
+    assert os.listdir(tmpdir.join('data', 'c')) == []
+
+
+def test_run_no_space(archiver, tmpdir, monkeypatch, caplog):
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', S3StandIn())
+    archiver.reserved_space = 2 ** 62
+
+    create_crawl(tmpdir, '20200801_000000', {'a.json': 'a'})
+    archiver.run()
+
+    assert os.listdir(tmpdir.join('data', 'scotland')) == ['20200801_000000']
+    assert 'Skipping scotland/20200801_000000, because the temporary directory has insufficient space' in \
+        caplog.messages
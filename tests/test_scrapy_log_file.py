@@ -1,7 +1,9 @@
 import datetime
+from collections import OrderedDict
 
 import pytest
 
+import ocdskingfisherarchive.scrapy_log_file
 from ocdskingfisherarchive.scrapy_log_file import ScrapyLogFile
 from tests import path
 
@@ -119,3 +121,39 @@ def test_item_counts(filename, expected):
 ])
 def test_is_complete(filename, expected):
     assert ScrapyLogFile(path(filename)).is_complete() is expected
+
+
+def test_get(tmpdir):
+    file = tmpdir.join('test.log')
+    file.write(message)
+
+    scrapy_log_file = ScrapyLogFile.get(str(file))
+
+    assert ScrapyLogFile.get(str(file)) is scrapy_log_file
+
+    # The log file changes.
+    file.write(message + '\n')
+
+    assert ScrapyLogFile.get(str(file)) is not scrapy_log_file
+
+    ScrapyLogFile.forget(str(file))
+
+    assert str(file) not in ScrapyLogFile._index
+
+
+def test_get_bounded(tmpdir, monkeypatch):
+    monkeypatch.setattr(ocdskingfisherarchive.scrapy_log_file, 'MAX_INDEXED', 2)
+    monkeypatch.setattr(ScrapyLogFile, '_index', OrderedDict())
+    names = []
+    for i in range(3):
+        file = tmpdir.join(f'{i}.log')
+        file.write(message)
+        names.append(str(file))
+
+    ScrapyLogFile.get(names[0])
+    ScrapyLogFile.get(names[1])
+    # The first log file is used again, so the second is the least recently used.
+    ScrapyLogFile.get(names[0])
+    ScrapyLogFile.get(names[2])
+
+    assert list(ScrapyLogFile._index) == [names[0], names[2]]
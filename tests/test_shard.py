@@ -0,0 +1,35 @@
+import pytest
+
+from ocdskingfisherarchive.shard import Shard
+
+sources = [f'source_{i}' for i in range(100)]
+
+
+def test_owns():
+    shards = [Shard(index, 3) for index in range(3)]
+
+    for source_id in sources:
+        assert [shard.owns(source_id) for shard in shards].count(True) == 1
+    for shard in shards:
+        assert 20 < sum(shard.owns(source_id) for source_id in sources) < 47
+
+
+def test_owns_single():
+    assert all(Shard().owns(source_id) for source_id in sources)
+
+
+def test_owner_add_worker():
+    before = Shard(0, 3)
+    after = Shard(0, 4)
+
+    for source_id in sources:
+        # A source either stays with its worker, or moves to the new worker.
+        assert after.owner(source_id) in (before.owner(source_id), 3)
+
+
+@pytest.mark.parametrize('index, count', [(1, 1), (-1, 2)])
+def test_init_invalid(index, count):
+    with pytest.raises(ValueError) as excinfo:
+        Shard(index, count)
+
+    assert str(excinfo.value) == f'index must be between 0 and {count - 1}, not {index}'
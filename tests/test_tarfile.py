@@ -1,3 +1,8 @@
+import os
+import tarfile
+
+import pytest
+
 from ocdskingfisherarchive.tarfile import LZ4TarFile
 from tests import path
 
@@ -14,3 +19,56 @@ def test_class(tmpdir):
         for tarinfo in tar:
             assert tarinfo.name == 'tests/fixtures/data.json'
             assert tar.extractfile(tarinfo).read() == content
+
+
+def test_add_stat(tmpdir):
+    compressed = tmpdir.join('compressed.lz4')
+    tmpdir.mkdir('directory').join('file.json').write('{}')
+    directory = str(tmpdir.join('directory'))
+    filename = str(tmpdir.join('directory', 'file.json'))
+    stat = os.stat(filename)
+
+    with LZ4TarFile.open(compressed, 'w:lz4') as tar:
+        tar.add_stat(directory, os.stat(directory), 'directory')
+        tar.add_stat(filename, stat, 'directory/file.json')
+
+        # Members aren't retained.
+        assert tar.members == []
+
+    with LZ4TarFile.open(compressed, 'r:lz4') as tar:
+        members = tar.getmembers()
+
+        assert [(tarinfo.name, tarinfo.type) for tarinfo in members] == [
+            ('directory', tarfile.DIRTYPE),
+            ('directory/file.json', tarfile.REGTYPE),
+        ]
+        assert tar.extractfile(members[1]).read() == b'{}'
+        assert members[1].mode == stat.st_mode & 0o7777
+        assert members[1].uid == stat.st_uid
+        assert members[1].uname == ''
+        assert members[1].mtime == int(stat.st_mtime)
+        # No extended header is written.
+        assert members[1].pax_headers == {}
+
+
+def test_add_stat_arcname(tmpdir):
+    compressed = tmpdir.join('compressed.lz4')
+    tmpdir.join('file.json').write('{}')
+    filename = str(tmpdir.join('file.json'))
+
+    with LZ4TarFile.open(compressed, 'w:lz4') as tar:
+        tar.add(filename)
+        tar.add_stat(filename, os.stat(filename))
+
+    with LZ4TarFile.open(compressed, 'r:lz4') as tar:
+        first, second = tar.getmembers()
+
+        assert first.name == second.name
+
+
+def test_add_stat_special(tmpdir):
+    os.mkfifo(str(tmpdir.join('fifo')))
+
+    with LZ4TarFile.open(tmpdir.join('compressed.lz4'), 'w:lz4') as tar:
+        with pytest.raises(ValueError, match='is neither a regular file nor a directory'):
+            tar.add_stat(str(tmpdir.join('fifo')), os.stat(str(tmpdir.join('fifo'))))
@@ -0,0 +1,104 @@
+import os
+import time
+
+import psutil
+import pytest
+
+import ocdskingfisherarchive.s3
+from ocdskingfisherarchive.tarfile import LZ4TarFile
+from ocdskingfisherarchive.throttle import Throttle, TokenBucket, lower_priority, throttle
+from tests import create_crawl
+from tests.stand_in import S3StandIn
+
+
+@pytest.fixture()
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+    return sleeps
+
+
+@pytest.fixture()
+def reset():
+    yield
+    throttle.configure()
+
+
+def test_token_bucket(sleeps):
+    bucket = TokenBucket(1000, capacity=100)
+
+    bucket.consume(100)
+
+    assert sleeps == []
+
+    bucket.consume(300)
+
+    assert sleeps == [pytest.approx(0.3, abs=0.01)]
+
+
+def test_throttle(sleeps):
+    instance = Throttle()
+    instance.read(10 ** 9)
+    instance.upload(10 ** 9)
+
+    assert sleeps == []
+
+    instance.configure(read_rate=100, upload_rate=1000)
+    instance.read(200)
+    instance.upload(2000)
+
+    assert sleeps == [pytest.approx(1, abs=0.01), pytest.approx(1, abs=0.01)]
+
+
+def test_throttle_cpu(sleeps):
+    instance = Throttle()
+    instance.configure(cpu=0.001)
+
+    end = time.process_time() + 0.05
+    while time.process_time() < end:
+        pass
+    instance.read(0)
+
+    # About 0.05 CPU-seconds, at 0.001 CPU-seconds per second.
+    assert sleeps and sleeps[0] > 40
+
+
+def test_tarfile_on_read(tmpdir):
+    tmpdir.join('file').write('x' * 100)
+    sizes = []
+
+    with LZ4TarFile.open(str(tmpdir.join('archive.tar.lz4')), 'w:lz4') as tar:
+        tar.on_read = sizes.append
+        tar.add(str(tmpdir.join('file')), 'file')
+
+    assert sum(sizes) == 100
+
+
+def test_run(archiver, tmpdir, monkeypatch, sleeps, reset):
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', S3StandIn())
+    throttle.configure(read_rate=1, upload_rate=1)
+
+    create_crawl(tmpdir, '20200801_000000', {'a.json': 'a' * 10})
+    archiver.run()
+
+    # The checksum and the data file read the crawl directory, and the files are uploaded.
+    assert len(sleeps) >= 3
+    assert os.listdir(tmpdir.join('data', 'scotland')) == []
+
+
+def test_lower_priority(monkeypatch):
+    increments = []
+    classes = []
+    monkeypatch.setattr(os, 'nice', increments.append)
+    monkeypatch.setattr(psutil.Process, 'ionice', lambda self, ioclass: classes.append(ioclass), raising=False)
+
+    lower_priority()
+
+    assert increments == []
+    assert classes == []
+
+    lower_priority(10, idle_io=True)
+
+    assert increments == [10]
+    if hasattr(psutil, 'IOPRIO_CLASS_IDLE'):
+        assert classes == [psutil.IOPRIO_CLASS_IDLE]
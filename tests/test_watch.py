@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+
+import pytest
+
+import ocdskingfisherarchive.s3
+from ocdskingfisherarchive.scrapy_log_file import ScrapyLogFile
+from ocdskingfisherarchive.watch import IN_CLOSE_WRITE, IN_CREATE, IN_ISDIR, Inotify, Watcher
+from tests import create_crawl
+from tests.stand_in import S3StandIn
+
+linux = pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is only available on Linux')
+
+
+@linux
+def test_inotify(tmpdir):
+    inotify = Inotify()
+    try:
+        inotify.add(str(tmpdir), IN_CREATE | IN_CLOSE_WRITE)
+        tmpdir.mkdir('directory')
+        tmpdir.join('file.txt').write('content')
+
+        events = inotify.read(timeout=1)
+
+        assert [(path, name) for path, mask, name in events] == [
+            (str(tmpdir), 'directory'),
+            (str(tmpdir), 'file.txt'),
+            (str(tmpdir), 'file.txt'),
+        ]
+        assert events[0][1] & IN_ISDIR
+        assert events[1][1] & IN_CREATE
+        assert events[2][1] & IN_CLOSE_WRITE
+        assert inotify.read(timeout=0) == []
+    finally:
+        inotify.close()
+
+
+@linux
+def test_inotify_not_existing(tmpdir):
+    inotify = Inotify()
+    try:
+        with pytest.raises(OSError):
+            inotify.add(str(tmpdir.join('missing')), IN_CREATE)
+    finally:
+        inotify.close()
+
+
+@pytest.mark.parametrize('inotify', [False, True])
+def test_due(inotify, archiver, tmpdir):
+    quiet = time.time() - 100
+    create_crawl(tmpdir, '20200901_000000', {'a.json': 'a'}, mtime=quiet)
+    create_crawl(tmpdir, '20200902_000000', {'a.json': 'a'}, mtime=time.time())
+    create_crawl(tmpdir, '20201001_000000', {'a.json': 'a'}, mtime=quiet)
+    create_crawl(tmpdir, '20200901_000000', {'a.json': 'a'}, source_id='scotland_sample', mtime=quiet)
+    tmpdir.join('data', 'scotland').mkdir('other')
+
+    watcher = Watcher(archiver, quiet_period=60)
+    if not inotify:
+        watcher.inotify = None
+    watcher.scan()
+
+    assert sorted(watcher.crawls) == [('scotland', '20200901_000000'), ('scotland', '20200902_000000'),
+                                      ('scotland', '20201001_000000')]
+    assert sorted(key for key, _ in watcher.due()) == [('scotland', '20200901_000000'),
+                                                       ('scotland', '20201001_000000')]
+
+    # The crawls were considered, and not modified since.
+    watcher.prune(watcher.due())
+    assert watcher.due() == []
+
+    # A crawl for the same month becomes quiet.
+    os.utime(tmpdir.join('data', 'scotland', '20200902_000000'), (quiet, quiet))
+    watcher.scan()
+
+    assert sorted(key for key, _ in watcher.due()) == [('scotland', '20200901_000000'),
+                                                       ('scotland', '20200902_000000')]
+
+    # The interval passes.
+    watcher.prune(watcher.due())
+    watcher.interval = 0
+
+    assert len(watcher.due()) == 3
+
+
+@linux
+def test_wait(archiver, tmpdir):
+    source_directory = tmpdir.mkdir('data').mkdir('scotland')
+    logs_directory = tmpdir.mkdir('logs').mkdir('kingfisher')
+
+    watcher = Watcher(archiver, interval=0.1, quiet_period=0)
+    watcher.scan()
+    assert watcher.crawls == {}
+
+    # A crawl directory is created.
+    source_directory.mkdir('20200902_000000')
+    watcher.wait()
+
+    assert list(watcher.crawls) == [('scotland', '20200902_000000')]
+
+    # A file is written to the crawl directory, and a log file is written.
+    os.utime(source_directory.join('20200902_000000'), (1, 1))
+    source_directory.join('20200902_000000', 'data.json').write('{}')
+    logs_directory.mkdir('scotland')
+    watcher.wait()
+    logs_directory.join('scotland', 'test.log').write('2020-09-02 00:00:00 [scrapy.utils.log] INFO message')
+    watcher.wait()
+
+    assert watcher.crawls[('scotland', '20200902_000000')] > 1
+    assert str(logs_directory.join('scotland', 'test.log')) in ScrapyLogFile._index
+
+    # The crawl directory is deleted.
+    source_directory.join('20200902_000000').remove()
+    watcher.wait()
+
+    assert watcher.crawls == {}
+
+
+def test_run(archiver, tmpdir, monkeypatch):
+    stand_in = S3StandIn()
+    monkeypatch.setattr(ocdskingfisherarchive.s3, 'client', stand_in)
+
+    create_crawl(tmpdir, '20200902_000000', {'a.json': 'a'})
+    create_crawl(tmpdir, '20201001_000000', {'a.json': 'a'}, mtime=time.time())
+
+    calls = []
+    watcher = Watcher(archiver, interval=0, quiet_period=60)
+    watcher.run(callback=lambda: calls.append(1), iterations=1)
+
+    assert sorted(stand_in.objects) == [
+        'scotland/2020/09/data.tar.lz4',
+        'scotland/2020/09/metadata.json',
+        'scotland/2020/09/scrapy.log',
+    ]
+    assert calls == [1]
+    # The archived crawl is no longer tracked.
+    assert list(watcher.crawls) == [('scotland', '20201001_000000')]
+
+
+def test_run_failure(archiver, tmpdir, monkeypatch, caplog):
+    def run(**kwargs):
+        raise RuntimeError('failure')
+
+    create_crawl(tmpdir, '20200902_000000', {'a.json': 'a'})
+    monkeypatch.setattr(archiver, 'run', run)
+
+    watcher = Watcher(archiver, interval=0, quiet_period=60)
+    watcher.run(iterations=2)
+
+    assert [record.message for record in caplog.records if record.levelname == 'ERROR'] == [
+        'Failed to archive 1 quiet crawls',
+        'Failed to archive 1 quiet crawls',
+    ]